@@ -0,0 +1,16 @@
+"""Django settings for turtlecli
+
+turtlecli only ever reads the tortoise models, so none of the apps, middleware,
+or templates needed by the web side of turtle_orm are loaded (which makes for
+a noticeably faster django.setup())
+"""
+
+from turtle_orm.settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = ["tortoise"]
+
+MIDDLEWARE = []
+
+TEMPLATES = []
+
+AUTH_PASSWORD_VALIDATORS = []
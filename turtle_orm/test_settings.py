@@ -0,0 +1,25 @@
+"""Django settings for running the tests
+
+    $ python manage.py test --settings=turtle_orm.test_settings
+
+The Turtle DB is replaced by a throwaway SQLite DB, in which the tests create
+the (unmanaged) tortoise tables themselves (see turtlecli.tests.utils)
+"""
+
+import os
+import tempfile
+
+from turtle_orm.base import *  # noqa: F401,F403
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(tempfile.gettempdir(), "turtlecli-tests.sqlite3"),
+    }
+}
+
+LOGGING["handlers"]["file"] = {"class": "logging.NullHandler"}  # noqa: F405
+LOGGING["loggers"]["turtlecli"]["level"] = "WARNING"  # noqa: F405
+
+# Keep the tests' caches (and daemon socket) away from the user's
+os.environ["XDG_CACHE_HOME"] = tempfile.mkdtemp(prefix="turtlecli-tests-")
@@ -1,8 +1,41 @@
+import sys
+
+from turtlecli import client, profiling
+
+profiling.mark("interpreter startup")
+
+# If a daemon is running, it does all the work; none of the (slow) imports
+# below are needed
+if __name__ == "__main__" and client.should_use_daemon(sys.argv[1:]):
+    status = client.run(sys.argv[1:])
+    if status is not None:
+        sys.exit(status)
+
 import django
 
 django.setup()
+profiling.mark("django setup")
 
 from turtlecli import cli
 
+profiling.mark("imports")
+
 if __name__ == "__main__":
-    cli.main()
+    if len(sys.argv) > 1 and sys.argv[1] == "sync":
+        from turtlecli import replica
+
+        replica.main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "archive":
+        from turtlecli import archive
+
+        archive.main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "export":
+        from turtlecli import export
+
+        export.main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "daemon":
+        from turtlecli import daemon
+
+        daemon.main(sys.argv[2:])
+    else:
+        cli.main()
@@ -0,0 +1,541 @@
+"""Compressed, memory-mapped local archive of History scripts and logs
+
+Logs (and, to a lesser extent, scripts) are extremely repetitive, so they
+compress very well. The archive stores each of these fields as its own
+stream of fixed-size blocks, each holding BLOCK_SIZE consecutive records and
+compressed independently. If zstandard is installed, blocks are compressed
+with zstd, using a dictionary trained on a sample of logs;
+otherwise zlib is used.
+
+Readers memory-map the block files, and only decompress the blocks they
+actually need (the most recently used of which are kept decompressed). An
+ID -> record number index maps each History ID to its block.
+
+The archive lives in a directory under the user's cache directory:
+
+    ids.npy                 History ID of every record, in record order
+    {field}.blocks          Concatenated compressed blocks of each field
+    {field}.offsets.npy     Offset of each block within {field}.blocks
+    meta.pickle             Codec, dictionary, and in-progress History IDs
+
+Records are appended in ID order. Rows that were still in progress when
+archived are re-archived (appended again) once they are updated; the later
+record then takes precedence.
+"""
+
+import argparse
+import collections
+import itertools
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+from tortoise.models import History
+from turtlecli.cache import (
+    get_cache_path,
+    get_db_alias,
+    read_cache_file,
+    write_cache_file,
+)
+from turtlecli.filters import filterByIds
+from turtlecli.textindex import IN_PROGRESS_STATE, TEXT_FIELDS
+
+CONSOLE_LOGGER = logging.getLogger("{}_user".format(__name__))
+
+ARCHIVE_FORMAT_VERSION = 1
+# Number of records per block
+BLOCK_SIZE = 64
+# Number of decompressed blocks kept in memory (per field)
+MAX_CACHED_BLOCKS = 32
+# Number of History rows fetched from the DB at a time when updating
+UPDATE_CHUNK_SIZE = 512
+ZSTD_LEVEL = 10
+ZSTD_DICT_SIZE = 112640
+# Number of records used to train the zstd dictionary
+ZSTD_DICT_SAMPLES = 500
+# Each block begins with the (uint32) length of each of its records
+LENGTH_FORMAT = "<{}I"
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def encode_block(records):
+    """Serialize the given list of strings (or None) into a single bytes"""
+
+    encoded = [record.encode("utf-8") if record else b"" for record in records]
+    return struct.pack(
+        LENGTH_FORMAT.format(len(encoded)), *[len(data) for data in encoded]
+    ) + b"".join(encoded)
+
+
+def decode_block(data, num_records):
+    """The inverse of encode_block"""
+
+    header_size = struct.calcsize(LENGTH_FORMAT.format(num_records))
+    lengths = struct.unpack(LENGTH_FORMAT.format(num_records), data[:header_size])
+    records = []
+    offset = header_size
+    for length in lengths:
+        records.append(data[offset : offset + length].decode("utf-8"))
+        offset += length
+    return records
+
+
+def import_zstandard():
+    """Return the zstandard module, or None if it isn't installed
+
+    It is only imported once an archive is actually used, rather than at startup"""
+
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+class Codec:
+    """Block compression: zstd (with an optional dictionary) or zlib"""
+
+    def __init__(self, name, dictionary=None):
+        zstandard = import_zstandard()
+        if name == "zstd" and not zstandard:
+            raise ArchiveError(
+                "This archive is compressed with zstd, but zstandard is not installed"
+            )
+        self.name = name
+        self.dictionary = dictionary
+        # A ZstdDecompressor must not be used by multiple threads at once
+        self.lock = threading.Lock()
+        if name == "zstd":
+            zstd_dict = (
+                zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            )
+            self.compressor = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL, dict_data=zstd_dict
+            )
+            self.decompressor = zstandard.ZstdDecompressor(dict_data=zstd_dict)
+
+    @classmethod
+    def train(cls, samples):
+        """Return the best available Codec, with a dictionary trained on the given samples"""
+
+        zstandard = import_zstandard()
+        if not zstandard:
+            return cls("zlib")
+
+        samples = [sample.encode("utf-8") for sample in samples if sample]
+        try:
+            dictionary = zstandard.train_dictionary(ZSTD_DICT_SIZE, samples).as_bytes()
+        except zstandard.ZstdError as error:
+            CONSOLE_LOGGER.debug("Could not train zstd dictionary: %s", error)
+            dictionary = None
+        return cls("zstd", dictionary)
+
+    def compress(self, data):
+        if self.name == "zstd":
+            return self.compressor.compress(data)
+        return zlib.compress(data, 9)
+
+    def decompress(self, data):
+        if self.name == "zstd":
+            with self.lock:
+                return self.decompressor.decompress(data)
+        return zlib.decompress(data)
+
+
+class FieldBlocks:
+    """Read access to the (memory-mapped) compressed blocks of a single field"""
+
+    def __init__(self, blocks_path, offsets, codec):
+        self.offsets = offsets
+        self.codec = codec
+        self.cache = collections.OrderedDict()
+        # Reports may be prefetched concurrently, and the cache isn't thread-safe
+        self.lock = threading.Lock()
+        self.file = open(blocks_path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        self.mmap = (
+            mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        )
+
+    def num_blocks(self):
+        return len(self.offsets) - 1
+
+    def block(self, block_num, num_records):
+        """Return the decompressed records of the given block"""
+
+        with self.lock:
+            if block_num in self.cache:
+                self.cache.move_to_end(block_num)
+                return self.cache[block_num]
+
+            start, end = self.offsets[block_num], self.offsets[block_num + 1]
+            records = decode_block(
+                self.codec.decompress(self.mmap[start:end]), num_records
+            )
+            self.cache[block_num] = records
+            if len(self.cache) > MAX_CACHED_BLOCKS:
+                self.cache.popitem(last=False)
+            return records
+
+    def close(self):
+        if isinstance(self.mmap, mmap.mmap):
+            self.mmap.close()
+        self.file.close()
+
+
+class Archive:
+    def __init__(self, path=None, using=None):
+        self.using = using
+        self.path = path if path else get_cache_path("archive", using, "d")
+        self.meta_path = os.path.join(self.path, "meta.pickle")
+        self.ids_path = os.path.join(self.path, "ids.npy")
+        self.meta = read_cache_file(self.meta_path, ARCHIVE_FORMAT_VERSION)
+        self.fields = {}
+        if self.meta:
+            self._open()
+
+    def exists(self):
+        return bool(self.meta)
+
+    def blocks_path(self, field):
+        return os.path.join(self.path, "{}.blocks".format(field))
+
+    def offsets_path(self, field):
+        return os.path.join(self.path, "{}.offsets.npy".format(field))
+
+    def _open(self):
+        self.codec = Codec(self.meta["codec"], self.meta["dictionary"])
+        self.ids = np.load(self.ids_path)
+        # A stable sort means that, for any ID that was archived more than
+        # once, the latest record comes last
+        self.order = np.argsort(self.ids, kind="stable")
+        self.sorted_ids = self.ids[self.order]
+        for field in TEXT_FIELDS:
+            self.fields[field] = FieldBlocks(
+                self.blocks_path(field), np.load(self.offsets_path(field)), self.codec
+            )
+
+    def close(self):
+        for blocks in self.fields.values():
+            blocks.close()
+        self.fields = {}
+
+    def __len__(self):
+        return len(self.ids) if self.meta else 0
+
+    def __contains__(self, id_):
+        return self.record_num(id_) is not None
+
+    def record_num(self, id_):
+        """Return the number of the latest record of the given History ID, or None"""
+
+        if not self.meta:
+            return None
+        index = np.searchsorted(self.sorted_ids, id_, side="right") - 1
+        if index < 0 or self.sorted_ids[index] != id_:
+            return None
+        return int(self.order[index])
+
+    def _block_records(self, field, block_num):
+        num_records = min(BLOCK_SIZE, len(self.ids) - block_num * BLOCK_SIZE)
+        return self.fields[field].block(block_num, num_records)
+
+    def get(self, field, id_):
+        """Return the archived `field` of the given History ID, or None
+
+        None is also returned for rows that were in progress when archived,
+        since their archived log may be incomplete"""
+
+        if id_ in self.meta["in_progress"]:
+            return None
+        return self._get_record(field, id_)
+
+    def _get_record(self, field, id_):
+        record_num = self.record_num(id_)
+        if record_num is None:
+            return None
+        block_num, position = divmod(record_num, BLOCK_SIZE)
+        return self._block_records(field, block_num)[position]
+
+    def get_many(self, field, ids):
+        """Return a dict of {id: text} for all of the given IDs that are archived"""
+
+        texts = {}
+        for id_ in sorted(ids, key=lambda id_: self.record_num(id_) or 0):
+            text = self.get(field, id_)
+            if text is not None:
+                texts[id_] = text
+        return texts
+
+    def with_texts(self, rows, field, using=None, chunk_size=None):
+        """Generate the given (dict) rows, with their `field` added
+
+        Texts are read from the archive where possible. The rest are fetched
+        from the DB, in one query per chunk_size rows (or for all of them, if
+        chunk_size isn't given)"""
+
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size) if chunk_size else rows)
+            if not chunk:
+                return
+            texts = self.get_many(field, [row["id"] for row in chunk])
+            missing_ids = [row["id"] for row in chunk if row["id"] not in texts]
+            if missing_ids:
+                texts.update(
+                    History.objects.using(using)
+                    .filter(filterByIds(missing_ids, using=using))
+                    .values_list("id", field)
+                )
+            for row in chunk:
+                row[field] = texts.get(row["id"])
+                yield row
+
+    def iter_records(self, field):
+        """Generate (id, text) for the latest record of every archived History ID"""
+
+        if not self.meta:
+            return
+        for block_num in range(self.fields[field].num_blocks()):
+            records = self._block_records(field, block_num)
+            for position, text in enumerate(records):
+                record_num = block_num * BLOCK_SIZE + position
+                id_ = int(self.ids[record_num])
+                if self.record_num(id_) == record_num:
+                    yield id_, text
+
+    def grep(self, field, pattern):
+        """Generate the History IDs whose `field` matches the given regex (case-insensitive)"""
+
+        regex = re.compile(pattern, re.IGNORECASE)
+        for id_, text in self.iter_records(field):
+            if regex.search(text):
+                yield id_
+
+    def _write(self, ids, offsets, in_progress):
+        np.save(self.ids_path, np.asarray(ids, dtype=np.int64))
+        for field in TEXT_FIELDS:
+            np.save(
+                self.offsets_path(field), np.asarray(offsets[field], dtype=np.int64)
+            )
+        write_cache_file(
+            self.meta_path,
+            {
+                "version": ARCHIVE_FORMAT_VERSION,
+                "codec": self.codec.name,
+                "dictionary": self.codec.dictionary,
+                "in_progress": in_progress,
+            },
+        )
+
+    def update(self, full=False):
+        """Append all History rows that are new (or were in progress) since the last update"""
+
+        queryset = History.objects.using(self.using).values_list(
+            "id", *TEXT_FIELDS, "executed_state"
+        )
+        os.makedirs(self.path, exist_ok=True)
+        # The archive is inconsistent until the update is complete, so it
+        # mustn't be readable in the meantime
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+
+        changed_rows = []
+        if full or not self.meta:
+            self.close()
+            self.codec = Codec.train(
+                History.objects.using(self.using)
+                .order_by("-id")
+                .values_list("log", flat=True)[:ZSTD_DICT_SAMPLES]
+            )
+            CONSOLE_LOGGER.debug("Creating archive using %s", self.codec.name)
+            ids = []
+            offsets = {field: [0] for field in TEXT_FIELDS}
+            in_progress = set()
+            for field in TEXT_FIELDS:
+                open(self.blocks_path(field), "wb").close()
+        else:
+            ids = list(self.ids)
+            offsets = {field: list(self.fields[field].offsets) for field in TEXT_FIELDS}
+            in_progress = set(self.meta["in_progress"])
+            # Rows that were in progress are only re-archived if they have
+            # actually changed (many are never marked as finished)
+            for row in queryset.filter(id__in=sorted(in_progress)).order_by("id"):
+                id_, executed_script, log, executed_state = row
+                if (executed_script or "") != self._get_record(
+                    "executed_script", id_
+                ) or (log or "") != self._get_record("log", id_):
+                    changed_rows.append(row)
+                elif executed_state != IN_PROGRESS_STATE:
+                    in_progress.discard(id_)
+            self.close()
+
+        writer = ArchiveWriter(self, ids, offsets)
+
+        def append(rows):
+            for id_, executed_script, log, executed_state in rows:
+                writer.append(id_, {"executed_script": executed_script, "log": log})
+                if executed_state == IN_PROGRESS_STATE:
+                    in_progress.add(id_)
+                else:
+                    in_progress.discard(id_)
+
+        if changed_rows:
+            CONSOLE_LOGGER.debug(
+                "Re-archiving %s changed in-progress rows", len(changed_rows)
+            )
+            append(changed_rows)
+
+        watermark = max(ids) if ids else 0
+        num_archived = 0
+        while True:
+            rows = list(
+                queryset.filter(id__gt=watermark).order_by("id")[:UPDATE_CHUNK_SIZE]
+            )
+            if not rows:
+                break
+            append(rows)
+            watermark = rows[-1][0]
+            num_archived += len(rows)
+            CONSOLE_LOGGER.debug("Archived History rows up to ID %s", watermark)
+
+        writer.close()
+        self._write(writer.ids, writer.offsets, in_progress)
+        self.meta = read_cache_file(self.meta_path, ARCHIVE_FORMAT_VERSION)
+        self._open()
+        CONSOLE_LOGGER.info(
+            "Archived %s new History rows (%s records in %s)",
+            num_archived,
+            len(self.ids),
+            self.path,
+        )
+
+
+class ArchiveWriter:
+    """Appends records to the block files of an archive
+
+    The last block of each field may be partial; if so, it is re-read, and
+    rewritten once it has more records"""
+
+    def __init__(self, archive, ids, offsets):
+        self.archive = archive
+        self.ids = ids
+        self.offsets = offsets
+        self.files = {}
+        self.pending = {field: [] for field in TEXT_FIELDS}
+
+        num_partial = len(ids) % BLOCK_SIZE
+        for field in TEXT_FIELDS:
+            file = open(archive.blocks_path(field), "r+b")
+            if num_partial:
+                start, end = offsets[field][-2:]
+                file.seek(start)
+                self.pending[field] = decode_block(
+                    archive.codec.decompress(file.read(end - start)), num_partial
+                )
+                # The partial block will be rewritten
+                offsets[field].pop()
+                file.truncate(start)
+            file.seek(0, os.SEEK_END)
+            self.files[field] = file
+
+    def _flush(self):
+        for field in TEXT_FIELDS:
+            data = self.archive.codec.compress(encode_block(self.pending[field]))
+            self.files[field].write(data)
+            self.offsets[field].append(self.offsets[field][-1] + len(data))
+            self.pending[field] = []
+
+    def append(self, id_, texts):
+        self.ids.append(id_)
+        for field in TEXT_FIELDS:
+            self.pending[field].append(texts[field])
+        if len(self.pending[TEXT_FIELDS[0]]) == BLOCK_SIZE:
+            self._flush()
+
+    def close(self):
+        if self.pending[TEXT_FIELDS[0]]:
+            self._flush()
+        for file in self.files.values():
+            file.close()
+
+
+_ARCHIVES = {}
+
+
+def get_archive(using=None):
+    """Return the (process-wide) Archive for the given DB alias, or None if there isn't one"""
+
+    using = get_db_alias(using)
+    if using not in _ARCHIVES:
+        archive = Archive(using=using)
+        _ARCHIVES[using] = archive if archive.exists() else None
+    return _ARCHIVES[using]
+
+
+def clear_archives():
+    """Close and forget the process-wide Archives
+
+    They are re-opened when next retrieved, so that they reflect any updates"""
+
+    for archive in _ARCHIVES.values():
+        if archive:
+            archive.close()
+    _ARCHIVES.clear()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="turtlecli archive",
+        description="Maintain a local, compressed archive of all scripts and logs, "
+        "for use with turtlecli --use-archive. Compression is much better if "
+        "zstandard is installed",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Rebuild the archive from scratch, rather than only appending rows that "
+        "are new (or were in progress) since the last update",
+    )
+    parser.add_argument(
+        "--grep",
+        metavar="REGEX",
+        help="Rather than updating the archive, print the IDs of all archived "
+        "History rows whose --field matches the given (Python-style, "
+        "case-insensitive) regular expression",
+    )
+    parser.add_argument(
+        "--field",
+        choices=TEXT_FIELDS,
+        default="log",
+        help="The field searched by --grep",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+        help="Specify the logging level",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger("turtlecli").setLevel(args.log_level)
+    archive = Archive()
+    if args.grep:
+        if not archive.exists():
+            raise ArchiveError("No archive exists; run 'turtlecli archive' first")
+        for id_ in archive.grep(args.field, args.grep):
+            print(id_)
+    else:
+        archive.update(full=args.full)
@@ -0,0 +1,280 @@
+"""Persistent, on-disk cache of the Turtle dimension tables
+
+The Observer, Operator, ObsProjectRef, and ObsProcedure tables are tiny
+compared to History, and change rarely. They are cached locally (in a single
+pickle file under the user's cache directory) so that names can be mapped
+to/from IDs without any round trips to the DB.
+
+A table is fully re-fetched once its TTL has expired. Between these full
+refreshes, new rows are picked up by fetching only those above the cached
+max-id watermark, which happens whenever a lookup misses.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import time
+
+from django.db import connections, router
+
+from tortoise.models import History, ObsProcedure, ObsProjectRef, Observer, Operator
+from turtlecli.projects import ProjectIndex, build_project_keys
+from turtlecli.utils import DEFAULT_HISTORY_TABLE_FIELDNAMES
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "turtlecli"
+)
+# Seconds after which a cached table is considered stale and fully re-fetched
+DEFAULT_TTL = float(os.environ.get("TURTLECLI_CACHE_TTL", 24 * 60 * 60))
+CACHE_FORMAT_VERSION = 1
+
+# The fields that are cached for each model, in addition to "id"
+CACHED_FIELDS = {
+    Observer: ("name",),
+    Operator: ("name",),
+    ObsProjectRef: ("name",),
+    ObsProcedure: ("name", "obsprojectref_id"),
+}
+
+
+def get_db_alias(using=None):
+    """Return the given DB alias or, if None, the alias that History is read from
+
+    The latter is "default", unless a router has been installed (e.g. by
+    --local; see turtlecli.replica)"""
+
+    return using if using else router.db_for_read(History)
+
+
+def get_cache_path(name, using=None, extension="pickle"):
+    """Return the path to the cache file `name` for the given DB alias
+
+    Each DB gets its own cache files, so that e.g. a local replica and the
+    production server are never confused with one another"""
+
+    settings_dict = connections[get_db_alias(using)].settings_dict
+    db_key = "{ENGINE}:{HOST}:{PORT}:{NAME}".format(**settings_dict)
+    digest = hashlib.md5(db_key.encode()).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, "{}.{}.{}".format(name, digest, extension))
+
+
+def read_cache_file(path, version):
+    """Read the given cache file, and return its contents
+
+    If it can't be read, or is not of the given version, return None"""
+
+    try:
+        with open(path, "rb") as file:
+            cached = pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError) as error:
+        logger.debug("Could not load cache file %s: %s", path, error)
+        return None
+
+    if cached.get("version") != version:
+        logger.debug("Ignoring cache file %s; unknown version", path)
+        return None
+    logger.debug("Loaded cache file %s", path)
+    return cached
+
+
+def write_cache_file(path, data):
+    """Atomically write the given data to the given cache file
+
+    Return True if it was successfully written"""
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as file:
+            pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except OSError as error:
+        # Caches are purely an optimization; never fail because of them
+        logger.warning("Could not write cache file %s: %s", path, error)
+        return False
+
+    logger.debug("Saved cache file %s", path)
+    return True
+
+
+class DimensionCache:
+    def __init__(self, path=None, ttl=DEFAULT_TTL, using=None):
+        self.using = get_db_alias(using)
+        self.path = path if path else get_cache_path("dimensions", self.using)
+        self.ttl = ttl
+        # Maps model name to a dict of {"refreshed": timestamp, "rows": {id: row}}
+        self.tables = {}
+        self.dirty = False
+        # Maps model name to the IDs that couldn't be found during this run
+        self.missing = {}
+        # Models that have already been refreshed on a miss during this run
+        self.refreshed_on_miss = set()
+        self.load()
+
+    def load(self):
+        cached = read_cache_file(self.path, CACHE_FORMAT_VERSION)
+        if cached:
+            self.tables = cached["tables"]
+
+    def save(self):
+        """Atomically write the cache to disk, if anything has changed"""
+
+        if not self.dirty:
+            return
+
+        if write_cache_file(
+            self.path, {"version": CACHE_FORMAT_VERSION, "tables": self.tables}
+        ):
+            self.dirty = False
+
+    def _fetch(self, model, min_id=None):
+        queryset = model.objects.using(self.using)
+        if min_id is not None:
+            queryset = queryset.filter(id__gt=min_id)
+        fields = CACHED_FIELDS[model]
+        return {
+            row[0]: row[1] if len(fields) == 1 else row[1:]
+            for row in queryset.values_list("id", *fields)
+        }
+
+    def refresh(self, model, full=False):
+        """Refresh the cached rows of the given model
+
+        If full is given, or the TTL has expired, the whole table is
+        re-fetched. Otherwise only rows above the max-id watermark are"""
+
+        table = self.tables.get(model.__name__)
+        if full or table is None or time.time() - table["refreshed"] > self.ttl:
+            logger.debug("Fetching all %s rows", model.__name__)
+            self.tables[model.__name__] = {
+                "refreshed": time.time(),
+                "rows": self._fetch(model),
+            }
+        else:
+            watermark = max(table["rows"], default=0)
+            logger.debug("Fetching %s rows with ID > %s", model.__name__, watermark)
+            table["rows"].update(self._fetch(model, min_id=watermark))
+            # Anything derived from the rows is now out of date
+            table.pop("project_keys", None)
+        self.missing.pop(model.__name__, None)
+        self.dirty = True
+
+    def refresh_all(self, full=False):
+        for model in CACHED_FIELDS:
+            self.refresh(model, full=full)
+        self.save()
+
+    def rows(self, model):
+        """Return a dict mapping ID to the cached row of the given model
+
+        For models with a single cached field (name), the row is simply
+        that value"""
+
+        table = self.tables.get(model.__name__)
+        if table is None or time.time() - table["refreshed"] > self.ttl:
+            self.refresh(model)
+        return self.tables[model.__name__]["rows"]
+
+    def names(self, model):
+        """Return a dict mapping ID to the cached name of the given model"""
+
+        rows = self.rows(model)
+        if len(CACHED_FIELDS[model]) == 1:
+            return rows
+        return {id_: row[0] for id_, row in rows.items()}
+
+    def get(self, model, id_):
+        """Return the cached row for the given ID
+
+        On the first miss of a run, rows newer than the watermark are fetched
+        and the lookup is tried again. If it still can't be found, None is
+        returned (and the ID is remembered as missing until the next refresh).
+        The cache isn't saved; see finish()"""
+
+        if id_ in self.missing.get(model.__name__, ()):
+            return None
+        rows = self.rows(model)
+        if id_ not in rows and model.__name__ not in self.refreshed_on_miss:
+            self.refreshed_on_miss.add(model.__name__)
+            self.refresh(model)
+            rows = self.rows(model)
+        if id_ not in rows:
+            self.missing.setdefault(model.__name__, set()).add(id_)
+        return rows.get(id_)
+
+    def finish(self):
+        """Save the cache, and forget the misses of this run"""
+
+        self.save()
+        self.missing.clear()
+        self.refreshed_on_miss.clear()
+
+    def project_index(self):
+        """Return a ProjectIndex of all cached ObsProjectRef names
+
+        The canonical project keys are computed only once per refresh of the
+        ObsProjectRef table, and are cached alongside it"""
+
+        rows = self.rows(ObsProjectRef)
+        table = self.tables[ObsProjectRef.__name__]
+        if "project_keys" not in table:
+            table["project_keys"] = build_project_keys(rows)
+            self.dirty = True
+        return ProjectIndex(rows, table["project_keys"])
+
+    def observer_name(self, observer_id):
+        return self.get(Observer, observer_id)
+
+    def operator_name(self, operator_id):
+        return self.get(Operator, operator_id)
+
+    def procedure_name(self, obsprocedure_id):
+        procedure = self.get(ObsProcedure, obsprocedure_id)
+        return procedure[0] if procedure else None
+
+    def project_name(self, obsprocedure_id):
+        procedure = self.get(ObsProcedure, obsprocedure_id)
+        return self.get(ObsProjectRef, procedure[1]) if procedure else None
+
+    def resolve_history_frame(self, df):
+        """Replace the foreign key columns of the given History DataFrame with names
+
+        `df` is expected to have obsprocedure, observer, and operator columns
+        containing IDs (i.e. as produced by to_timeseries with verbose=False).
+        The returned DataFrame instead has the columns given in
+        DEFAULT_HISTORY_TABLE_FIELDNAMES"""
+
+        df = df.copy()
+        df["obsprocedure__obsprojectref__name"] = [
+            self.project_name(id_) for id_ in df["obsprocedure"]
+        ]
+        df["obsprocedure__name"] = [
+            self.procedure_name(id_) for id_ in df["obsprocedure"]
+        ]
+        df["observer__name"] = [self.observer_name(id_) for id_ in df["observer"]]
+        df["operator__name"] = [self.operator_name(id_) for id_ in df["operator"]]
+        # The first field is the datetime index
+        return df[list(DEFAULT_HISTORY_TABLE_FIELDNAMES[1:])]
+
+
+_DIMENSION_CACHES = {}
+
+
+def get_dimension_cache(using=None):
+    """Return the (process-wide) DimensionCache for the given DB alias"""
+
+    using = get_db_alias(using)
+    if using not in _DIMENSION_CACHES:
+        _DIMENSION_CACHES[using] = DimensionCache(using=using)
+    return _DIMENSION_CACHES[using]
+
+
+def finish_dimension_caches():
+    """Finish the run of every DimensionCache (see DimensionCache.finish)"""
+
+    for dimensions in _DIMENSION_CACHES.values():
+        dimensions.finish()
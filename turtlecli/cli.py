@@ -9,32 +9,28 @@ import sys
 
 import dateutil.parser as dp
 from dateutil.relativedelta import relativedelta
-import IPython
 
 from django.utils import timezone
-from django.db.models import Q
 from django.db import connections
 
 from tortoise.models import History
-from turtlecli.filters import (
-    filterByRange,
-    filterByProject,
-    filterByScript,
-    filterByObserver,
-    filterByOperator,
-)
+from turtlecli.cache import finish_dimension_caches, get_db_alias, get_dimension_cache
+from turtlecli.query import compile_query
 from turtlecli.utils import (
     genHistoryTable,
     in_ipython,
     formatSql,
-    DEFAULT_HISTORY_TABLE_FIELDNAMES,
+    HISTORY_TABLE_ID_FIELDNAMES,
     get_console_width,
-    format_date_time,
-    iterable_to_fancy_string,
 )
 from turtlecli.reports import DiffReport, LogReport, ScriptReport
-from turtlecli.gitify import gitify
-
+from turtlecli.render import Renderer
+from turtlecli.gitify import gitify, gitify_by_project
+from turtlecli.archive import get_archive
+from turtlecli.execution import ExecutedQuery, QueryExecutor
+from turtlecli.profiling import Profiler
+from turtlecli.streaming import STREAM_CHUNK_SIZE
+from turtlecli.replica import use_replica
 
 FILE_LOGGER = logging.getLogger("{}_file".format(__name__))
 CONSOLE_LOGGER = logging.getLogger("{}_user".format(__name__))
@@ -53,7 +49,7 @@ def parse_kwargs(kwargs_list):
     return kwargs
 
 
-def parse_args():
+def parse_args(argv=None):
     console_width = get_console_width()
     width = console_width * 0.8 if console_width > 80 / 0.8 else 80
     parser = argparse.ArgumentParser(
@@ -86,10 +82,12 @@ def parse_args():
     general_group.add_argument(
         "--regex",
         action="store_true",
-        help="Indicates that given search terms are MySQL-style regular expressions. For "
+        help="Indicates that given search terms are regular expressions. For "
         "example, if this is given then --project-names '^AGBT.*72$' would be treated "
         "as a regular expression and all resultls in which the project name starts "
-        " with AGBT and ends with 72 would be returned",
+        " with AGBT and ends with 72 would be returned. Project, script, observer, and "
+        "operator names are matched locally, so these use Python-style regular "
+        "expressions",
     )
     general_group.add_argument(
         "-v",
@@ -98,6 +96,50 @@ def parse_args():
         help="Make output more verbose. Note: this will display SQL "
         "queries made during the initial query",
     )
+    general_group.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="Re-fetch the locally-cached observer, operator, project, and "
+        "procedure names before querying. These are otherwise only re-fetched "
+        "periodically (see $TURTLECLI_CACHE_TTL)",
+    )
+    general_group.add_argument(
+        "--use-archive",
+        action="store_true",
+        help="Read scripts and logs from the local compressed archive where "
+        "possible, rather than from the DB. The archive is created (and brought "
+        "up to date) via 'turtlecli archive'",
+    )
+    general_group.add_argument(
+        "--local",
+        action="store_true",
+        help="Query the local replica of the Turtle DB, rather than the server. "
+        "The replica is created (and brought up to date) via 'turtlecli sync'",
+    )
+    general_group.add_argument(
+        "--replica-path",
+        help="Path to the replica queried by --local, if it was synced to one "
+        "via 'turtlecli sync --path' (default: under ~/.cache/turtlecli)",
+    )
+    general_group.add_argument(
+        "--chunk-size",
+        type=int,
+        default=STREAM_CHUNK_SIZE,
+        help="The number of results fetched from the DB at a time when saving "
+        "or showing logs, or exporting to git. Results are streamed, so only "
+        "this many are held in memory at once",
+    )
+    general_group.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="The number of queries that may be made concurrently (each on its "
+        "own DB connection). For example, the total number of results is counted "
+        "while the results themselves are fetched, and report contents are "
+        "fetched while the results table is displayed. Give 1 to make queries "
+        "one at a time",
+    )
     parser.add_argument(
         "--log-level",
         choices=["DEBUG", "INFO", "WARNING", "ERROR"],
@@ -277,12 +319,19 @@ def parse_args():
         help="Specify the path into which all output files will be written."
         "If the path does not exist, an attempt will be made to create it.",
     )
+    output_group.add_argument(
+        "--no-pager",
+        action="store_true",
+        help="Don't pipe long output into $PAGER (less -R by default). Output is "
+        "only ever paged if stdout is a terminal",
+    )
     output_group.add_argument(
         # TODO: --diff is deprecated
         "--show-diffs",
         "--diff",
         action="store_true",
-        help="Show the differences between the scripts for each result",
+        help="Show the differences between the script of each result and that of "
+        "the previous execution of the same script (whether or not it is a result)",
     )
     output_group.add_argument(
         "--show-logs",
@@ -306,6 +355,16 @@ def parse_args():
         action="store_true",
         help="Save the script for each result to file. Path is relative to --output.",
     )
+    output_group.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        metavar="JSON_PATH",
+        help="Show how long each phase of execution (startup, query, table "
+        "rendering, each report, etc.) took, along with every SQL query made (and "
+        "the rows and bytes it returned). If a path is given, the profile is "
+        "written to it as JSON instead",
+    )
     output_group.add_argument(
         "--show-sql",
         action="store_true",
@@ -318,7 +377,15 @@ def parse_args():
         action="store_true",
         help="Export all results to a git repository, with every execution "
         "forming a commit. Execution date is used as commit date. File name "
-        "is in the format {PROJECT}.{SCRIPTNAME}.py",
+        "is in the format {PROJECT}.{SCRIPTNAME}.py. If the repository has been "
+        "exported to before, only executions since the last export are added",
+    )
+    output_group.add_argument(
+        "--shard-by-project",
+        action="store_true",
+        help="With --export-to-git, export each project to its own repository "
+        "(under --output), in parallel across --jobs processes. The repositories "
+        "are indexed by manifest.json",
     )
 
     ### Advanced Group ###
@@ -328,6 +395,16 @@ def parse_args():
         "advisable to couple them with a reasonable --limit value. "
         "Note also that none of these are case-sensitive",
     )
+    advanced_group.add_argument(
+        "--use-index",
+        action="store_true",
+        help="Use a local index (stored in ~/.cache/turtlecli) for --script-contains, "
+        "--log-contains, --script-regex, --log-regex, and --kwargs, rather than "
+        "searching on the server (note that the regexes are then Python-style). "
+        "The index is "
+        "brought up to date with the server every time it is used. NOTE: The first "
+        "use will take a VERY long time, since every script and log must be fetched",
+    )
     advanced_group.add_argument(
         "-k",
         "--kwargs",
@@ -335,7 +412,14 @@ def parse_args():
         metavar="KEY=VALUE",
         help="Search for one or more keyword=value style statements within observation "
         "scripts. Note that whitespace DOES NOT matter here (though key/value pairs "
-        "must be separated by spaces)",
+        "must be separated by spaces). If --use-index is given, numeric values "
+        "are compared as numbers",
+    )
+    advanced_group.add_argument(
+        "--all-kwargs",
+        action="store_true",
+        help="Require that scripts contain ALL of the given --kwargs, rather "
+        "than any of them",
     )
     advanced_group.add_argument(
         "--script-contains",
@@ -364,11 +448,27 @@ def parse_args():
         "used to search within logs",
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.exact and args.regex:
         parser.error("--exact cannot be given alongside --regex!")
 
+    if args.replica_path and not args.local:
+        parser.error("--replica-path can only be given alongside --local")
+
+    if args.local:
+        try:
+            use_replica(args.replica_path)
+        except ValueError as error:
+            parser.error(str(error))
+
+    if args.use_archive:
+        args.archive = get_archive()
+        if not args.archive:
+            parser.error("No archive found; run 'turtlecli archive' first")
+    else:
+        args.archive = None
+
     if args.kwargs:
         # Parse the keyword-value strings inside of kwargs. If there is
         # a ValueError, consider it a parsing error
@@ -419,15 +519,33 @@ def parse_args():
             "--output is meaningless without --save-scripts, --save-logs, or --export-to-git"
         )
 
+    if args.shard_by_project and not args.export_to_git:
+        parser.error("--shard-by-project is meaningless without --export-to-git")
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
     return args
 
 
-def generateRegexpStatement(keyword, value):
-    return r"{keyword}\s*=\s*[\'\"]{value}[\'\"]".format(keyword=keyword, value=value)
+def get_report(prefetched_reports, report_class, *args, **kwargs):
+    """Return the prefetched report of the given class, or create it now"""
+
+    if report_class in prefetched_reports:
+        return prefetched_reports[report_class].result()
+    return report_class(*args, **kwargs)
+
+
+def prefetch_report(report_class, *args, **kwargs):
+    return report_class(*args, **kwargs).prefetch()
 
 
-def main():
-    args = parse_args()
+def main(argv=None):
+    profiler = Profiler()
+    with profiler.phase("argument parsing"):
+        args = parse_args(argv)
+    profiler.enabled = args.profile is not None
+    profiler.install()
 
     # Set up logging
     if args.verbose:
@@ -447,286 +565,233 @@ def main():
         logging.getLogger("django.db.backends").setLevel("DEBUG")
 
     CONSOLE_LOGGER.debug("Done parsing arguments!")
-    FILE_LOGGER.info("argv: %s", " ".join([shlex.quote(arg) for arg in sys.argv]))
+    FILE_LOGGER.info(
+        "argv: %s",
+        " ".join([shlex.quote(arg) for arg in (argv if argv else sys.argv)]),
+    )
 
-    description_parts = []
-    results = History.objects.all()
-    if args.project_names:
-        plural = "s" if args.project_names and len(args.project_names) > 1 else ""
-        description_parts.append(
-            "for project name{} {}".format(
-                plural,
-                iterable_to_fancy_string(args.project_names, quote=True, word="or"),
-            )
-        )
-        results &= filterByProject(
-            args.project_names, fuzzy=not args.exact, regex=args.regex
-        )
+    with profiler.phase("query compilation"):
+        if args.refresh_cache:
+            get_dimension_cache().refresh_all(full=True)
 
-    if args.script_names:
-        plural = "s" if args.script_names and len(args.script_names) > 1 else ""
-        description_parts.append(
-            "for script name{} {}".format(
-                plural,
-                iterable_to_fancy_string(args.script_names, quote=True, word="or"),
-            )
-        )
-        results &= filterByScript(args.script_names, regex=args.regex)
+        query, description_parts = compile_query(args)
+        # Everything is compiled into a single Q, so only one SELECT is issued
+        results = History.objects.filter(query)
+        # Queries made prior to this point (connection setup, name resolution) are
+        # not relevant to the query time we report
+        connection = connections[get_db_alias()]
+        connection.ensure_connection()
+        first_query_index = len(connection.queries)
 
-    if args.observers:
-        plural = "s" if args.observers and len(args.observers) > 1 else ""
+    if args.sort_by:
         description_parts.append(
-            "by observer name{} {}".format(
-                plural, iterable_to_fancy_string(args.observers, quote=True, word="or")
-            )
+            "ordered by {} ({})".format(args.sort_by, args.direction)
         )
-        results &= filterByObserver(
-            args.observers, fuzzy=not args.exact, regex=args.regex
+        direction = "-" if args.direction == "descending" else ""
+        # ID breaks ties, so that the order is the same every time the
+        # results are fetched
+        results = results.order_by(
+            "{}{}".format(direction, args.sort_by), "{}id".format(direction)
         )
 
-    if args.operators:
-        plural = "s" if args.operators and len(args.operators) > 1 else ""
-        description_parts.append(
-            "with operator name{} {}".format(
-                plural, iterable_to_fancy_string(args.operators, quote=True, word="or")
-            )
+    with profiler.phase("query execution"):
+        # THIS IS WHERE THE QUERY IS ACTUALLY EXECUTED (once)
+        # Only IDs are fetched here; names are filled in from the dimension cache
+        executor = QueryExecutor(args.jobs)
+        executed = ExecutedQuery(
+            results, args.limit, HISTORY_TABLE_ID_FIELDNAMES, executor=executor
         )
-        results &= filterByOperator(
-            args.operators, fuzzy=not args.exact, regex=args.regex
-        )
-
-    if args.state:
-        # Argument choices are shortened forms of the possible field values
-        state = "obs_{}".format(args.state)
-        description_parts.append("with state {}".format(state))
-        results &= History.objects.filter(executed_state=state)
-
-    if args.times:
-        time_bits = History.objects.none()
-        stubs = []
-        for time in args.times:
-            assert time.tzinfo
-            start = time - args.buffer
-            end = time + args.buffer
-            stubs.append(
-                "{} {} of {} (i.e. between {} and {})".format(
-                    getattr(args.buffer, args.unit),
-                    args.unit,
-                    format_date_time(time),
-                    format_date_time(start),
-                    format_date_time(end),
-                )
+    all_results = executed.all_results
+    # The reports select the fetched results by ID, rather than re-filtering
+    results = executed.results
+
+    # If possible, the reports are fetched while the table is rendered
+    prefetched_reports = {}
+    if executor.concurrent:
+        if args.show_scripts or args.save_scripts:
+            prefetched_reports[ScriptReport] = executor.submit(
+                prefetch_report,
+                ScriptReport,
+                results,
+                args.interactive,
+                archive=args.archive,
             )
-            time_bits |= filterByRange(start, end)
-
-        description_parts.append(
-            "that occurred within {}".format(
-                iterable_to_fancy_string(stubs, quote=False, word="or")
+        if args.show_diffs:
+            prefetched_reports[DiffReport] = executor.submit(
+                prefetch_report,
+                DiffReport,
+                results,
+                args.interactive,
+                archive=args.archive,
+                jobs=args.jobs,
+            )
+        # Unlimited logs are streamed, rather than held in memory
+        if (args.show_logs or args.save_logs) and args.limit != 0:
+            prefetched_reports[LogReport] = executor.submit(
+                prefetch_report,
+                LogReport,
+                results,
+                args.interactive,
+                archive=args.archive,
+                chunk_size=args.chunk_size,
             )
-        )
-        results &= time_bits
-
-    if args.last:
-        now = timezone.now()
-        assert now.tzinfo
 
-        # if args.tz:
-        #     now = timezone.make_aware(now, args.tz)
-        delta_start = now - relativedelta(**{args.unit: args.last})
-        assert delta_start.tzinfo
+    with profiler.phase("DataFrame construction"):
+        df = executed.df
+        if args.tz and not df.empty:
+            df.index = df.index.tz_convert(args.tz)
 
-        # if args.tz:
-        #     delta_start = timezone.make_aware(now, args.tz)
-        description_parts.append(
-            "that occurred within the last {} {} (i.e. between {} and {})".format(
-                args.last,
-                args.unit,
-                format_date_time(delta_start),
-                format_date_time(now),
+        try:
+            timezone_str = df.index.tzinfo.zone
+        except AttributeError:
+            timezone_str = None
+
+        if args.strftime:
+            # Note: after this, column is no longer a DT column!
+            df.index = df.index.strftime(args.strftime)
+        queries = connection.queries[first_query_index:]
+        # We only show this if we are logging DEBUG messages, _and_ we are not
+        # already logging all SQL queries (that would be redundant)
+        if CONSOLE_LOGGER.level == logging.DEBUG and not args.show_sql and queries:
+            CONSOLE_LOGGER.debug("Executed query:\n" + formatSql(queries[0]["sql"]))
+
+        # Sum up query time from all relevant queries
+        query_time = sum(float(query["time"]) for query in queries)
+
+        # This must occur after query accounting, since it may need to refresh
+        # the dimension cache
+        df = get_dimension_cache().resolve_history_frame(df)
+
+    # Everything from here on is written via one Renderer, so that it is all
+    # paged together (if it's long)
+    with Renderer(pager=not (args.interactive or args.no_pager)) as output:
+        with profiler.phase("table rendering"):
+            num_results = len(df)
+            if executed.truncated:
+                # The (expensive) count is only made if the limit was hit, and
+                # only waited for now
+                limit_str = " due to `limit` of {}; for all {} results re-run with --limit 0".format(
+                    num_results, executed.count
+                )
+            else:
+                limit_str = ""
+            plural = "s" if num_results > 1 else ""
+            output.print(
+                "Found {} result{} in {:.3f} seconds{}".format(
+                    num_results, plural, query_time, limit_str
+                )
             )
-        )
-        results &= filterByRange(delta_start, now)
-
-    if args.after or args.before:
-        if args.after and args.before:
-            description_parts.append(
-                "executed after {} but before {}".format(
-                    format_date_time(args.after), format_date_time(args.before)
+            FILE_LOGGER.info(
+                "Found {} result{} in {:.3f} seconds".format(
+                    num_results, plural, query_time
                 )
             )
-        elif args.after or args.before:
-            if args.after:
-                description_parts.append(
-                    "executed after {}".format(format_date_time(args.after))
+            if not df.empty:
+                output.print(
+                    "Displaying scripts {}".format(", ".join(description_parts))
                 )
-            elif args.after:
-                description_parts.append(
-                    "executed before {}".format(format_date_time(args.before))
+                output.print(
+                    genHistoryTable(
+                        df,
+                        verbose=args.verbose or log_level == "DEBUG",
+                        timezone=timezone_str,
+                    )
                 )
-        results &= filterByRange(args.after, args.before)
-
-    # Handle script contains
-    if args.script_contains:
-        description_parts.append(
-            "with script containing: {}".format(args.script_contains)
-        )
-        query = Q()
-        for contains in args.script_contains:
-            query |= Q(executed_script__icontains=contains)
-
-        results &= History.objects.filter(query)
-
-    # Handle log contains
-    if args.log_contains:
-        description_parts.append("with log containing: {}".format(args.log_contains))
-        query = Q()
-        for contains in args.log_contains:
-            query |= Q(log__icontains=contains)
-
-        results &= History.objects.filter(query)
-
-    # Handle script regex
-    if args.script_regex:
-        description_parts.append("with script regex: {}".format(args.script_regex))
-        query = Q()
-        for regex in args.script_regex:
-            query |= Q(executed_script__iregex=regex)
-
-        results &= History.objects.filter(query)
-
-    # Handle log regex
-    if args.log_regex:
-        description_parts.append("with log regex: {}".format(args.log_regex))
-        query = Q()
-        for regex in args.log_regex:
-            query |= Q(log__iregex=regex)
-
-        results &= History.objects.filter(query)
-
-    # Handle kwargs
-    if args.kwargs:
-        description_parts.append("with config kwargs: {}".format(args.kwargs))
-        query = Q()
-        for keyword, value in args.kwargs.items():
-            # TODO: How to also handle &= ?
-            query |= Q(executed_script__iregex=generateRegexpStatement(keyword, value))
-
-        results &= History.objects.filter(query)
-
-    # TODO: Consider testing results only once?
-    # The following operations only make sense if results have been found
-    if results.exists() and args.sort_by:
-        description_parts.append(
-            "ordered by {} ({})".format(args.sort_by, args.direction)
-        )
-        field = "{}{}".format(
-            "-" if args.direction == "descending" else "", args.sort_by
-        )
-        results = results.order_by(field)
-
-    all_results = results
-    all_results_count = all_results.count()
-    # This must occur after ordering!
-    # Don't limit if limit is set to 0
-    if results.exists() and args.limit != 0:
-        results = results[: args.limit]
-
-    # if args.group_by:
-    #     results = results.group_by(args.group_by)
-
-    # THIS IS WHERE THE QUERY IS ACTUALLY EXECUTED
-    df = results.to_timeseries(
-        fieldnames=DEFAULT_HISTORY_TABLE_FIELDNAMES, index="datetime"
-    )
-
-    if args.tz and results.exists():
-        df.index = df.index.tz_convert(args.tz)
-
-    try:
-        timezone_str = df.index.tzinfo.zone
-    except AttributeError:
-        timezone_str = None
-
-    if args.strftime:
-        # Note: after this, column is no longer a DT column!
-        df.index = df.index.strftime(args.strftime)
-    # First 2 queries are not relevant to us
-    queries = connections["default"].queries[2:]
-    # We only show this if we are logging DEBUG messages, _and_ we are not
-    # already logging all SQL queries (that would be redundant)
-    if CONSOLE_LOGGER.level == logging.DEBUG and not args.show_sql and queries:
-        CONSOLE_LOGGER.debug("Executed query:\n" + formatSql(queries[-1]["sql"]))
-
-    # Sum up query time from all relevant queries
-    query_time = sum(float(query["time"]) for query in queries)
-
-    num_results = len(df)
-    if args.limit != 0 and args.limit <= num_results:
-        limit_str = " due to `limit` of {}; for all {} results re-run with --limit 0".format(
-            num_results, all_results_count
-        )
-    else:
-        limit_str = ""
-    plural = "s" if num_results > 1 else ""
-    print(
-        "Found {} result{} in {:.3f} seconds{}".format(
-            num_results, plural, query_time, limit_str
-        )
-    )
-    FILE_LOGGER.info(
-        "Found {} result{} in {:.3f} seconds".format(num_results, plural, query_time)
-    )
-    if not df.empty:
-        print("Displaying scripts {}".format(", ".join(description_parts)))
-        print(
-            genHistoryTable(
-                df, verbose=args.verbose or log_level == "DEBUG", timezone=timezone_str
-            )
-        )
-    else:
-        print("No scripts found {}".format(", ".join(description_parts)))
-        if args.exact:
-            CONSOLE_LOGGER.info("Try again without --exact to perform fuzzy searches")
-        if not args.regex:
-            CONSOLE_LOGGER.info(
-                "Try again with --regex to treat given arguments as regular expressions"
-            )
-    print("")
-
-    if args.output and args.output != ".":
-        os.makedirs(args.output, exist_ok=True)
-        CONSOLE_LOGGER.debug("Created directory %s", args.output)
-
-    if args.show_scripts or args.save_scripts:
-        report = ScriptReport(results, args.interactive)
-        if args.show_scripts:
-            report.print_report()
+            else:
+                output.print("No scripts found {}".format(", ".join(description_parts)))
+                # So that it comes before the hints below
+                output.flush()
+                if args.exact:
+                    CONSOLE_LOGGER.info(
+                        "Try again without --exact to perform fuzzy searches"
+                    )
+                if not args.regex:
+                    CONSOLE_LOGGER.info(
+                        "Try again with --regex to treat given arguments as regular expressions"
+                    )
+            output.print()
+
+        if args.output and args.output != ".":
+            os.makedirs(args.output, exist_ok=True)
+            CONSOLE_LOGGER.debug("Created directory %s", args.output)
+
+        if args.show_scripts or args.save_scripts:
+            with profiler.phase("script report"):
+                report = get_report(
+                    prefetched_reports,
+                    ScriptReport,
+                    results,
+                    args.interactive,
+                    archive=args.archive,
+                )
+                if args.show_scripts:
+                    report.print_report(output)
+
+                if args.save_scripts and not args.export_to_git:
+                    report.save_report(args.output)
+
+        if args.show_diffs:
+            with profiler.phase("diff report"):
+                get_report(
+                    prefetched_reports,
+                    DiffReport,
+                    results,
+                    args.interactive,
+                    archive=args.archive,
+                    jobs=args.jobs,
+                ).print_report(output)
+
+        if args.show_logs or args.save_logs:
+            with profiler.phase("log report"):
+                report = get_report(
+                    prefetched_reports,
+                    LogReport,
+                    results,
+                    args.interactive,
+                    archive=args.archive,
+                    chunk_size=args.chunk_size,
+                )
+                if args.show_logs:
+                    report.print_report(output)
 
-        if args.save_scripts and not args.export_to_git:
-            report.save_report(args.output)
+                if args.save_logs and not args.export_to_git:
+                    report.save_report(args.output)
 
-    if args.show_diffs:
-        if set(results.values_list("obsprocedure__name", flat=True)):
-            CONSOLE_LOGGER.warning(
-                "Multiple script names detected; diffs may not make much sense!"
-            )
-        DiffReport(results, args.interactive).print_report()
+    # Before the (forked) workers of gitify_by_project are started
+    executor.shutdown()
 
-    if args.show_logs or args.save_logs:
-        report = LogReport(results, args.interactive)
-        if args.show_logs:
-            report.print_report()
+    if args.export_to_git:
+        with profiler.phase("git export"):
+            if args.shard_by_project:
+                gitify_by_project(
+                    results,
+                    args.output,
+                    include_log=args.save_logs,
+                    archive=args.archive,
+                    chunk_size=args.chunk_size,
+                    jobs=args.jobs,
+                )
+            else:
+                gitify(
+                    results,
+                    args.output,
+                    include_log=args.save_logs,
+                    archive=args.archive,
+                    chunk_size=args.chunk_size,
+                )
 
-        if args.save_logs and not args.export_to_git:
-            report.save_report(args.output)
+    # Rows fetched on cache misses are only saved once, now
+    finish_dimension_caches()
 
-    if args.export_to_git:
-        gitify(results, args.output, include_log=args.save_logs)
+    if profiler.enabled:
+        profiler.report(args.profile)
 
     # If the user has requested an interactive session, enter it now.
     # However, don't bother trying if we are already being run via IPython,
     # because it won't work
     if args.interactive and not in_ipython():
+        # IPython is slow to import, so it is only imported when needed
+        import IPython
         from tortoise.models import ObsProcedure, Observer, Operator, ObsProjectRef
 
         CONSOLE_LOGGER.info("")
@@ -0,0 +1,98 @@
+"""Thin client for the turtlecli daemon (see turtlecli.daemon)
+
+This forwards argv to the daemon over a Unix socket, and writes the output
+that is streamed back to stdout/stderr. It must only use the standard library,
+since the whole point is to avoid the cost of importing Django, pandas, etc.
+
+Messages from the daemon are framed as a one-byte channel followed by a
+4-byte (big-endian) payload length:
+
+    b"1": stdout data
+    b"2": stderr data
+    b"x": exit status (ASCII)
+    b"r": the daemon refused the request; it should be run locally instead
+"""
+
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+
+SOCKET_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "turtlecli",
+    "daemon.sock",
+)
+HEADER = struct.Struct(">cI")
+
+STDOUT = b"1"
+STDERR = b"2"
+EXIT = b"x"
+REFUSE = b"r"
+
+# Subcommands are always run locally
+LOCAL_SUBCOMMANDS = ("sync", "archive", "export", "daemon")
+# Interactive sessions need a real terminal, so are always run locally
+INTERACTIVE_ARGS = ("-i", "--interactive")
+
+
+def should_use_daemon(argv):
+    if argv and argv[0] in LOCAL_SUBCOMMANDS:
+        return False
+    if any(arg in INTERACTIVE_ARGS for arg in argv):
+        return False
+    return os.path.exists(SOCKET_PATH)
+
+
+def read_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection to turtlecli daemon closed unexpectedly")
+        data += chunk
+    return data
+
+
+def send_request(sock, request):
+    sock.sendall(json.dumps(request).encode() + b"\n")
+
+
+def run(argv):
+    """Run turtlecli with the given argv via the daemon, and return its exit status
+
+    None is returned if there is no (working) daemon, in which case the
+    caller should run turtlecli itself"""
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+    except OSError:
+        # Most likely a stale socket, left by a daemon that was killed
+        sock.close()
+        return None
+
+    terminal_size = shutil.get_terminal_size()
+    request = {
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "settings": os.environ.get("DJANGO_SETTINGS_MODULE"),
+        "columns": terminal_size.columns,
+        "lines": terminal_size.lines,
+        "stdout_isatty": sys.stdout.isatty(),
+        "stderr_isatty": sys.stderr.isatty(),
+    }
+    streams = {STDOUT: sys.stdout.buffer, STDERR: sys.stderr.buffer}
+    with sock:
+        send_request(sock, request)
+        while True:
+            channel, size = HEADER.unpack(read_exactly(sock, HEADER.size))
+            payload = read_exactly(sock, size)
+            if channel == EXIT:
+                return int(payload)
+            if channel == REFUSE:
+                return None
+            streams[channel].write(payload)
+            streams[channel].flush()
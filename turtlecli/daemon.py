@@ -0,0 +1,294 @@
+"""Persistent turtlecli server, for fast repeated queries
+
+`turtlecli daemon` keeps Django set up, the DB connection open, and the
+dimension cache warm, and serves turtlecli invocations forwarded to it over a
+per-user Unix socket by turtlecli.client. While it is running, every (non-
+interactive) invocation of turtlecli is transparently run by it, which avoids
+paying the startup cost each time.
+
+Requests are handled one at a time, in-process: stdout and stderr (including
+log output) are redirected to the client for the duration of each.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import traceback
+
+from django.db import connections, router
+
+from turtlecli import archive, cache, cli, profiling, temptables, textindex
+from turtlecli.client import (
+    EXIT,
+    HEADER,
+    REFUSE,
+    SOCKET_PATH,
+    STDERR,
+    STDOUT,
+    send_request,
+)
+
+CONSOLE_LOGGER = logging.getLogger("{}_user".format(__name__))
+
+# Seconds without any requests after which the daemon exits
+DEFAULT_IDLE_TIMEOUT = 60 * 60
+
+
+class ClientStream:
+    """A text stream that sends everything written to it to a client"""
+
+    encoding = "utf-8"
+
+    def __init__(self, sock, channel, isatty):
+        self.sock = sock
+        self.channel = channel
+        self._isatty = isatty
+
+    def write(self, text):
+        data = text.encode(self.encoding, errors="replace")
+        self.sock.sendall(HEADER.pack(self.channel, len(data)) + data)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return self._isatty
+
+
+class RedirectedStream:
+    """A text stream that writes to whichever stream is current
+
+    This replaces sys.stdout/sys.stderr (and the streams of any logging
+    handlers that write to them) for the life of the daemon"""
+
+    def __init__(self, stream):
+        self.default = stream
+        self.current = stream
+
+    def __getattr__(self, attr):
+        return getattr(self.current, attr)
+
+    def write(self, text):
+        return self.current.write(text)
+
+
+def redirect_std_streams():
+    stdout = RedirectedStream(sys.stdout)
+    stderr = RedirectedStream(sys.stderr)
+    handlers = [logging.getLogger().handlers] + [
+        logger.handlers
+        for logger in logging.Logger.manager.loggerDict.values()
+        if isinstance(logger, logging.Logger)
+    ]
+    for handler in (handler for handlers_ in handlers for handler in handlers_):
+        if isinstance(handler, logging.StreamHandler):
+            if handler.stream is sys.stdout:
+                handler.setStream(stdout)
+            elif handler.stream is sys.stderr:
+                handler.setStream(stderr)
+    sys.stdout = stdout
+    sys.stderr = stderr
+    return stdout, stderr
+
+
+def discard_unusable_connections():
+    """Close any DB connections that have been dropped (e.g. by the server timing
+    them out while idle), so that they are re-opened when next used"""
+
+    for connection in connections.all():
+        if connection.connection is not None and not connection.is_usable():
+            CONSOLE_LOGGER.debug("Re-opening DB connection %s", connection.alias)
+            connection.close()
+
+
+def read_request(sock):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(65536)
+        if not chunk:
+            # e.g. is_running() checking whether we are up
+            return None
+        data += chunk
+    return json.loads(data.decode())
+
+
+class Daemon:
+    def __init__(self, path=SOCKET_PATH, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.settings = os.environ.get("DJANGO_SETTINGS_MODULE")
+        self.routers = list(router.routers)
+        self.environ = dict(os.environ)
+        self.cwd = os.getcwd()
+        self.log_levels = {
+            name: logger.level
+            for name, logger in logging.Logger.manager.loggerDict.items()
+            if isinstance(logger, logging.Logger)
+        }
+
+    def handle(self, sock):
+        request = read_request(sock)
+        if request is None:
+            return
+        if request.get("stop"):
+            raise KeyboardInterrupt
+        if request.get("settings") != self.settings:
+            CONSOLE_LOGGER.debug(
+                "Refusing request for settings %s", request.get("settings")
+            )
+            sock.sendall(HEADER.pack(REFUSE, 0))
+            return
+
+        CONSOLE_LOGGER.debug("Handling request: %s", request["argv"])
+        discard_unusable_connections()
+        self.stdout.current = ClientStream(sock, STDOUT, request["stdout_isatty"])
+        self.stderr.current = ClientStream(sock, STDERR, request["stderr_isatty"])
+        os.environ["COLUMNS"] = str(request["columns"])
+        os.environ["LINES"] = str(request["lines"])
+        status = 0
+        try:
+            os.chdir(request["cwd"])
+            cli.main(request["argv"])
+        except SystemExit as error:
+            status = error.code if isinstance(error.code, int) else 1
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away (e.g. it was interrupted)
+            return
+        except Exception as error:
+            status = 1
+            if any(arg in ("-v", "--verbose") for arg in request["argv"]):
+                traceback.print_exc()
+            else:
+                print(error, file=sys.stderr)
+        finally:
+            self.reset()
+        sock.sendall(HEADER.pack(EXIT, len(str(status))) + str(status).encode())
+
+    def reset(self):
+        """Undo any process-wide changes made while handling a request"""
+
+        self.stdout.current = self.stdout.default
+        self.stderr.current = self.stderr.default
+        os.environ.clear()
+        os.environ.update(self.environ)
+        os.chdir(self.cwd)
+        # e.g. --local installs a router
+        router.routers[:] = self.routers
+        for name, level in self.log_levels.items():
+            logging.getLogger(name).setLevel(level)
+        for connection in connections.all():
+            # e.g. --profile installs an execute wrapper
+            connection.execute_wrappers.clear()
+            # This is bounded, but query accounting relies on its length changing
+            connection.queries_log.clear()
+        temptables.clear_temp_tables()
+        # e.g. if the request failed before the caches were finished
+        cache.finish_dimension_caches()
+        # Otherwise, later requests would miss any rows added since this one
+        textindex.clear_text_indexes()
+        archive.clear_archives()
+        profiling.clear_marks()
+
+    def serve(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):
+            if is_running(self.path):
+                raise ValueError("A turtlecli daemon is already running")
+            os.remove(self.path)
+
+        self.stdout, self.stderr = redirect_std_streams()
+        profiling.clear_marks()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The socket is only accessible by the current user
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        server.listen()
+        server.settimeout(self.idle_timeout)
+        CONSOLE_LOGGER.info("Listening on %s", self.path)
+        try:
+            while True:
+                try:
+                    sock, __ = server.accept()
+                except socket.timeout:
+                    CONSOLE_LOGGER.info(
+                        "No requests for %s seconds; exiting", self.idle_timeout
+                    )
+                    break
+                sock.settimeout(None)
+                with sock:
+                    try:
+                        self.handle(sock)
+                    except (OSError, ValueError) as error:
+                        CONSOLE_LOGGER.warning("Error handling request: %s", error)
+        except KeyboardInterrupt:
+            CONSOLE_LOGGER.info("Stopping")
+        finally:
+            server.close()
+            os.remove(self.path)
+
+
+def is_running(path=SOCKET_PATH):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def stop(path=SOCKET_PATH):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        sock.connect(path)
+        send_request(sock, {"stop": True})
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="turtlecli daemon",
+        description="Serve turtlecli queries from a persistent process, so that "
+        "each query doesn't pay the cost of starting up (importing Django, "
+        "connecting to the DB, etc.). While this is running, turtlecli "
+        "invocations (other than --interactive ones) are run by it. "
+        "Run it in the background, e.g. 'turtlecli daemon &'",
+    )
+    parser.add_argument(
+        "--stop", action="store_true", help="Stop the running daemon, and exit"
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=DEFAULT_IDLE_TIMEOUT,
+        help="Exit after this many seconds without any requests",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+        help="Specify the logging level",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger("turtlecli").setLevel(args.log_level)
+    if args.stop:
+        if not is_running():
+            sys.exit("No turtlecli daemon is running")
+        stop()
+        return
+
+    try:
+        Daemon(idle_timeout=args.idle_timeout).serve()
+    except ValueError as error:
+        sys.exit(str(error))
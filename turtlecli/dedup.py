@@ -0,0 +1,113 @@
+"""Content-addressed deduplication of executed scripts
+
+The same script is typically executed many times (once per session, plus
+any re-runs). Rather than fetching every copy, the server computes an MD5 of
+each executed_script; each distinct script is then fetched only once, and
+repeats are simply references to the first execution with that content.
+"""
+
+import hashlib
+import logging
+
+from django.db.backends.signals import connection_created
+from django.db.models import CharField, Func
+
+from tortoise.models import History
+from turtlecli.filters import filterByIds
+
+logger = logging.getLogger(__name__)
+
+
+class MD5(Func):
+    """The MD5 hex digest of the given expression, as computed by the DB"""
+
+    function = "MD5"
+    output_field = CharField()
+
+
+def _md5(text):
+    if text is None:
+        return None
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+
+def register_sqlite_functions(sender, connection, **kwargs):
+    """Provide MD5() on SQLite connections, which don't have it built in"""
+
+    if connection.vendor == "sqlite":
+        connection.connection.create_function("MD5", 1, _md5)
+
+
+connection_created.connect(register_sqlite_functions, dispatch_uid="turtlecli_md5")
+
+
+def with_script_hash(results):
+    """Annotate the given History QuerySet with script_hash, and defer the script itself"""
+
+    return results.annotate(script_hash=MD5("executed_script")).defer("executed_script")
+
+
+class ScriptContents:
+    """The distinct script contents of a set of History results
+
+    Only one copy of each distinct script is fetched (in a single query). If
+    an Archive is given, scripts are read from it where possible"""
+
+    def __init__(self, rows, using=None, archive=None):
+        """rows is an iterable of dicts with (at least) id, datetime, and script_hash"""
+
+        # Maps hash to the (id, datetime) of the first result with that content
+        self.first_executions = {}
+        num_results = 0
+        for row in rows:
+            self.first_executions.setdefault(
+                row["script_hash"], (row["id"], row["datetime"])
+            )
+            num_results += 1
+
+        first_ids = [id_ for id_, __ in self.first_executions.values()]
+        scripts = archive.get_many("executed_script", first_ids) if archive else {}
+        missing_ids = [id_ for id_ in first_ids if id_ not in scripts]
+        if missing_ids:
+            scripts.update(
+                History.objects.using(using)
+                .filter(filterByIds(missing_ids, using=using))
+                .values_list("id", "executed_script")
+            )
+        # Maps hash to script content
+        self.contents = {
+            script_hash: scripts.get(id_)
+            for script_hash, (id_, __) in self.first_executions.items()
+        }
+        logger.debug(
+            "Fetched %s distinct scripts for %s results",
+            len(self.contents),
+            num_results,
+        )
+
+    @classmethod
+    def for_results(cls, results, using=None, archive=None):
+        """Return the ScriptContents of the given History QuerySet"""
+
+        return cls(
+            with_script_hash(results).values("id", "datetime", "script_hash"),
+            using=using,
+            archive=archive,
+        )
+
+    def __len__(self):
+        return len(self.contents)
+
+    def get(self, script_hash):
+        return self.contents.get(script_hash)
+
+    def first_execution(self, script_hash):
+        """Return the (id, datetime) of the first result with the given content"""
+
+        return self.first_executions.get(script_hash)
+
+    def is_repeat(self, row):
+        """Return True if the given row isn't the first with its content"""
+
+        first_execution = self.first_execution(row["script_hash"])
+        return bool(first_execution) and first_execution[0] != row["id"]
@@ -0,0 +1,122 @@
+"""Single-pass execution of the main History query
+
+The filter compiled from the user's arguments can be very expensive (e.g. text
+searches over every script), so it is executed once: the limited page of
+results is fetched (IDs and table columns only), and everything else -- the
+table, the total count, and the reports -- is derived from that.
+
+Independent queries (the count, and the reports) can be run concurrently, each
+on its own DB connection, via a QueryExecutor. Latency is then set by the
+slowest of them, rather than their sum.
+"""
+
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pandas as pd
+from django.db import connections
+
+from tortoise.models import History
+from turtlecli.filters import filterByIds
+
+logger = logging.getLogger(__name__)
+
+# Past this many results, reports re-run the original filter rather than
+# selecting the results by ID (which would make for an enormous IN clause)
+MAX_ID_LIST_SIZE = 10000
+
+
+def _close_connections_after(function, *args, **kwargs):
+    try:
+        return function(*args, **kwargs)
+    finally:
+        # Django connections are per-thread, so each worker has its own; they
+        # must be closed before the worker goes away
+        connections.close_all()
+
+
+class QueryExecutor:
+    """Runs functions that make queries in a pool of `jobs` threads
+
+    If jobs is 1, functions are run immediately, in the calling thread"""
+
+    def __init__(self, jobs=1):
+        self.concurrent = jobs > 1
+        self.pool = ThreadPoolExecutor(max_workers=jobs) if self.concurrent else None
+
+    def submit(self, function, *args, **kwargs):
+        """Return a Future of the result of the given function"""
+
+        if self.concurrent:
+            return self.pool.submit(_close_connections_after, function, *args, **kwargs)
+
+        future = Future()
+        try:
+            future.set_result(function(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    def shutdown(self):
+        if self.concurrent:
+            self.pool.shutdown()
+
+
+class ExecutedQuery:
+    """The results of executing the given (ordered) History QuerySet once
+
+    `limit` of 0 means no limit. One more row than the limit is fetched, so
+    that the (separate, expensive) count query only needs to be made if the
+    limit was actually hit. If the given executor is concurrent, the count is
+    then made in the background, while the results are displayed"""
+
+    def __init__(self, queryset, limit, fieldnames, executor=None):
+        self.all_results = queryset
+        self.limit = limit
+        page = queryset if limit == 0 else queryset[: limit + 1]
+        rows = list(page.values_list("id", *fieldnames))
+        self.truncated = limit != 0 and len(rows) > limit
+        if self.truncated:
+            rows = rows[:limit]
+        self.ids = [row[0] for row in rows]
+        self.count_future = None
+        if self.truncated and executor and executor.concurrent:
+            self.count_future = executor.submit(queryset.count)
+
+        df = pd.DataFrame.from_records(rows, columns=["id", *fieldnames])
+        df.set_index(fieldnames[0], inplace=True)
+        df.index = pd.to_datetime(df.index, errors="ignore")
+        self.df = df
+        self._count = None if self.truncated else len(rows)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def count(self):
+        """The number of results, ignoring the limit"""
+
+        if self._count is None:
+            if self.count_future:
+                self._count = self.count_future.result()
+            else:
+                self._count = self.all_results.count()
+        return self._count
+
+    @property
+    def results(self):
+        """A QuerySet of (only) the fetched results, in the same order"""
+
+        if not self.ids:
+            return self.all_results.none()
+        if len(self.ids) > MAX_ID_LIST_SIZE:
+            logger.debug(
+                "%s results; reports will re-run the original query", len(self.ids)
+            )
+            return self.all_results[: self.limit] if self.limit else self.all_results
+        using = self.all_results.db
+        return (
+            History.objects.using(using)
+            .filter(filterByIds(self.ids, using=using))
+            .order_by(*self.all_results.query.order_by)
+        )
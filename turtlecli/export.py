@@ -0,0 +1,276 @@
+"""Partitioned Parquet export of History metadata, for analytics
+
+`turtlecli export` writes one row per History execution (but none of the
+script/log text, only its length and hash) to a Parquet dataset that is
+partitioned by month, i.e.:
+
+    {output}/month=2019-06/part-0.parquet
+
+Name columns are dictionary-encoded. The export is incremental: only rows
+above the highest exported ID are fetched, plus any rows that were in
+progress as of the last export and have since changed. Only the partitions
+(months) containing those rows are rewritten.
+
+The result can be loaded without touching the DB, e.g.:
+
+    pandas.read_parquet(path, filters=[("month", ">=", "2019-01")])
+
+pyarrow is required.
+"""
+
+import argparse
+import json
+import logging
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from django.db.models.functions import Length
+
+from tortoise.models import History, ObsProcedure, Observer, Operator
+from turtlecli.cache import finish_dimension_caches, get_cache_path, get_dimension_cache
+from turtlecli.dedup import MD5
+from turtlecli.textindex import IN_PROGRESS_STATE
+
+CONSOLE_LOGGER = logging.getLogger("{}_user".format(__name__))
+
+EXPORT_FORMAT_VERSION = 1
+# Number of History rows fetched from the DB at a time
+EXPORT_CHUNK_SIZE = 5000
+STATE_FILE_NAME = "_turtlecli_export.json"
+PARTITION_FILE_NAME = "part-0.parquet"
+# Columns that are dictionary-encoded
+DICTIONARY_COLUMNS = (
+    "project",
+    "procedure",
+    "observer",
+    "operator",
+    "state",
+    "version",
+)
+
+
+class ExportError(Exception):
+    pass
+
+
+def get_schema():
+    string_dictionary = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema(
+        [
+            ("id", pa.int64()),
+            ("datetime", pa.timestamp("us", tz="UTC")),
+            ("project", string_dictionary),
+            ("procedure", string_dictionary),
+            ("observer", string_dictionary),
+            ("operator", string_dictionary),
+            ("state", string_dictionary),
+            ("version", string_dictionary),
+            ("script_length", pa.int64()),
+            ("log_length", pa.int64()),
+            ("script_hash", pa.string()),
+            ("log_hash", pa.string()),
+        ]
+    )
+
+
+def fetch_metadata(queryset):
+    """Return a DataFrame of the export columns for the given History QuerySet
+
+    Lengths and hashes are computed by the DB, so no text is transferred"""
+
+    rows = list(
+        queryset.annotate(
+            script_length=Length("executed_script"),
+            log_length=Length("log"),
+            script_hash=MD5("executed_script"),
+            log_hash=MD5("log"),
+        ).values_list(
+            "id",
+            "datetime",
+            "obsprocedure_id",
+            "observer_id",
+            "operator_id",
+            "executed_state",
+            "version",
+            "script_length",
+            "log_length",
+            "script_hash",
+            "log_hash",
+        )
+    )
+    dimensions = get_dimension_cache()
+    procedures = dimensions.rows(ObsProcedure)
+    if any(row[2] not in procedures for row in rows):
+        # There are new procedures; this also picks up any new projects
+        dimensions.refresh_all()
+    procedure_names = dimensions.names(ObsProcedure)
+    observer_names = dimensions.names(Observer)
+    operator_names = dimensions.names(Operator)
+
+    df = pd.DataFrame(
+        rows,
+        columns=[
+            "id",
+            "datetime",
+            "obsprocedure_id",
+            "observer_id",
+            "operator_id",
+            "state",
+            "version",
+            "script_length",
+            "log_length",
+            "script_hash",
+            "log_hash",
+        ],
+    )
+    df["project"] = df["obsprocedure_id"].map(dimensions.project_name)
+    df["procedure"] = df["obsprocedure_id"].map(procedure_names)
+    df["observer"] = df["observer_id"].map(observer_names)
+    df["operator"] = df["operator_id"].map(operator_names)
+    df["datetime"] = pd.to_datetime(df["datetime"], utc=True)
+    return df[get_schema().names]
+
+
+class Export:
+    def __init__(self, path=None, using=None):
+        if pa is None:
+            raise ExportError("pyarrow must be installed in order to export")
+        self.using = using
+        self.path = path if path else get_cache_path("history", using, "parquet")
+        self.state_path = os.path.join(self.path, STATE_FILE_NAME)
+        self.state = {"version": EXPORT_FORMAT_VERSION, "last_id": 0, "in_progress": {}}
+        try:
+            with open(self.state_path) as file:
+                state = json.load(file)
+            if state.get("version") == EXPORT_FORMAT_VERSION:
+                self.state = state
+        except (OSError, ValueError) as error:
+            CONSOLE_LOGGER.debug("Could not read %s: %s", self.state_path, error)
+
+    def partition_path(self, month):
+        return os.path.join(self.path, "month={}".format(month), PARTITION_FILE_NAME)
+
+    def write_partition(self, month, df):
+        """Merge the given rows into the given month's partition"""
+
+        path = self.partition_path(month)
+        if os.path.exists(path):
+            existing = pq.read_table(path).to_pandas()
+            df = pd.concat([existing[~existing["id"].isin(df["id"])], df])
+        df = df.sort_values("id")
+        for column in DICTIONARY_COLUMNS:
+            df[column] = df[column].astype("category")
+
+        table = pa.Table.from_pandas(
+            df[get_schema().names], schema=get_schema(), preserve_index=False
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = "{}.tmp".format(path)
+        pq.write_table(table, temp_path)
+        os.replace(temp_path, path)
+        CONSOLE_LOGGER.debug("Wrote %s rows to %s", len(df), path)
+
+    def write(self, df):
+        months = df["datetime"].dt.strftime("%Y-%m")
+        for month, month_df in df.groupby(months):
+            self.write_partition(month, month_df)
+        for id_, state, log_hash in zip(df["id"], df["state"], df["log_hash"]):
+            if state == IN_PROGRESS_STATE:
+                self.state["in_progress"][str(id_)] = log_hash
+            else:
+                self.state["in_progress"].pop(str(id_), None)
+        self.state["last_id"] = max(self.state["last_id"], int(df["id"].max()))
+
+        # Written last, so that an interrupted export is simply redone
+        temp_path = "{}.tmp".format(self.state_path)
+        with open(temp_path, "w") as file:
+            json.dump(self.state, file)
+        os.replace(temp_path, self.state_path)
+
+    def update(self, full=False):
+        """Export all History rows that are new (or were in progress, and have changed)"""
+
+        os.makedirs(self.path, exist_ok=True)
+        if full:
+            self.state = {
+                "version": EXPORT_FORMAT_VERSION,
+                "last_id": 0,
+                "in_progress": {},
+            }
+            for entry in os.scandir(self.path):
+                partition_path = os.path.join(entry.path, PARTITION_FILE_NAME)
+                if entry.name.startswith("month=") and os.path.exists(partition_path):
+                    os.remove(partition_path)
+        queryset = History.objects.using(self.using)
+
+        in_progress = self.state["in_progress"]
+        if in_progress:
+            df = fetch_metadata(
+                queryset.filter(id__in=[int(id_) for id_ in in_progress])
+            )
+            changed = [
+                in_progress.get(str(id_)) != log_hash or state != IN_PROGRESS_STATE
+                for id_, state, log_hash in zip(df["id"], df["state"], df["log_hash"])
+            ]
+            if any(changed):
+                CONSOLE_LOGGER.debug(
+                    "Re-exporting %s changed in-progress rows", sum(changed)
+                )
+                self.write(df[changed])
+
+        num_exported = 0
+        while True:
+            df = fetch_metadata(
+                queryset.filter(id__gt=self.state["last_id"]).order_by("id")[
+                    :EXPORT_CHUNK_SIZE
+                ]
+            )
+            if df.empty:
+                break
+            self.write(df)
+            num_exported += len(df)
+            CONSOLE_LOGGER.debug(
+                "Exported History rows up to ID %s", self.state["last_id"]
+            )
+        CONSOLE_LOGGER.info(
+            "Exported %s new History rows to %s", num_exported, self.path
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="turtlecli export",
+        description="Export History metadata (names, state, version, and "
+        "script/log lengths and hashes) as a Parquet dataset, partitioned by month",
+    )
+    parser.add_argument(
+        "--output",
+        help="Path to the dataset directory (default: under ~/.cache/turtlecli)",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Re-export everything, rather than only rows that are new (or were "
+        "in progress) since the last export",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+        help="Specify the logging level",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger("turtlecli").setLevel(args.log_level)
+    Export(path=args.output).update(full=args.full)
+    finish_dimension_caches()
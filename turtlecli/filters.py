@@ -1,50 +1,141 @@
-"""QuerySet Filters for History model"""
+"""Q filters for the History model"""
 
 from datetime import timedelta
-import os
-from glob import glob
 import re
 import logging
 
-from astropy.io import fits
-import dateutil.parser as dp
+from django.db.models import Q
 
-from tortoise.models import History
+from django.db import connections
 
-CONSOLE_LOGGER = logging.getLogger("{}_user".format(__name__))
+from tortoise.models import ObsProcedure, ObsProjectRef, Observer, Operator
+from turtlecli.cache import get_db_alias, get_dimension_cache
+from turtlecli.intervals import IntervalSet, filterByIntervals
+from turtlecli.projects import PROJECT_NAME_REGEX
+from turtlecli.sessions import SCIENCE_DATA_ROOT, TEST_DATA_ROOT, get_session_index
+from turtlecli.temptables import RawSubquery, create_temp_table, max_in_list_size
 
+CONSOLE_LOGGER = logging.getLogger("{}_user".format(__name__))
 
-PROJECT_NAME_REGEX = re.compile(
-    r"(?P<prefix>(?P<type>[AT])?\w*)(?P<year>\d{2,4})(?P<semester>[ABC])[_\s\-]?(?P<code>\d{,10})[_\s\-]?(?P<session>\d+)?",
-    re.IGNORECASE,
-)
+# Scripts executed within this amount of time of a scan are considered to be
+# part of that scan's session
+SESSION_SCAN_BUFFER = timedelta(minutes=15)
 
 
 def filterByRange(start, end):
-    """Return all History objects executed between start and end, inclusive"""
+    """Return a Q matching History executed between start and end, inclusive"""
 
-    results = History.objects.all()
     if start:
         assert start.tzinfo
-        results &= History.objects.filter(datetime__gte=start)
     if end:
-        results &= History.objects.filter(datetime__lte=end)
         assert end.tzinfo
-    return results
+
+    if start and end:
+        return Q(datetime__range=(start, end))
+    if start:
+        return Q(datetime__gte=start)
+    if end:
+        return Q(datetime__lte=end)
+    return Q()
+
+
+def filterByIds(ids, using=None):
+    """Return a Q matching History with any of the given IDs
+
+    Large sets of IDs are sent via a temporary table, rather than inline"""
+
+    ids = sorted(ids)
+    using = get_db_alias(using)
+    if len(ids) <= max_in_list_size(using):
+        return Q(id__in=ids)
+
+    CONSOLE_LOGGER.debug("%s IDs; using a temporary table", len(ids))
+    connection = connections[using]
+    table_name = create_temp_table(
+        "ids", ["id INTEGER NOT NULL PRIMARY KEY"], [(id_,) for id_ in ids], using
+    )
+    return Q(
+        id__in=RawSubquery(
+            "SELECT id FROM {}".format(connection.ops.quote_name(table_name)), []
+        )
+    )
+
+
+def join_regexes(regexes):
+    """Combine the given regular expressions into a single alternation
+
+    This allows a single REGEXP predicate to be sent to the DB, rather than
+    an OR chain of them
+    """
+    if len(regexes) == 1:
+        return regexes[0]
+    return "|".join("({})".format(regex) for regex in regexes)
+
+
+def resolveNames(model, values=(), fuzzy=False, regexes=(), refresh=True):
+    """Resolve the given names to the primary keys of `model`
+
+    `model` is expected to be one of the (small) dimension tables, e.g.
+    Observer. All matching is done locally, against the dimension cache, so
+    that the History query only needs to filter on its integer foreign keys.
+    If nothing matches (and refresh is given), the cache is refreshed and
+    matching is retried once. All matching is case-insensitive: values are matched
+    exactly or, if fuzzy is given, as substrings; regexes are searched for
+    using Python-style regular expressions"""
+
+    try:
+        compiled_regexes = [re.compile(regex, re.IGNORECASE) for regex in regexes]
+    except re.error as error:
+        raise ValueError(
+            "Invalid regular expression {!r}: {}".format(error.pattern, error)
+        )
+    folded_values = {value.casefold() for value in values}
+
+    def match(names):
+        ids = set()
+        for id_, name in names.items():
+            folded_name = name.casefold()
+            if fuzzy:
+                matched = any(value in folded_name for value in folded_values)
+            else:
+                matched = folded_name in folded_values
+            if matched or any(regex.search(name) for regex in compiled_regexes):
+                ids.add(id_)
+        return ids
+
+    dimensions = get_dimension_cache()
+    ids = match(dimensions.names(model))
+    if not ids and refresh:
+        # Perhaps the cache is simply out of date
+        dimensions.refresh(model, full=True)
+        dimensions.save()
+        ids = match(dimensions.names(model))
+
+    CONSOLE_LOGGER.debug(
+        "Resolved {values} (regexes: {regexes}) to {num_ids} {model} IDs".format(
+            values=list(values),
+            regexes=list(regexes),
+            num_ids=len(ids),
+            model=model.__name__,
+        )
+    )
+    return sorted(ids)
 
 
 def filterByProject(project_names, fuzzy=False, regex=False):
-    """Look for the given project names in History
+    """Return a Q matching the given project names in History
 
     There is some added value to the standard filterByValues here: if fuzzy
     is given, then a regex is used to attempt to parse common project names
-    given in the "standard" format, then reconstruct them into _another_
-    regex. This new regex is actually used in the query. The idea here is to
+    given in the "standard" format into a canonical key, which is then looked
+    up in the (cached) index of all project keys. The idea here is to
     handle silly stuff like GBT19A453 not working in the standard/exact search,
     despite obviously be AGBT19A_453
     """
-    results = History.objects.none()
-    session_filter = None
+    names = []
+    regexes = []
+    fuzzy_names = []
+    session_intervals = None
     for project_name in project_names:
         # If --regex given, do a regex search
         if regex:
@@ -52,9 +143,7 @@ def filterByProject(project_names, fuzzy=False, regex=False):
                 "Treating {project_name} as a regular expression due to presence "
                 "of regex=True".format(project_name=project_name)
             )
-            results |= History.objects.filter(
-                obsprocedure__obsprojectref__name__iregex=project_name
-            )
+            regexes.append(project_name)
         # Otherwise do an exact, case-insensitive string search
         else:
             CONSOLE_LOGGER.debug(
@@ -62,13 +151,11 @@ def filterByProject(project_names, fuzzy=False, regex=False):
                     project_name=project_name
                 )
             )
-            results |= History.objects.filter(
-                obsprocedure__obsprojectref__name__iexact=project_name
-            )
+            names.append(project_name)
 
         if fuzzy and not regex:
             CONSOLE_LOGGER.debug(
-                "Performing a regex search of project names due to fuzzy=True"
+                "Performing a canonical key search of project names due to fuzzy=True"
             )
             match = PROJECT_NAME_REGEX.search(project_name)
             if match:
@@ -76,67 +163,57 @@ def filterByProject(project_names, fuzzy=False, regex=False):
                 session = match.groupdict().get("session", None)
                 if session:
                     if not obs_type or obs_type == "A":
-                        # science_data_path =
-                        scanlog_paths = glob(
-                            "/home/archive/science-data/**/AGBT{year}{semester}_{code}_{session}/ScanLog.fits".format(
-                                **match.groupdict()
-                            )
+                        session_index = get_session_index(SCIENCE_DATA_ROOT)
+                        session_name = "AGBT{year}{semester}_{code}_{session}".format(
+                            **match.groupdict()
                         )
                     else:
-                        scanlog_paths = glob(
-                            "/home/archive/test-data/**/TGBT{year}{semester}_{code}_{session}/ScanLog.fits".format(
-                                **match.groupdict()
-                            )
-                        )
-                    try:
-                        if len(scanlog_paths) != 1:
-                            raise ValueError("aw man")
-                        scanlog_path = scanlog_paths[0]
-                        scanlog = fits.open(scanlog_path)
-                        execution_times = sorted(
-                            set(dp.parse(i[0]) for i in scanlog[1].data)
+                        session_index = get_session_index(TEST_DATA_ROOT)
+                        session_name = "TGBT{year}{semester}_{code}_{session}".format(
+                            **match.groupdict()
                         )
-                    except (FileNotFoundError, ValueError, KeyError):
+                    execution_times = session_index.scan_times(session_name)
+                    scanlog_path = session_index.get_scanlog_path(session_name)
+                    if not execution_times:
                         CONSOLE_LOGGER.info(
                             "Given project name '{project_name}' looks "
                             "like it includes a session identifier. For whatever reason, "
                             "Turtle does not store any session information, so we are "
-                            "looking to {scanlog_path} for more. However, it doesn't exist or couldn't be read, so "
+                            "looking to the ScanLog of {session_name} for more. However, it doesn't exist or couldn't be read, so "
                             "we're simply ignoring the session identifier altogether".format(
-                                project_name=project_name, scanlog_path=scanlog_path
+                                project_name=project_name, session_name=session_name
                             )
                         )
                     else:
-                        session_filter = History.objects.none()
-                        if len(execution_times) < 100:
-                            for execution_time in execution_times:
-                                # Put a little cushion in here to handle slight inconsistencies between turtle and M&C
-                                session_filter |= filterByRange(
-                                    execution_time - timedelta(minutes=15),
-                                    execution_time + timedelta(minutes=15),
-                                )
-                        else:
-                            CONSOLE_LOGGER.info(
-                                "Too many scans to perform discrete search; instead search for scripts "
-                                "executed between first and last scan ({start} to {end})".format(
-                                    execution_times[0], execution_times[-1]
-                                )
-                            )
-                            session_filter |= filterByRange(
-                                execution_times[0] - timedelta(minutes=15),
-                                execution_time[-1] + timedelta(minutes=15),
+                        if session_intervals is None:
+                            session_intervals = IntervalSet()
+                        # Put a little cushion in here to handle slight inconsistencies
+                        # between turtle and M&C. Overlapping windows are merged
+                        session_windows = IntervalSet(
+                            (
+                                execution_time - SESSION_SCAN_BUFFER,
+                                execution_time + SESSION_SCAN_BUFFER,
                             )
+                            for execution_time in execution_times
+                        )
+                        session_intervals = IntervalSet(
+                            list(session_intervals) + list(session_windows)
+                        )
                         CONSOLE_LOGGER.info(
                             "Given project name '{project_name}' looks "
                             "like it includes a session identifier. For whatever reason, "
                             "Turtle does not store any session information, so we are "
                             "looking to {scanlog_path} for more. The first scan was executed at "
                             "{start}, and the last was executed at {end}, so we're "
-                            "using those as the time boundaries for session {session}".format(
+                            "searching within {buffer} of each of the {num_scans} scans "
+                            "({num_windows} distinct time windows) of session {session}".format(
                                 project_name=project_name,
                                 start=execution_times[0],
                                 end=execution_times[-1],
                                 scanlog_path=scanlog_path,
+                                buffer=SESSION_SCAN_BUFFER,
+                                num_scans=len(execution_times),
+                                num_windows=len(session_windows),
                                 session=session,
                             )
                         )
@@ -146,20 +223,7 @@ def filterByProject(project_names, fuzzy=False, regex=False):
                         project_name=project_name, PROJECT_NAME_REGEX=PROJECT_NAME_REGEX
                     )
                 )
-                the_regex = "{prefix}{year}.*{semester}.*{code}".format(
-                    **match.groupdict()
-                )
-                CONSOLE_LOGGER.debug(
-                    "'{project_name}' matches regex '{PROJECT_NAME_REGEX}', "
-                    "so it is being transformed into a fuzzy query: '{the_regex}'".format(
-                        project_name=project_name,
-                        PROJECT_NAME_REGEX=PROJECT_NAME_REGEX,
-                        the_regex=the_regex,
-                    )
-                )
-                results |= History.objects.filter(
-                    obsprocedure__obsprojectref__name__iregex=the_regex
-                )
+                fuzzy_names.append(project_name)
             else:
                 CONSOLE_LOGGER.debug(
                     "No match found of '{project_name}' with regex '{PROJECT_NAME_REGEX}'".format(
@@ -167,69 +231,87 @@ def filterByProject(project_names, fuzzy=False, regex=False):
                     )
                 )
 
-    if session_filter is not None:
-        results &= session_filter
-    return results
+    def resolve():
+        ids = set(resolveNames(ObsProjectRef, names, regexes=regexes, refresh=False))
+        project_index = get_dimension_cache().project_index()
+        for project_name in fuzzy_names:
+            ids.update(project_index.lookup(project_name))
+        return ids
+
+    # Only refresh the cache if the fuzzy search didn't find anything, either
+    project_ids = resolve()
+    if not project_ids:
+        get_dimension_cache().refresh(ObsProjectRef, full=True)
+        project_ids = resolve()
+    if not project_ids and not regex:
+        suggestions = set()
+        project_index = get_dimension_cache().project_index()
+        for project_name in project_names:
+            suggestions.update(project_index.suggest(project_name))
+        if suggestions:
+            CONSOLE_LOGGER.info(
+                "No projects found named {project_names}; did you mean one of: {suggestions}?".format(
+                    project_names=project_names,
+                    suggestions=", ".join(sorted(suggestions)),
+                )
+            )
+
+    query = Q(obsprocedure__obsprojectref_id__in=sorted(project_ids))
+    if session_intervals is not None:
+        query &= filterByIntervals(session_intervals)
+    return query
 
 
 def filterByScript(script_names, regex=False):
-    results = History.objects.none()
+    """Return a Q matching the given script (ObsProcedure) names in History
+
+    As with the other names, these are resolved to IDs locally (see resolveNames)"""
+
     if regex:
         CONSOLE_LOGGER.debug(
             "Treating given script names as regular expressions due to presence of regex=True"
         )
-        for script_name in script_names:
-            results |= History.objects.filter(obsprocedure__name__iregex=script_name)
+        ids = resolveNames(ObsProcedure, regexes=script_names)
     else:
         CONSOLE_LOGGER.debug(
             "Searching for exact, case-insensitive matches of script names"
         )
-        for script_name in script_names:
-            results |= History.objects.filter(obsprocedure__name__iexact=script_names)
-    return results
+        ids = resolveNames(ObsProcedure, script_names)
+    return Q(obsprocedure_id__in=ids)
 
 
-def filterByValues(accessor, values, fuzzy=False, regex=False):
-    if fuzzy or regex:
-        if fuzzy:
-            CONSOLE_LOGGER.debug(
-                "Searching for case-insensitive substring matches of given '{accessor}' values".format(
-                    accessor=accessor
-                )
-            )
-        if regex:
-            CONSOLE_LOGGER.debug(
-                "Treating given '{accessor}' values as case-insensitive regular expressions".format(
-                    accessor=accessor
-                )
+def filterByValues(accessor, model, values, fuzzy=False, regex=False):
+    """Return a Q matching the given `model` names via the `accessor` foreign key
+
+    Names are first resolved to primary keys (see resolveNames), so the
+    returned Q is simply an IN on the foreign key column"""
+
+    if fuzzy:
+        CONSOLE_LOGGER.debug(
+            "Searching for case-insensitive substring matches of given '{model}' values".format(
+                model=model.__name__
             )
-        results = History.objects.none()
-        for value in values:
-            if fuzzy:
-                results |= History.objects.filter(
-                    **{"{accessor}__icontains".format(accessor=accessor): value}
-                )
-            if regex:
-                results |= History.objects.filter(
-                    **{"{accessor}__iregex".format(accessor=accessor): value}
-                )
-    else:
+        )
+    if regex:
         CONSOLE_LOGGER.debug(
-            "Searching for exact, case-insensitive matches of given '{accessor}' values: {values}".format(
-                accessor=accessor, values=values
+            "Treating given '{model}' values as case-insensitive regular expressions".format(
+                model=model.__name__
             )
         )
-        for value in values:
-            results |= History.objects.filter(
-                **{"{accessor}__iexact".format(accessor=accessor): values}
+    if not (fuzzy or regex):
+        CONSOLE_LOGGER.debug(
+            "Searching for exact, case-insensitive matches of given '{model}' values: {values}".format(
+                model=model.__name__, values=values
             )
+        )
 
-    return results
+    ids = resolveNames(model, values, fuzzy=fuzzy, regexes=values if regex else ())
+    return Q(**{"{accessor}__in".format(accessor=accessor): ids})
 
 
 def filterByObserver(observer_names, fuzzy=False, regex=False):
-    return filterByValues("observer__name", observer_names, fuzzy, regex)
+    return filterByValues("observer_id", Observer, observer_names, fuzzy, regex)
 
 
 def filterByOperator(operator_names, fuzzy=False, regex=False):
-    return filterByValues("operator__name", operator_names, fuzzy, regex)
+    return filterByValues("operator_id", Operator, operator_names, fuzzy, regex)
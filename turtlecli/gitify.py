@@ -5,8 +5,33 @@
 
 # import argparse
 # import re
+import hashlib
+import json
+import logging
+import multiprocessing
 import os
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.db import connections
+
+from tortoise.models import History
+from turtlecli.archive import Archive
+from turtlecli.cache import get_dimension_cache
+from turtlecli.dedup import ScriptContents, with_script_hash
+from turtlecli.filters import filterByIds
+from turtlecli.streaming import STREAM_CHUNK_SIZE, stream_values, with_progress
+
+CONSOLE_LOGGER = logging.getLogger("{}_user".format(__name__))
+
+# Git config keys under which the last exported execution is recorded
+LAST_ID_KEY = "turtlecli.last-id"
+LAST_DATETIME_KEY = "turtlecli.last-datetime"
+MANIFEST_FILE_NAME = "manifest.json"
+# The project under which executions whose project is unknown are exported
+UNKNOWN_PROJECT_NAME = "_unknown"
+# The script name of executions whose procedure is unknown, by procedure ID
+UNKNOWN_SCRIPT_NAME = "_unknown_{}"
 
 # # ../AGBT19A_999.OREO.2019-06-14_15:57:59.OPERATOR.script.txt
 # DATE_REGEX = re.compile(
@@ -14,73 +39,365 @@ import subprocess
 # )
 
 
-def gitify(results, output, include_log=False):
+class GitifyError(Exception):
+    pass
+
+
+def check_clean(output):
+    """Raise GitifyError if the repository at `output` has uncommitted changes
+
+    Exports check out what they commit, which must not overwrite any changes"""
+
+    status = git_output(["status", "--porcelain", "--untracked-files=no"], output)
+    if status:
+        raise GitifyError(
+            "The repository at {} has uncommitted changes; commit or stash them "
+            "before exporting to it:\n{}".format(output, status)
+        )
+
+
+def gitify(
+    results, output, include_log=False, archive=None, chunk_size=None, progress=True
+):
+    """Commit every execution in `results`, oldest first, to the repository at `output`
+
+    Everything is written via a single `git fast-import` stream, so git is
+    only run a few times, no matter how many executions there are.
+
+    The export is incremental: the last exported execution is recorded in the
+    repository's config, and only executions after it (i.e. with a greater ID)
+    are exported by subsequent calls.
+
+    Return a dict summarizing the export"""
+
     subprocess.check_output(["git", "init"], cwd=output)
+    check_clean(output)
+    # e.g. refs/heads/master
+    ref = git_output(["symbolic-ref", "HEAD"], output)
+    parent = git_output(["rev-parse", "--verify", "--quiet", ref], output, check=False)
+    # Name <email>, from the user's git config
+    author = git_output(["var", "GIT_AUTHOR_IDENT"], output).rsplit(" ", 2)[0]
+    committer = git_output(["var", "GIT_COMMITTER_IDENT"], output)
+    last_id = git_output(["config", "--get", LAST_ID_KEY], output, check=False)
+    last_id = int(last_id) if last_id else 0
+    if last_id:
+        CONSOLE_LOGGER.info(
+            "Exporting only executions after %s (ID %s), which was the last "
+            "exported to %s",
+            git_output(["config", "--get", LAST_DATETIME_KEY], output, check=False),
+            last_id,
+            output,
+        )
+        if results.query.can_filter():
+            results = results.filter(id__gt=last_id)
 
-    for (
-        project_name,
-        script_name,
-        execution_date,
-        executed_script,
-        log,
-    ) in results.values_list(
-        "obsprocedure__obsprojectref__name",
-        "obsprocedure__name",
-        "datetime",
-        "executed_script",
-        "log",
-    ):
-        commit_script_execution(
-            project_name,
-            script_name,
-            execution_date,
-            executed_script,
-            log,
+    # Each distinct script is fetched only once
+    scripts = ScriptContents.for_results(results, archive=archive)
+    # Names are mapped from the IDs via the dimension cache, rather than
+    # joined, so that executions whose procedure is gone are still exported
+    fields = ["obsprocedure_id", "datetime", "script_hash", "id"]
+    if include_log and not archive:
+        fields.append("log")
+    results = with_script_hash(results)
+    if not results.query.can_filter():
+        # Can't be filtered or re-ordered by the DB
+        rows = sorted(
+            (row for row in results.values(*fields) if row["id"] > last_id),
+            key=lambda row: (row["datetime"], row["id"]),
+        )
+    else:
+        # Rows (which may include logs) are streamed, so memory use is bounded
+        rows = stream_values(results.order_by("datetime", "id"), fields, chunk_size)
+    if include_log and archive:
+        # Logs are only fetched for the rows that aren't in the archive
+        rows = archive.with_texts(
+            rows,
+            "log",
+            using=results.db,
+            chunk_size=chunk_size if chunk_size else STREAM_CHUNK_SIZE,
+        )
+
+    fast_import = subprocess.Popen(
+        ["git", "fast-import", "--quiet"], cwd=output, stdin=subprocess.PIPE
+    )
+    stream = GitFastImportStream(
+        fast_import.stdin,
+        ref,
+        parent,
+        author,
+        committer,
+        # So that files that haven't changed since the last export aren't
+        # committed again
+        blob_ids=get_tree_blob_ids(parent, output) if parent else None,
+    )
+    dimensions = get_dimension_cache()
+    last_row = None
+    try:
+        for row in with_progress(rows, "Exported") if progress else rows:
+            if not last_row or row["id"] > last_row["id"]:
+                last_row = row
+            procedure_id = row["obsprocedure_id"]
+            project_name = dimensions.project_name(procedure_id)
+            script_name = dimensions.procedure_name(procedure_id)
+            if not project_name:
+                project_name = UNKNOWN_PROJECT_NAME
+            if not script_name:
+                script_name = UNKNOWN_SCRIPT_NAME.format(procedure_id)
+            files = {
+                get_script_file_name(project_name, script_name): (
+                    scripts.get(row["script_hash"]) or ""
+                )
+            }
+            if include_log:
+                files[get_log_file_name(project_name, script_name)] = row["log"] or ""
+            stream.commit(files, row["datetime"])
+    finally:
+        fast_import.stdin.close()
+        if fast_import.wait():
+            raise subprocess.CalledProcessError(
+                fast_import.returncode, fast_import.args
+            )
+
+    CONSOLE_LOGGER.debug("Made %s commits in %s", stream.num_commits, output)
+    if last_row:
+        subprocess.check_output(
+            ["git", "config", LAST_ID_KEY, str(last_row["id"])], cwd=output
+        )
+        subprocess.check_output(
+            ["git", "config", LAST_DATETIME_KEY, str(last_row["datetime"])],
+            cwd=output,
+        )
+    if stream.num_commits:
+        # Check out what was imported. Only the files that changed since the
+        # previous export are updated, and git refuses to overwrite untracked
+        # files
+        subprocess.check_output(
+            ["git", "read-tree", "-m", "-u", *([parent] if parent else []), ref],
+            cwd=output,
+        )
+
+    return {
+        "num_commits": stream.num_commits,
+        "last_id": last_row["id"] if last_row else last_id or None,
+    }
+
+
+def _gitify_project(
+    using, query, procedure_ids, output, include_log, archive_path, chunk_size
+):
+    """Export the results of a single project (in a worker process)
+
+    The results are those of the given (pickled) Query, among the given
+    procedures. QuerySets would be evaluated in order to be pickled"""
+
+    os.makedirs(output, exist_ok=True)
+    results = History.objects.using(using).all()
+    results.query = query
+    results = results.filter(obsprocedure_id__in=procedure_ids)
+    # Archives can't be pickled, so each worker opens its own
+    archive = Archive(path=archive_path) if archive_path else None
+    try:
+        return gitify(
+            results,
             output,
             include_log=include_log,
+            archive=archive,
+            chunk_size=chunk_size,
+            progress=False,
         )
+    finally:
+        connections.close_all()
 
 
-def commit_script_execution(
-    project_name,
-    script_name,
-    execution_date,
-    executed_script,
-    log,
-    output,
-    include_log=False,
+def group_procedure_ids_by_project(results):
+    """Return a dict mapping each project name to the IDs of its procedures in results
+
+    Procedures whose project is unknown are grouped under UNKNOWN_PROJECT_NAME"""
+
+    dimensions = get_dimension_cache()
+    procedure_ids_by_project = {}
+    for procedure_id in (
+        results.order_by().values_list("obsprocedure_id", flat=True).distinct()
+    ):
+        project_name = dimensions.project_name(procedure_id)
+        procedure_ids_by_project.setdefault(
+            project_name if project_name else UNKNOWN_PROJECT_NAME, []
+        ).append(procedure_id)
+    return procedure_ids_by_project
+
+
+def gitify_by_project(
+    results, output, include_log=False, archive=None, chunk_size=None, jobs=1
 ):
-    script_file_name = "{project_name}.{script_name}.script.py".format(
+    """Export the results of each project to its own repository, in parallel
+
+    The repository of each project is {output}/{project}, and is exported as
+    by gitify() (i.e. incrementally). They are indexed by {output}/manifest.json
+
+    The workers are forked, so no other threads (e.g. of a QueryExecutor) may be
+    running: any lock that one of them held would never be released in the
+    workers"""
+
+    if not results.query.can_filter():
+        # Per-project results can't be filtered out of a sliced QuerySet
+        results = History.objects.using(results.db).filter(
+            filterByIds(results.values_list("id", flat=True), using=results.db)
+        )
+    procedure_ids_by_project = group_procedure_ids_by_project(results)
+
+    manifest_path = os.path.join(output, MANIFEST_FILE_NAME)
+    try:
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        manifest = {"projects": {}}
+
+    # Workers must not share the connections of this process
+    connections.close_all()
+    # Workers are forked, so that they inherit Django's state (e.g. --local)
+    with ProcessPoolExecutor(
+        max_workers=jobs, mp_context=multiprocessing.get_context("fork")
+    ) as pool:
+        futures = {
+            pool.submit(
+                _gitify_project,
+                results.db,
+                results.query,
+                procedure_ids,
+                os.path.join(output, project_name.replace(os.sep, "_")),
+                include_log,
+                archive.path if archive else None,
+                chunk_size,
+            ): project_name
+            for project_name, procedure_ids in procedure_ids_by_project.items()
+        }
+        try:
+            for num_done, future in enumerate(as_completed(futures), 1):
+                project_name = futures[future]
+                summary = future.result()
+                manifest["projects"][project_name] = {
+                    "path": project_name.replace(os.sep, "_"),
+                    "last_id": summary["last_id"],
+                }
+                CONSOLE_LOGGER.info(
+                    "[%s/%s] Made %s commits to the repository of project %s",
+                    num_done,
+                    len(futures),
+                    summary["num_commits"],
+                    project_name,
+                )
+        finally:
+            # Written even if some projects failed, so it indexes those that didn't
+            temp_path = "{}.tmp".format(manifest_path)
+            with open(temp_path, "w") as file:
+                json.dump(manifest, file, indent=2, sort_keys=True)
+            os.replace(temp_path, manifest_path)
+
+
+def git_output(args, cwd, check=True):
+    try:
+        return (
+            subprocess.check_output(["git", *args], cwd=cwd, stderr=subprocess.DEVNULL)
+            .decode()
+            .strip()
+        )
+    except subprocess.CalledProcessError:
+        if check:
+            raise
+        return None
+
+
+def get_tree_blob_ids(commit, cwd):
+    """Return a dict mapping each path in the given commit to its blob ID"""
+
+    ls_tree = subprocess.check_output(["git", "ls-tree", "-r", "-z", commit], cwd=cwd)
+    blob_ids = {}
+    for entry in ls_tree.decode().split("\0"):
+        if entry:
+            # <mode> <type> <object>\t<path>
+            info, path = entry.split("\t", 1)
+            blob_ids[path] = info.split()[2]
+    return blob_ids
+
+
+def get_blob_id(data):
+    """Return the ID that git would give a blob of the given bytes"""
+
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+class GitFastImportStream:
+    """Writes commits to a `git fast-import` process
+
+    Files whose content is unchanged are left out of each commit, and commits
+    that would change nothing are skipped. Identical content is only sent
+    once"""
+
+    def __init__(
+        self, file, ref, parent=None, author=None, committer=None, blob_ids=None
+    ):
+        self.file = file
+        self.ref = ref
+        self.parent = parent
+        self.author = author
+        self.committer = committer
+        # Maps path to the ID of its current blob
+        self.blob_ids = blob_ids if blob_ids else {}
+        # Maps blob ID to its fast-import mark
+        self.marks = {}
+        self.num_commits = 0
+
+    def write_data(self, data):
+        self.file.write(b"data %d\n" % len(data))
+        self.file.write(data)
+        self.file.write(b"\n")
+
+    def blob_mark(self, data):
+        blob_id = get_blob_id(data)
+        if blob_id not in self.marks:
+            self.marks[blob_id] = ":{}".format(len(self.marks) + 1)
+            self.file.write(b"blob\nmark %s\n" % self.marks[blob_id].encode())
+            self.write_data(data)
+        return self.marks[blob_id]
+
+    def commit(self, files, date, message="Commit created by turtlecli"):
+        """Commit the given {path: text} (if anything changed) with the given date"""
+
+        changes = []
+        for path, text in files.items():
+            data = text.encode("utf-8")
+            blob_id = get_blob_id(data)
+            if self.blob_ids.get(path) != blob_id:
+                changes.append((path, self.blob_mark(data)))
+                self.blob_ids[path] = blob_id
+        if not changes:
+            return
+
+        self.file.write(b"commit %s\n" % self.ref.encode())
+        self.file.write(
+            "author {} {} +0000\n".format(self.author, int(date.timestamp())).encode()
+        )
+        self.file.write("committer {}\n".format(self.committer).encode())
+        self.write_data(message.encode())
+        if self.parent and not self.num_commits:
+            self.file.write(b"from %s\n" % self.parent.encode())
+        for path, mark in changes:
+            self.file.write("M 100644 {} {}\n".format(mark, path).encode())
+        self.file.write(b"\n")
+        self.num_commits += 1
+
+
+def get_script_file_name(project_name, script_name):
+    return "{project_name}.{script_name}.script.py".format(
         project_name=project_name, script_name=script_name
     )
-    log_file_name = "{project_name}.{script_name}.log.py".format(
+
+
+def get_log_file_name(project_name, script_name):
+    return "{project_name}.{script_name}.log.py".format(
         project_name=project_name, script_name=script_name
     )
 
-    script_file_path = os.path.join(output, script_file_name)
-    log_file_path = os.path.join(output, log_file_name)
-    with open(script_file_path, "w") as file:
-        file.write(executed_script)
-    subprocess.check_output(["git", "add", script_file_name], cwd=output)
-
-    if include_log:
-        with open(log_file_path, "w") as file:
-            file.write(log)
-        subprocess.check_output(["git", "add", log_file_name], cwd=output)
-    status = subprocess.check_output(["git", "diff", "--cached"], cwd=output)
-    if status:
-        subprocess.check_output(
-            [
-                "git",
-                "commit",
-                "-m",
-                "Commit created by turtlecli",
-                "--date",
-                str(execution_date),
-            ],
-            cwd=output,
-        )
-
 
 # def gitify_path(dir_path):
 #     dir_path = Path(dir_path)
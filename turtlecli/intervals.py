@@ -0,0 +1,122 @@
+"""Sets of disjoint time intervals, and their translation into queries
+
+Time windows (from --times, or from the scans of a session) frequently
+overlap. These are merged into the minimal set of disjoint ranges before
+being sent to the DB. If there are only a few ranges, they are sent as an OR
+of BETWEENs; otherwise, they are inserted into a temporary table that History
+is joined against (see turtlecli.temptables), so that the size of the SQL
+stays bounded.
+"""
+
+import logging
+
+from django.db import connections
+from django.db.models import Q
+
+from tortoise.models import History
+from turtlecli.cache import get_db_alias
+from turtlecli.temptables import RawSubquery, create_temp_table
+
+CONSOLE_LOGGER = logging.getLogger("{}_user".format(__name__))
+
+# The maximum number of ranges that will be ORed together in a query. Above
+# this, a temporary table is used instead
+MAX_OR_RANGES = 100
+
+
+class IntervalSet:
+    """A sorted set of disjoint, closed [start, end] intervals"""
+
+    def __init__(self, intervals=()):
+        self.intervals = self.merge(intervals)
+
+    @staticmethod
+    def merge(intervals):
+        """Sort and merge the given (start, end) intervals
+
+        Overlapping (and touching) intervals are combined. Returns a list of
+        disjoint (start, end) tuples, in order"""
+
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        return merged
+
+    def add(self, start, end):
+        self.intervals = self.merge(self.intervals + [(start, end)])
+
+    def __iter__(self):
+        return iter(self.intervals)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def __bool__(self):
+        return bool(self.intervals)
+
+    def __repr__(self):
+        return "IntervalSet({!r})".format(self.intervals)
+
+
+def create_interval_table(intervals, using=None):
+    """Insert the given intervals into a new temporary table; return its name
+
+    The table lives only as long as the DB connection"""
+
+    using = get_db_alias(using)
+    connection = connections[using]
+    return create_temp_table(
+        "intervals",
+        ["start_time DATETIME(6) NOT NULL", "end_time DATETIME(6) NOT NULL"],
+        [
+            (
+                connection.ops.adapt_datetimefield_value(start),
+                connection.ops.adapt_datetimefield_value(end),
+            )
+            for start, end in intervals
+        ],
+        using=using,
+    )
+
+
+def filterByIntervals(intervals, using=None):
+    """Return a Q matching History executed within any of the given intervals
+
+    intervals is an IntervalSet (or an iterable of (start, end) tuples, which
+    will be merged into one). All bounds must be timezone-aware"""
+
+    if not isinstance(intervals, IntervalSet):
+        intervals = IntervalSet(intervals)
+
+    if not intervals:
+        return Q(pk__in=[])
+
+    if len(intervals) <= MAX_OR_RANGES:
+        query = Q()
+        for start, end in intervals:
+            assert start.tzinfo and end.tzinfo
+            query |= Q(datetime__range=(start, end))
+        return query
+
+    CONSOLE_LOGGER.debug(
+        "%s intervals is more than %s; using a temporary table",
+        len(intervals),
+        MAX_OR_RANGES,
+    )
+    using = get_db_alias(using)
+    connection = connections[using]
+    table_name = create_interval_table(list(intervals), using=using)
+    history_table = connection.ops.quote_name(History._meta.db_table)
+    return Q(
+        id__in=RawSubquery(
+            "SELECT {history}.id FROM {history} JOIN {intervals} ON "
+            "{history}.datetime BETWEEN {intervals}.start_time AND {intervals}.end_time".format(
+                history=history_table, intervals=connection.ops.quote_name(table_name)
+            ),
+            [],
+        )
+    )
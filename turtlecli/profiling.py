@@ -0,0 +1,236 @@
+"""Per-phase timing and SQL accounting for --profile
+
+Phases are timed via Profiler.phase(), and every SQL statement executed on any
+connection (including those opened later, e.g. for streaming) is timed, along
+with the number of rows and (approximate) bytes that it returned. Wall time
+before turtlecli.cli.main() is reconstructed from the marks made by
+turtlecli.__main__ and, where /proc is available, the process start time.
+
+This module must not import anything slow, since it is imported before Django
+is set up.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# (phase name, wall time) pairs, recorded (unconditionally; they're cheap) during
+# startup
+_MARKS = []
+
+
+def mark(name):
+    """Record that the given startup phase has just finished
+
+    It is taken to have started when the previous phase finished (or, for the
+    first phase, when the process started)"""
+
+    _MARKS.append((name, time.time()))
+
+
+def clear_marks():
+    """Forget all startup phases (i.e. for a process that serves many requests)"""
+
+    _MARKS.clear()
+
+
+def get_process_start_time():
+    """Return the wall time at which this process started, or None if unknown"""
+
+    try:
+        with open("/proc/self/stat") as file:
+            # The command name (field 2) may contain spaces, so split after it
+            fields = file.read().rpartition(")")[2].split()
+        with open("/proc/uptime") as file:
+            uptime = float(file.read().split()[0])
+        # starttime (field 22) is in clock ticks since boot
+        started_after_boot = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+    return time.time() - (uptime - started_after_boot)
+
+
+def _estimate_size(row):
+    size = 0
+    for value in row:
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+        elif value is not None:
+            size += 8
+    return size
+
+
+class _CountingCursor:
+    """Wraps a DB-API cursor, accounting fetched rows to the given statement"""
+
+    def __init__(self, cursor, statement):
+        self._cursor = cursor
+        self._statement = statement
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+    def _count(self, rows, start):
+        self._statement["time"] += time.perf_counter() - start
+        self._statement["rows"] += len(rows)
+        self._statement["bytes"] += sum(_estimate_size(row) for row in rows)
+        return rows
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._count([row] if row is not None else [], start)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        if size is None:
+            return self._count(self._cursor.fetchmany(), start)
+        return self._count(self._cursor.fetchmany(size), start)
+
+    def fetchall(self):
+        return self._count(self._cursor.fetchall(), time.perf_counter())
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+
+class Profiler:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.start_time = time.time()
+        self.phases = []
+        self.statements = []
+        self.current_phase = None
+
+    def startup_phases(self):
+        """Return the phases recorded via mark()"""
+
+        phases = []
+        previous_time = get_process_start_time()
+        for name, time_ in _MARKS:
+            if previous_time is not None:
+                phases.append({"name": name, "time": time_ - previous_time})
+            previous_time = time_
+        return phases
+
+    def install(self):
+        """Account all SQL statements, on current and future DB connections"""
+
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+
+        if not self.enabled:
+            return
+        for connection in connections.all():
+            connection.execute_wrappers.append(self)
+        connection_created.connect(self._on_connection_created)
+
+    def _on_connection_created(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __call__(self, execute, sql, params, many, context):
+        if threading.current_thread() is threading.main_thread():
+            phase = self.current_phase
+        else:
+            # e.g. a report being prefetched while the table is rendered
+            phase = "background"
+        statement = {
+            "phase": phase,
+            "sql": sql,
+            "time": 0.0,
+            "rows": 0,
+            "bytes": 0,
+        }
+        self.statements.append(statement)
+        cursor_wrapper = context["cursor"]
+        raw_cursor = cursor_wrapper.cursor
+        if not isinstance(raw_cursor, _CountingCursor):
+            cursor_wrapper.cursor = _CountingCursor(raw_cursor, statement)
+        else:
+            raw_cursor._statement = statement
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            statement["time"] += time.perf_counter() - start
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as the given phase"""
+
+        if not self.enabled:
+            yield
+            return
+        previous_phase = self.current_phase
+        self.current_phase = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append({"name": name, "time": time.perf_counter() - start})
+            self.current_phase = previous_phase
+
+    def to_dict(self):
+        phases = self.startup_phases() + self.phases
+        for phase in phases:
+            statements = [s for s in self.statements if s["phase"] == phase["name"]]
+            phase["num_queries"] = len(statements)
+            phase["sql_time"] = sum(statement["time"] for statement in statements)
+        return {
+            "total_time": sum(phase["time"] for phase in phases),
+            "phases": phases,
+            "statements": self.statements,
+        }
+
+    def format_report(self):
+        from tabulate import tabulate
+
+        profile = self.to_dict()
+        phase_table = tabulate(
+            [
+                (
+                    phase["name"],
+                    phase["time"],
+                    phase["num_queries"],
+                    phase["sql_time"],
+                )
+                for phase in profile["phases"]
+            ],
+            headers=["Phase", "Time (s)", "Queries", "SQL Time (s)"],
+            floatfmt=".3f",
+        )
+        statement_table = tabulate(
+            [
+                (
+                    statement["phase"],
+                    statement["time"],
+                    statement["rows"],
+                    statement["bytes"],
+                    " ".join(statement["sql"].split())[:60],
+                )
+                for statement in profile["statements"]
+            ],
+            headers=["Phase", "Time (s)", "Rows", "Bytes", "SQL"],
+            floatfmt=".3f",
+        )
+        return "Profile (total {:.3f} seconds):\n{}\n\n{}".format(
+            profile["total_time"], phase_table, statement_table
+        )
+
+    def report(self, path=None):
+        """Write the profile as JSON to the given path, or as tables to stderr"""
+
+        if path:
+            with open(path, "w") as file:
+                json.dump(self.to_dict(), file, indent=2)
+        else:
+            print(self.format_report(), file=sys.stderr)
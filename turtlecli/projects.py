@@ -0,0 +1,133 @@
+"""Canonical project keys, for fuzzy matching of project names
+
+Project names are given in a variety of formats (GBT19A453, AGBT19A_453,
+agbt19a-453, ...). Every ObsProjectRef name is normalized once into a
+canonical key; fuzzy lookups are then simply dictionary hits.
+"""
+
+import difflib
+import logging
+import re
+
+CONSOLE_LOGGER = logging.getLogger("{}_user".format(__name__))
+
+
+PROJECT_NAME_REGEX = re.compile(
+    r"(?P<prefix>(?P<type>[AT])?\w*)(?P<year>\d{2,4})(?P<semester>[ABC])[_\s\-]?(?P<code>\d{,10})[_\s\-]?(?P<session>\d+)?",
+    re.IGNORECASE,
+)
+
+
+def canonical_project_key(match):
+    """Given a PROJECT_NAME_REGEX match, return (type, key)
+
+    The key is a tuple of (prefix, year, semester, code), normalized such
+    that e.g. GBT19A453, AGBT19A_453 and AGBT2019A_0453 all have the same key.
+    type is the (uppercase) project type, e.g. A or T, or None if the
+    name doesn't include one"""
+
+    groups = match.groupdict()
+    obs_type = groups["type"].upper() if groups["type"] else None
+    prefix = groups["prefix"].upper()
+    if obs_type:
+        prefix = prefix[1:]
+    # The prefix regex is greedy, so e.g. the "20" in AGBT2019A ends up in it
+    prefix = prefix.rstrip("0123456789_- ")
+    key = (
+        prefix,
+        groups["year"][-2:],
+        groups["semester"].upper(),
+        groups["code"].lstrip("0"),
+    )
+    return obs_type, key
+
+
+def normalize_project_name(name):
+    """Strip everything but letters and digits from the name, and uppercase it"""
+
+    return re.sub(r"[^0-9A-Z]", "", name.upper())
+
+
+def build_project_keys(project_names):
+    """Given a dict of {id: name}, return a dict of {key: [(type, id), ...]}"""
+
+    keys = {}
+    for id_, name in project_names.items():
+        match = PROJECT_NAME_REGEX.search(name)
+        if match:
+            obs_type, key = canonical_project_key(match)
+            keys.setdefault(key, []).append((obs_type, id_))
+    return keys
+
+
+class ProjectIndex:
+    def __init__(self, project_names, project_keys):
+        # {id: name} for every ObsProjectRef
+        self.project_names = project_names
+        # {key: [(type, id), ...]}, as built by build_project_keys
+        self.project_keys = project_keys
+
+    def lookup(self, project_name):
+        """Return the IDs of all projects whose canonical key matches the given name
+
+        If the given name includes a project type, only projects of that
+        type are returned. Otherwise, projects of any type are"""
+
+        match = PROJECT_NAME_REGEX.search(project_name)
+        if not match:
+            return []
+
+        obs_type, key = canonical_project_key(match)
+        ids = [
+            id_
+            for project_type, id_ in self.project_keys.get(key, [])
+            if not obs_type or project_type == obs_type
+        ]
+        CONSOLE_LOGGER.debug(
+            "Canonical key {key} of '{project_name}' matches {ids}".format(
+                key=key, project_name=project_name, ids=ids
+            )
+        )
+        if not ids:
+            ids = self.partial_lookup(match)
+        return ids
+
+    def partial_lookup(self, match):
+        """Return the IDs of all projects whose names contain the given
+        PROJECT_NAME_REGEX match, with anything in between its parts
+
+        This handles partial names (e.g. AGBT19A, or 19A453), which don't
+        have an exact canonical key"""
+
+        partial_regex = re.compile(
+            "{prefix}{year}.*{semester}.*{code}".format(
+                **{
+                    group: re.escape(value) if value else ""
+                    for group, value in match.groupdict().items()
+                }
+            ),
+            re.IGNORECASE,
+        )
+        ids = sorted(
+            id_
+            for id_, name in self.project_names.items()
+            if partial_regex.search(name)
+        )
+        CONSOLE_LOGGER.debug(
+            "Partial project name regex '{regex}' matches {ids}".format(
+                regex=partial_regex.pattern, ids=ids
+            )
+        )
+        return ids
+
+    def suggest(self, project_name, num=5):
+        """Return up to num known project names similar to the given one, best first"""
+
+        normalized_names = {}
+        for name in self.project_names.values():
+            normalized_names.setdefault(normalize_project_name(name), name)
+
+        matches = difflib.get_close_matches(
+            normalize_project_name(project_name), normalized_names, n=num
+        )
+        return [normalized_names[match] for match in matches]
@@ -0,0 +1,261 @@
+"""Compile parsed turtlecli arguments into a single Q expression for History
+
+Every filter contributes a Q object rather than a QuerySet; these are combined
+into one normalized expression so that exactly one SELECT is sent to the DB.
+All time constraints that are ANDed together (--last, --after, --before) are
+merged into a single range up front.
+"""
+
+import logging
+
+from dateutil.relativedelta import relativedelta
+from django.db.models import Q
+from django.utils import timezone
+
+from turtlecli.filters import (
+    filterByIds,
+    filterByRange,
+    filterByProject,
+    filterByScript,
+    filterByObserver,
+    filterByOperator,
+    join_regexes,
+)
+from turtlecli.intervals import IntervalSet, filterByIntervals
+from turtlecli.textindex import get_text_index
+from turtlecli.utils import format_date_time, iterable_to_fancy_string
+
+CONSOLE_LOGGER = logging.getLogger("{}_user".format(__name__))
+
+
+def generateRegexpStatement(keyword, value):
+    return r"{keyword}\s*=\s*[\'\"]{value}[\'\"]".format(keyword=keyword, value=value)
+
+
+def intersect_ranges(ranges):
+    """Given an iterable of (start, end) ranges, return their intersection
+
+    Either bound of a range may be None, indicating that it is unbounded.
+    Returns a single (start, end) tuple."""
+
+    starts = [start for start, __ in ranges if start]
+    ends = [end for __, end in ranges if end]
+    return (max(starts) if starts else None, min(ends) if ends else None)
+
+
+def anyOf(lookup, values):
+    """Return a Q matching any of the given values for the given lookup"""
+
+    query = Q()
+    for value in values:
+        query |= Q(**{lookup: value})
+    return query
+
+
+def compile_query(args):
+    """Compile the given parsed arguments into a Q object for History
+
+    Returns a tuple of (query, description_parts), where description_parts
+    describe each of the filters in human-readable form"""
+
+    description_parts = []
+    query = Q()
+    if args.project_names:
+        plural = "s" if args.project_names and len(args.project_names) > 1 else ""
+        description_parts.append(
+            "for project name{} {}".format(
+                plural,
+                iterable_to_fancy_string(args.project_names, quote=True, word="or"),
+            )
+        )
+        query &= filterByProject(
+            args.project_names, fuzzy=not args.exact, regex=args.regex
+        )
+
+    if args.script_names:
+        plural = "s" if args.script_names and len(args.script_names) > 1 else ""
+        description_parts.append(
+            "for script name{} {}".format(
+                plural,
+                iterable_to_fancy_string(args.script_names, quote=True, word="or"),
+            )
+        )
+        query &= filterByScript(args.script_names, regex=args.regex)
+
+    if args.observers:
+        plural = "s" if args.observers and len(args.observers) > 1 else ""
+        description_parts.append(
+            "by observer name{} {}".format(
+                plural, iterable_to_fancy_string(args.observers, quote=True, word="or")
+            )
+        )
+        query &= filterByObserver(
+            args.observers, fuzzy=not args.exact, regex=args.regex
+        )
+
+    if args.operators:
+        plural = "s" if args.operators and len(args.operators) > 1 else ""
+        description_parts.append(
+            "with operator name{} {}".format(
+                plural, iterable_to_fancy_string(args.operators, quote=True, word="or")
+            )
+        )
+        query &= filterByOperator(
+            args.operators, fuzzy=not args.exact, regex=args.regex
+        )
+
+    if args.state:
+        # Argument choices are shortened forms of the possible field values
+        state = "obs_{}".format(args.state)
+        description_parts.append("with state {}".format(state))
+        query &= Q(executed_state=state)
+
+    if args.times:
+        windows = []
+        stubs = []
+        for time in args.times:
+            assert time.tzinfo
+            start = time - args.buffer
+            end = time + args.buffer
+            stubs.append(
+                "{} {} of {} (i.e. between {} and {})".format(
+                    getattr(args.buffer, args.unit),
+                    args.unit,
+                    format_date_time(time),
+                    format_date_time(start),
+                    format_date_time(end),
+                )
+            )
+            windows.append((start, end))
+
+        description_parts.append(
+            "that occurred within {}".format(
+                iterable_to_fancy_string(stubs, quote=False, word="or")
+            )
+        )
+        # Overlapping windows are merged before being sent to the DB
+        query &= filterByIntervals(IntervalSet(windows))
+
+    # All of these time ranges are ANDed together, so we can merge them
+    # into a single range up front
+    ranges = []
+    if args.last:
+        now = timezone.now()
+        assert now.tzinfo
+
+        delta_start = now - relativedelta(**{args.unit: args.last})
+        assert delta_start.tzinfo
+
+        description_parts.append(
+            "that occurred within the last {} {} (i.e. between {} and {})".format(
+                args.last,
+                args.unit,
+                format_date_time(delta_start),
+                format_date_time(now),
+            )
+        )
+        ranges.append((delta_start, now))
+
+    if args.after or args.before:
+        if args.after and args.before:
+            description_parts.append(
+                "executed after {} but before {}".format(
+                    format_date_time(args.after), format_date_time(args.before)
+                )
+            )
+        elif args.after:
+            description_parts.append(
+                "executed after {}".format(format_date_time(args.after))
+            )
+        else:
+            description_parts.append(
+                "executed before {}".format(format_date_time(args.before))
+            )
+        ranges.append((args.after, args.before))
+
+    if ranges:
+        query &= filterByRange(*intersect_ranges(ranges))
+
+    # The IDs found by each --use-index search are intersected locally, and
+    # only the result is sent to the DB (where it is ANDed with the rest of
+    # the query)
+    index_ids = None
+
+    def intersect_index_ids(ids):
+        nonlocal index_ids
+        index_ids = ids if index_ids is None else index_ids & ids
+
+    # Handle script contains
+    if args.script_contains:
+        description_parts.append(
+            "with script containing: {}".format(args.script_contains)
+        )
+        if args.use_index:
+            intersect_index_ids(
+                get_text_index().search_contains(
+                    "executed_script", args.script_contains
+                )
+            )
+        else:
+            query &= anyOf("executed_script__icontains", args.script_contains)
+
+    # Handle log contains
+    if args.log_contains:
+        description_parts.append("with log containing: {}".format(args.log_contains))
+        if args.use_index:
+            intersect_index_ids(
+                get_text_index().search_contains("log", args.log_contains)
+            )
+        else:
+            query &= anyOf("log__icontains", args.log_contains)
+
+    # Handle script regex
+    if args.script_regex:
+        description_parts.append("with script regex: {}".format(args.script_regex))
+        if args.use_index:
+            intersect_index_ids(
+                get_text_index().search_regex("executed_script", args.script_regex)
+            )
+        else:
+            query &= Q(executed_script__iregex=join_regexes(args.script_regex))
+
+    # Handle log regex
+    if args.log_regex:
+        description_parts.append("with log regex: {}".format(args.log_regex))
+        if args.use_index:
+            intersect_index_ids(get_text_index().search_regex("log", args.log_regex))
+        else:
+            query &= Q(log__iregex=join_regexes(args.log_regex))
+
+    # Handle kwargs
+    if args.kwargs:
+        description_parts.append(
+            "with {} of config kwargs: {}".format(
+                "all" if args.all_kwargs else "any", args.kwargs
+            )
+        )
+        if args.use_index:
+            intersect_index_ids(
+                get_text_index().search_kwargs(args.kwargs, match_all=args.all_kwargs)
+            )
+        elif args.all_kwargs:
+            for keyword, value in args.kwargs.items():
+                query &= Q(
+                    executed_script__iregex=generateRegexpStatement(keyword, value)
+                )
+        else:
+            query &= Q(
+                executed_script__iregex=join_regexes(
+                    [
+                        generateRegexpStatement(keyword, value)
+                        for keyword, value in args.kwargs.items()
+                    ]
+                )
+            )
+
+    if index_ids is not None:
+        # Many IDs (e.g. for a common string) are sent via a temporary table
+        query &= filterByIds(index_ids)
+
+    CONSOLE_LOGGER.debug("Compiled query: %s", query)
+    return query, description_parts
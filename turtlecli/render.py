@@ -0,0 +1,148 @@
+"""Buffered, pager-aware rendering of turtlecli's output
+
+Reports can be very long (e.g. --show-logs for a thousand results), so output
+is collected into large writes rather than many small ones, and the terminal
+is only measured once. If stdout is a terminal and the output doesn't fit on
+the screen, it is piped into $PAGER (less -R by default, so that colors are
+kept), as git does. When stdout isn't a terminal, output is written as-is,
+without colors.
+"""
+
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Buffered output is written once it reaches this many characters
+BUFFER_SIZE = 64 * 1024
+DEFAULT_PAGER = "less -R"
+# As for git: quit if the output fits on one screen, keep colors, and leave
+# the output on the screen after quitting
+DEFAULT_LESS = "FRX"
+
+
+def get_pager():
+    """Return the pager command given by $PAGER (or the default), or None if
+    paging is disabled (e.g. PAGER=cat)"""
+
+    pager = os.environ.get("PAGER", DEFAULT_PAGER).strip()
+    if not pager or pager == "cat":
+        return None
+    return pager
+
+
+def has_fileno(stream):
+    """Return True if the given stream is backed by a real file descriptor
+
+    Streams that aren't (e.g. those of the daemon's clients) can't be paged"""
+
+    try:
+        stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        return False
+    return True
+
+
+class Renderer:
+    """Writes output to the given stream (stdout by default), via a buffer
+
+    If paging is enabled, output is held until it is clear whether it fits on
+    the screen. If it doesn't, a pager is started, and everything (including
+    any further output) is written to it instead"""
+
+    def __init__(self, stream=None, pager=True):
+        self.stream = stream if stream else sys.stdout
+        self.isatty = self.stream.isatty()
+        # Colors only make sense on a terminal
+        self.color = self.isatty
+        terminal_size = shutil.get_terminal_size()
+        self.width = terminal_size.columns
+        self.pager_command = (
+            get_pager() if pager and self.isatty and has_fileno(self.stream) else None
+        )
+        # Only output longer than this is paged
+        self.max_lines = terminal_size.lines if self.pager_command else None
+        self.num_lines = 0
+        self.pager = None
+        self.buffer = []
+        self.buffer_size = 0
+        # Set if the pager was quit before all the output was written to it
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, text):
+        if self.closed:
+            return
+        self.buffer.append(text)
+        self.buffer_size += len(text)
+        if self.max_lines is not None:
+            # Still deciding whether to page
+            self.num_lines += text.count("\n")
+            if self.num_lines >= self.max_lines:
+                self.start_pager()
+        elif self.buffer_size >= BUFFER_SIZE:
+            self._write_buffer()
+
+    def print(self, text=""):
+        self.write("{}\n".format(text))
+
+    def start_pager(self):
+        self.max_lines = None
+        env = dict(os.environ)
+        env.setdefault("LESS", DEFAULT_LESS)
+        try:
+            self.pager = subprocess.Popen(
+                shlex.split(self.pager_command),
+                stdin=subprocess.PIPE,
+                stdout=self.stream,
+                env=env,
+                encoding=getattr(self.stream, "encoding", None) or "utf-8",
+                errors="replace",
+            )
+        except OSError as error:
+            logger.debug("Could not start pager %r: %s", self.pager_command, error)
+        self._write_buffer()
+
+    def _write_buffer(self):
+        if not self.buffer:
+            return
+        text = "".join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+        try:
+            (self.pager.stdin if self.pager else self.stream).write(text)
+        except BrokenPipeError:
+            # The pager was quit; the rest of the output isn't wanted
+            self.closed = True
+
+    def flush(self):
+        """Write out all buffered output now (e.g. before prompting the user)
+
+        If it hasn't yet been decided whether to page, the output isn't paged"""
+
+        self.max_lines = None
+        self._write_buffer()
+        try:
+            (self.pager.stdin if self.pager else self.stream).flush()
+        except BrokenPipeError:
+            self.closed = True
+
+    def close(self):
+        self.flush()
+        if self.pager:
+            try:
+                self.pager.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.pager.wait()
+            self.pager = None
+        self.closed = True
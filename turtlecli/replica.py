@@ -0,0 +1,214 @@
+"""Incremental local replica of the Turtle DB
+
+`turtlecli sync` mirrors History and its dimension tables into a SQLite file
+in the user's cache directory. The dimension tables are small, so they are
+fully re-copied on every sync. History is copied incrementally: only rows
+above the highest ID already in the replica are fetched, plus any rows that
+were still in progress as of the last sync (since their logs keep growing).
+
+`turtlecli --local` then runs its queries against the replica, via a second
+DB alias (see use_replica).
+"""
+
+import argparse
+import logging
+import os
+
+from django.db import connections, router, transaction
+from django.db.models import Max
+
+from tortoise.models import History, ObsProcedure, ObsProjectRef, Observer, Operator
+from turtlecli.cache import get_cache_path
+from turtlecli.temptables import max_in_list_size
+from turtlecli.textindex import IN_PROGRESS_STATE
+
+CONSOLE_LOGGER = logging.getLogger("{}_user".format(__name__))
+
+REPLICA_ALIAS = "local"
+# Number of History rows fetched from the server at a time
+SYNC_CHUNK_SIZE = 500
+# Dimension tables, in dependency order
+DIMENSION_MODELS = (Observer, Operator, ObsProjectRef, ObsProcedure)
+
+
+class ReplicaRouter:
+    """Route all queries to the local replica"""
+
+    def db_for_read(self, model, **hints):
+        return REPLICA_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return REPLICA_ALIAS
+
+
+def get_replica_path(source="default"):
+    """Return the path of the replica of the given DB alias"""
+
+    return get_cache_path("replica", source, "sqlite3")
+
+
+def register_replica(path=None):
+    """Add the replica at the given path (by default, that of the default DB) as
+    the REPLICA_ALIAS DB alias, and return its path
+
+    If a replica at another path was registered, it is replaced"""
+
+    path = path if path else get_replica_path()
+    settings = connections.databases.get(REPLICA_ALIAS)
+    if settings is None:
+        connections.databases[REPLICA_ALIAS] = {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": path,
+        }
+    elif settings["NAME"] != path:
+        # The connection shares these settings, so it reconnects to the new path
+        connections[REPLICA_ALIAS].close()
+        settings["NAME"] = path
+    return path
+
+
+def use_replica(path=None):
+    """Route all subsequent queries to the replica
+
+    Raises ValueError if the replica doesn't exist"""
+
+    path = register_replica(path)
+    if not os.path.isfile(path):
+        raise ValueError(
+            "No local replica found at {}; run 'turtlecli sync' first".format(path)
+        )
+    router.routers.insert(0, ReplicaRouter())
+    CONSOLE_LOGGER.debug("Routing all queries to replica %s", path)
+
+
+def field_names(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def create_tables(using=REPLICA_ALIAS):
+    """Create any of the replicated tables that don't yet exist in the replica"""
+
+    connection = connections[using]
+    existing_tables = connection.introspection.table_names()
+    with connection.schema_editor() as editor:
+        for model in DIMENSION_MODELS + (History,):
+            if model._meta.db_table not in existing_tables:
+                CONSOLE_LOGGER.debug("Creating table %s", model._meta.db_table)
+                editor.create_model(model)
+                if model is History:
+                    # Nearly every query filters on this
+                    editor.execute(
+                        "CREATE INDEX History_datetime ON {} (datetime)".format(
+                            editor.quote_name(model._meta.db_table)
+                        )
+                    )
+
+
+def copy_rows(model, rows, using=REPLICA_ALIAS):
+    """Insert (or replace) the given rows (dicts of attname: value) into the replica"""
+
+    # The IDs are deleted in chunks, since SQLite limits the number of
+    # parameters of a statement
+    ids = [row["id"] for row in rows]
+    chunk_size = max_in_list_size(using)
+    for start in range(0, len(ids), chunk_size):
+        model.objects.using(using).filter(
+            id__in=ids[start : start + chunk_size]
+        )._raw_delete(using)
+    # Django picks a batch size that keeps the inserts within that limit, too
+    model.objects.using(using).bulk_create([model(**row) for row in rows])
+
+
+def sync_dimensions(source="default", target=REPLICA_ALIAS):
+    for model in DIMENSION_MODELS:
+        rows = list(model.objects.using(source).values(*field_names(model)))
+        model.objects.using(target).all()._raw_delete(target)
+        copy_rows(model, rows, using=target)
+        CONSOLE_LOGGER.info("Copied %s %s rows", len(rows), model.__name__)
+
+
+def sync_history(source="default", target=REPLICA_ALIAS, full=False):
+    queryset = History.objects.using(source).values(*field_names(History))
+
+    if full:
+        History.objects.using(target).all()._raw_delete(target)
+
+    in_progress = list(
+        History.objects.using(target)
+        .filter(executed_state=IN_PROGRESS_STATE)
+        .values_list("id", flat=True)
+    )
+    for start in range(0, len(in_progress), SYNC_CHUNK_SIZE):
+        with transaction.atomic(using=target):
+            copy_rows(
+                History,
+                list(
+                    queryset.filter(id__in=in_progress[start : start + SYNC_CHUNK_SIZE])
+                ),
+                using=target,
+            )
+    if in_progress:
+        CONSOLE_LOGGER.info("Re-synced %s in-progress History rows", len(in_progress))
+
+    watermark = (
+        History.objects.using(target).aggregate(watermark=Max("id"))["watermark"] or 0
+    )
+    num_synced = 0
+    while True:
+        rows = list(queryset.filter(id__gt=watermark).order_by("id")[:SYNC_CHUNK_SIZE])
+        if not rows:
+            break
+        with transaction.atomic(using=target):
+            copy_rows(History, rows, using=target)
+        watermark = rows[-1]["id"]
+        num_synced += len(rows)
+        CONSOLE_LOGGER.debug("Synced History rows up to ID %s", watermark)
+    CONSOLE_LOGGER.info(
+        "Synced %s new History rows (up to ID %s)", num_synced, watermark
+    )
+
+
+def sync(source="default", full=False, path=None):
+    """Bring the replica of the given DB alias up to date"""
+
+    path = register_replica(path if path else get_replica_path(source))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    CONSOLE_LOGGER.info("Syncing %s to %s", source, path)
+    create_tables()
+    # The server doesn't necessarily enforce its foreign keys, so we can't either
+    with connections[REPLICA_ALIAS].constraint_checks_disabled():
+        with transaction.atomic(using=REPLICA_ALIAS):
+            sync_dimensions(source)
+        sync_history(source, full=full)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="turtlecli sync",
+        description="Mirror the Turtle DB into a local replica, for use with "
+        "turtlecli --local",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Re-copy all of History, rather than only rows that are new (or were "
+        "in progress) since the last sync",
+    )
+    parser.add_argument(
+        "--path",
+        help="Path to the replica (default: under ~/.cache/turtlecli). Query it "
+        "via turtlecli --local --replica-path",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+        help="Specify the logging level",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger("turtlecli").setLevel(args.log_level)
+    sync(full=args.full, path=args.path)
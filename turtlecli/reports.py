@@ -1,43 +1,79 @@
-import difflib
 import logging
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 from colorama import Fore
+from django.db.models import OuterRef, Q, Subquery
 
-from turtlecli.utils import color_diff, gen2, get_console_width
-
+from tortoise.models import History
+from turtlecli.cache import get_dimension_cache
+from turtlecli.dedup import ScriptContents, with_script_hash
+from turtlecli.filters import filterByIds
+from turtlecli.streaming import StreamedValues, with_progress
+from turtlecli.render import Renderer
+from turtlecli.utils import color_diff, diff_lines, diff_scripts
 
 logger = logging.getLogger(__name__)
 
+# Below this many diffs, starting a pool of processes costs more than it saves
+MIN_POOL_DIFFS = 16
+
 
 class TurtleReport:
-    def __init__(self, results, interactive=False, text_color=Fore.BLUE):
+    # The History fields needed by the report. Only these are fetched, via
+    # values(), so results are dicts. Names are mapped from the IDs via the
+    # dimension cache, so no joins (or per-result queries) are needed
+    fields = ("id", "datetime", "obsprocedure_id", "observer_id")
+
+    def __init__(
+        self,
+        results,
+        interactive=False,
+        text_color=Fore.BLUE,
+        archive=None,
+        chunk_size=None,
+    ):
         self.results = results
+        # If given, script/log text is read from this (local) Archive where possible
+        self.archive = archive
+        # Number of rows fetched at a time, for reports that stream their results
+        self.chunk_size = chunk_size
         self.title = "{}{}".format(self.title, ", interactively" if interactive else "")
         self.text_color = text_color
         self.interactive = interactive
-        self.result_generator = results
+        # Used to map IDs to names without any additional queries
+        self.dimensions = get_dimension_cache()
+        self.result_generator = self.get_results()
+
+    def get_results(self):
+        """Return an iterable of the (dict) results that the report is made from"""
+
+        return self.results.values(*self.fields)
+
+    def prefetch(self):
+        """Fetch everything needed for the report now (e.g. in another thread),
+        rather than as it is reported. Return the report"""
+
+        self.result_generator = list(self.result_generator)
+        return self
 
     def colorize(self, text):
         return "{}{}{}".format(self.text_color, text, Fore.RESET)
 
-    def print_report_msg(self, text, raw=False):
-        try:
-            console_width = get_console_width()
-        except ValueError:
-            console_width = 80
-            logger.warning(
-                "Could not detect console width; falling back to default of {}".format(
-                    console_width
-                )
-            )
+    def colorize_report(self, text):
+        """Return the given result report, colorized for a terminal"""
+
+        return self.colorize(text)
 
-        if raw:
-            print(text)
-            print("-" * console_width)
+    def print_report_msg(self, output, text, raw=False, colorize=None):
+        rule = "-" * output.width
+        if raw or not output.color:
+            output.print(text)
+            output.print(rule)
         else:
-            print(self.colorize(text))
-            print(self.colorize("-" * console_width))
+            output.print((colorize if colorize else self.colorize)(text))
+            output.print(self.colorize(rule))
 
     def gen_filename(self):
         raise NotImplementedError("Must be implemented by child class")
@@ -49,23 +85,34 @@ class TurtleReport:
         raise NotImplementedError("Must be implemented by child class")
 
     def save_report(self, path):
-        for result in self.result_generator:
+        for result in with_progress(self.result_generator, "Saved"):
             full_path = os.path.join(path, self.gen_filename(result))
             with open(full_path, "w") as file:
                 file.write(self.gen_result_report(result))
 
             logger.debug(
-                "Saved {result} to {full_path}".format(
-                    result=result, full_path=full_path
+                "Saved History {id} to {full_path}".format(
+                    id=result["id"], full_path=full_path
                 )
             )
 
-    def print_report(self):
-        self.print_report_msg(self.title)
+    def print_report(self, output=None):
+        """Print the report via the given Renderer (a new one, by default)"""
+
+        if not output:
+            with Renderer(pager=not self.interactive) as output:
+                return self.print_report(output)
+
+        self.print_report_msg(output, self.title)
         for result in self.result_generator:
-            self.print_report_msg(self.gen_result_header(result))
-            self.print_report_msg(self.gen_result_report(result))
+            self.print_report_msg(output, self.gen_result_header(result))
+            self.print_report_msg(
+                output,
+                self.gen_result_report(result),
+                colorize=self.colorize_report,
+            )
             if self.interactive:
+                output.flush()
                 response = input(
                     self.colorize(
                         "Press any key to see the next diff (or 'q' to exit the loop)"
@@ -77,73 +124,232 @@ class TurtleReport:
 
 class LogReport(TurtleReport):
     title = "Showing logs for all above results"
+    fields = TurtleReport.fields + ("log",)
+
+    def get_results(self):
+        if not self.archive:
+            # Logs can be huge, so they are streamed rather than held in memory
+            return StreamedValues(self.results, self.fields, self.chunk_size)
+
+        # Logs are only fetched (in one query) for results that aren't in the archive
+        return list(
+            self.archive.with_texts(
+                self.results.values(*TurtleReport.fields),
+                "log",
+                using=self.results.db,
+            )
+        )
 
     def gen_filename(self, result):
         return "{project}.{script}.{exec}.{observer}.log.txt".format(
-            observer=result.observer.name,
-            project=result.obsprocedure.obsprojectref.name,
-            script=result.obsprocedure.name,
-            exec=result.datetime,
+            observer=self.dimensions.observer_name(result["observer_id"]),
+            project=self.dimensions.project_name(result["obsprocedure_id"]),
+            script=self.dimensions.procedure_name(result["obsprocedure_id"]),
+            exec=result["datetime"],
         ).replace(" ", "_")
 
     def gen_result_header(self, result):
         return "Logs for script {script}, executed at {exec} by observer {observer}".format(
-            observer=result.observer.name,
-            script=result.obsprocedure.name,
-            exec=result.datetime,
+            observer=self.dimensions.observer_name(result["observer_id"]),
+            script=self.dimensions.procedure_name(result["obsprocedure_id"]),
+            exec=result["datetime"],
         )
 
     def gen_result_report(self, result):
-        return result.log
+        return result["log"]
 
 
 class ScriptReport(TurtleReport):
     title = "Showing scripts for all above results"
 
+    def __init__(self, *args, **kwargs):
+        super(ScriptReport, self).__init__(*args, **kwargs)
+        # Each distinct script is fetched only once; repeats refer back to
+        # the first execution with the same content
+        self.scripts = ScriptContents(self.result_generator, archive=self.archive)
+
+    def get_results(self):
+        return list(with_script_hash(self.results).values(*self.fields, "script_hash"))
+
     def gen_filename(self, result):
         return "{project}.{script}.{exec}.{observer}.script.txt".format(
-            observer=result.observer.name,
-            project=result.obsprocedure.obsprojectref.name,
-            script=result.obsprocedure.name,
-            exec=result.datetime,
+            observer=self.dimensions.observer_name(result["observer_id"]),
+            project=self.dimensions.project_name(result["obsprocedure_id"]),
+            script=self.dimensions.procedure_name(result["obsprocedure_id"]),
+            exec=result["datetime"],
         ).replace(" ", "_")
 
     def gen_result_header(self, result):
-        return "Contents of scripts executed at {exec}".format(exec=result.datetime)
+        return "Contents of scripts executed at {exec}".format(exec=result["datetime"])
 
     def gen_result_report(self, result):
-        return result.executed_script
+        if self.scripts.is_repeat(result):
+            __, first_datetime = self.scripts.first_execution(result["script_hash"])
+            return "Identical to script executed at {exec}".format(exec=first_datetime)
+        return self.scripts.get(result["script_hash"])
+
+    def save_report(self, path):
+        # Maps script hash to the path it was first saved to
+        saved_paths = {}
+        for result in with_progress(self.result_generator, "Saved"):
+            full_path = os.path.join(path, self.gen_filename(result))
+            if os.path.lexists(full_path):
+                os.remove(full_path)
+
+            first_path = saved_paths.get(result["script_hash"])
+            if first_path:
+                try:
+                    os.link(first_path, full_path)
+                    logger.debug(
+                        "Linked {full_path} to identical {first_path}".format(
+                            full_path=full_path, first_path=first_path
+                        )
+                    )
+                    continue
+                except OSError as error:
+                    logger.debug(
+                        "Could not link {full_path} to {first_path} ({error}); "
+                        "writing it instead".format(
+                            full_path=full_path, first_path=first_path, error=error
+                        )
+                    )
+
+            with open(full_path, "w") as file:
+                file.write(self.scripts.get(result["script_hash"]) or "")
+            saved_paths.setdefault(result["script_hash"], full_path)
+            logger.debug(
+                "Saved History {id} to {full_path}".format(
+                    id=result["id"], full_path=full_path
+                )
+            )
 
 
 class DiffReport(TurtleReport):
-    title = "Showing logs for all above results"
+    """Differences between each result and the previous execution of its script
 
-    def __init__(self, *args, **kwargs):
+    Results are grouped by ObsProcedure. The previous execution of each is
+    looked up by the DB (in the same query as the results themselves), so it
+    needn't be among the results, and the number of queries doesn't depend on
+    the number of results. Pairs with identical content aren't diffed at all;
+    the rest are diffed across a pool of `jobs` processes"""
+
+    title = "Showing differences from the previous execution of each script"
+
+    def __init__(self, *args, jobs=1, **kwargs):
+        self.jobs = jobs
         super(DiffReport, self).__init__(*args, **kwargs)
-        # Iterate through results as pairs -- that is, grab every two items out at a time
-        self.result_generator = gen2(self.results)
 
-    @staticmethod
-    def diff_scripts(script_a, script_b, compact=True):
-        script_a_lines = script_a.split("\n")
-        script_b_lines = script_b.split("\n")
+    def get_results(self):
+        # The ID of the previous execution of the same procedure (ties in
+        # datetime are broken by ID, as in the main query)
+        previous_id = (
+            History.objects.filter(obsprocedure_id=OuterRef("obsprocedure_id"))
+            .filter(
+                Q(datetime__lt=OuterRef("datetime"))
+                | Q(datetime=OuterRef("datetime"), id__lt=OuterRef("id"))
+            )
+            .order_by("-datetime", "-id")
+            .values("id")[:1]
+        )
+        results = list(
+            with_script_hash(self.results)
+            .annotate(previous_id=Subquery(previous_id))
+            .values(*self.fields, "script_hash", "previous_id")
+        )
+        rows_by_id = {result["id"]: result for result in results}
+        missing_ids = {
+            result["previous_id"] for result in results if result["previous_id"]
+        } - set(rows_by_id)
+        if missing_ids:
+            rows_by_id.update(
+                (row["id"], row)
+                for row in with_script_hash(
+                    History.objects.using(self.results.db).filter(
+                        filterByIds(missing_ids, using=self.results.db)
+                    )
+                ).values(*self.fields, "script_hash")
+            )
 
-        if compact:
-            diff = difflib.unified_diff(script_a_lines, script_b_lines)
+        # Grouped by procedure, in order of each procedure's first result
+        groups = {}
+        for result in results:
+            groups.setdefault(result["obsprocedure_id"], []).append(
+                (rows_by_id.get(result["previous_id"]), result)
+            )
+        pairs = [pair for group in groups.values() for pair in group]
+        changed_pairs = [
+            (previous, result)
+            for previous, result in pairs
+            if previous and previous["script_hash"] != result["script_hash"]
+        ]
+        # Only the scripts that actually need diffing are fetched
+        self.scripts = ScriptContents(
+            (row for pair in changed_pairs for row in pair),
+            using=self.results.db,
+            archive=self.archive,
+        )
+        self.diffs = self.diff_pairs(
+            {
+                (previous["script_hash"], result["script_hash"])
+                for previous, result in changed_pairs
+            }
+        )
+        return pairs
+
+    def diff_pairs(self, hash_pairs):
+        """Return a dict mapping each (hash A, hash B) pair to the diff of A and B"""
+
+        hash_pairs = list(hash_pairs)
+        script_pairs = [
+            (self.scripts.get(hash_a), self.scripts.get(hash_b))
+            for hash_a, hash_b in hash_pairs
+        ]
+        if self.jobs > 1 and len(script_pairs) >= MIN_POOL_DIFFS:
+            # This usually runs in a thread (prefetching the report), so the
+            # workers aren't forked from this process, but from a forkserver.
+            # Only the scripts themselves are sent to them
+            with ProcessPoolExecutor(
+                max_workers=self.jobs,
+                mp_context=multiprocessing.get_context("forkserver"),
+            ) as pool:
+                diffs = list(pool.map(diff_scripts, *zip(*script_pairs), chunksize=4))
         else:
-            diff = difflib.ndiff(script_a_lines, script_b_lines)
+            diffs = [diff_scripts(*script_pair) for script_pair in script_pairs]
+        logger.debug("Diffed %s distinct pairs of scripts", len(diffs))
+        return dict(zip(hash_pairs, diffs))
+
+    @staticmethod
+    def diff_scripts(script_a, script_b, compact=True, color=True):
+        diff = diff_lines(script_a, script_b, compact)
+        if not color:
+            return diff
         colordiff = color_diff(diff)
         return colordiff
 
+    def colorize_report(self, text):
+        return self.colorize("\n".join(color_diff(text.split("\n"))))
+
     def gen_result_header(self, result):
-        # Due to our result_generator, result is actually two results
-        result_a, result_b = result
-        return "Differences between scripts A (executed {a}) and B (executed {b})".format(
-            a=result_a.datetime, b=result_b.datetime
+        # Each result is actually a (previous execution, execution) pair
+        previous, result = result
+        if not previous:
+            return "Script {script} executed at {b}".format(
+                script=self.dimensions.procedure_name(result["obsprocedure_id"]),
+                b=result["datetime"],
+            )
+        return (
+            "Differences in script {script} between its executions at {a} and {b}"
+        ).format(
+            script=self.dimensions.procedure_name(result["obsprocedure_id"]),
+            a=previous["datetime"],
+            b=result["datetime"],
         )
 
     def gen_result_report(self, result):
-        # Due to our result_generator, result is actually two results
-        result_a, result_b = result
-        diff = self.diff_scripts(result_a.executed_script, result_b.executed_script)
-        return "\n".join(diff)
+        # Each result is actually a (previous execution, execution) pair
+        previous, result = result
+        if not previous:
+            return "No previous execution of this script"
+        if previous["script_hash"] == result["script_hash"]:
+            return "Scripts are identical"
+        return self.diffs[(previous["script_hash"], result["script_hash"])]
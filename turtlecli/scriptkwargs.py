@@ -0,0 +1,146 @@
+"""Extraction of keyword=value statements from executed scripts
+
+Observation scripts set their parameters in a few ways: as plain Python
+assignments (tint = 40.96e-6), as keyword arguments (Track(src, beamName="1")),
+as dicts, or as lines within a configuration string passed to Configure
+(receiver = 'Rcvr1_2'). All of these are extracted into (keyword, value)
+pairs. Scripts that aren't valid Python are scanned line by line instead.
+
+Keywords and values are normalized to lowercase, with any quotes stripped, so
+that lookups are case-insensitive (as the REGEXP-based search is).
+"""
+
+import ast
+import logging
+import re
+import sys
+
+logger = logging.getLogger(__name__)
+
+# A keyword=value line, e.g. within a config string. Note that == is excluded
+KWARG_LINE_REGEX = re.compile(
+    r"^\s*(?P<keyword>[A-Za-z_]\w*)\s*=(?!=)\s*(?P<value>.+?)\s*$", re.MULTILINE
+)
+QUOTED_VALUE_REGEX = re.compile(r"""^(?P<quote>['"])(?P<value>.*?)(?P=quote)""")
+# Before Python 3.8, ast.parse returns these node types (and the name of their
+# value attribute) for constants, rather than ast.Constant
+if sys.version_info < (3, 8):
+    LEGACY_CONSTANT_NODES = (
+        (ast.Str, "s"),
+        (ast.Num, "n"),
+        (ast.NameConstant, "value"),
+    )
+else:
+    LEGACY_CONSTANT_NODES = ()
+# Returned by _literal for nodes that aren't constants (since None is one)
+NOT_CONSTANT = object()
+
+
+def normalize_keyword(keyword):
+    return keyword.strip().lower()
+
+
+def normalize_value(value):
+    return str(value).strip().lower()
+
+
+def strip_source_value(value):
+    """Given the source text of a value, strip its enclosing quotes or trailing comment"""
+
+    match = QUOTED_VALUE_REGEX.match(value)
+    if match:
+        return match.group("value")
+    return value.split("#", 1)[0].rstrip()
+
+
+def to_number(value):
+    """Return the given (normalized) value as a float, or None if it isn't numeric"""
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _literal(node):
+    """Return the value of the given node if it is a constant, else NOT_CONSTANT
+
+    This handles the constant nodes of every supported Python version"""
+
+    if isinstance(node, getattr(ast, "Constant", ())):
+        return node.value
+    for node_type, attribute in LEGACY_CONSTANT_NODES:
+        if isinstance(node, node_type):
+            return getattr(node, attribute)
+    return NOT_CONSTANT
+
+
+def _constant_value(node):
+    """Return the value of the given node if it is a constant, else None"""
+
+    value = _literal(node)
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = _literal(node.operand)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return -value
+    return None
+
+
+def _extract_from_lines(text):
+    return [
+        (match.group("keyword"), strip_source_value(match.group("value")))
+        for match in KWARG_LINE_REGEX.finditer(text)
+    ]
+
+
+def _extract_from_ast(tree):
+    pairs = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign):
+            value = _constant_value(node.value)
+            if value is not None:
+                pairs.extend(
+                    (target.id, value)
+                    for target in node.targets
+                    if isinstance(target, ast.Name)
+                )
+        elif isinstance(node, ast.keyword):
+            value = _constant_value(node.value)
+            if node.arg and value is not None:
+                pairs.append((node.arg, value))
+        elif isinstance(node, ast.Dict):
+            for key, value_node in zip(node.keys, node.values):
+                value = _constant_value(value_node)
+                key = _literal(key)
+                if isinstance(key, str) and value is not None:
+                    pairs.append((key, value))
+        else:
+            text = _literal(node)
+            if isinstance(text, str):
+                # Configuration strings
+                pairs.extend(_extract_from_lines(text))
+    return pairs
+
+
+def extract_kwargs(script):
+    """Return the set of normalized (keyword, value) pairs in the given script"""
+
+    if not script:
+        return set()
+
+    try:
+        pairs = _extract_from_ast(ast.parse(script))
+    except (SyntaxError, ValueError) as error:
+        logger.debug("Could not parse script (%s); scanning it line by line", error)
+        pairs = _extract_from_lines(script)
+
+    kwargs = set()
+    for keyword, value in pairs:
+        value = normalize_value(value)
+        # Multi-line values are (e.g.) config strings, whose contents are
+        # extracted separately
+        if value and "\n" not in value:
+            kwargs.add((normalize_keyword(keyword), value))
+    return kwargs
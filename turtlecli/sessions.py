@@ -0,0 +1,198 @@
+"""Persistent index of GBT sessions, for session-qualified project searches
+
+Turtle does not store any session information, so to find the scripts
+executed during a given session we look at the scan start times in that
+session's ScanLog.fits. Finding these files requires walking the entire data
+archive, and reading them is slow, so both are cached: the archive is walked
+incrementally (only directories that are new or have changed since the last
+walk are re-listed), and the scan times of each ScanLog are parsed only once
+per modification of that file.
+
+The archive is laid out as {root}/{directory}/{session}/ScanLog.fits
+"""
+
+import datetime
+import hashlib
+import logging
+import os
+
+import dateutil.parser as dp
+import numpy as np
+
+from turtlecli.cache import CACHE_DIR, read_cache_file, write_cache_file
+
+CONSOLE_LOGGER = logging.getLogger("{}_user".format(__name__))
+
+SCIENCE_DATA_ROOT = "/home/archive/science-data"
+TEST_DATA_ROOT = "/home/archive/test-data"
+SESSION_INDEX_FORMAT_VERSION = 1
+
+
+def parse_naive_utc(date_str):
+    """Parse the given string into a naive datetime, in UTC"""
+
+    time = dp.parse(date_str)
+    if time.tzinfo:
+        time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return time
+
+
+def parse_scan_times(scanlog_path):
+    """Return the sorted, unique scan start times in the given ScanLog
+
+    Times are returned as timezone-aware (UTC) datetimes"""
+
+    # astropy is slow to import, and only needed here
+    from astropy.io import fits
+
+    with fits.open(scanlog_path) as scanlog:
+        # The first column is DATE-OBS, which is repeated for every row of a scan
+        date_strs = np.unique(np.asarray(scanlog[1].data.field(0), dtype=str))
+
+    try:
+        # DATE-OBS should be ISO 8601, which numpy can parse all at once
+        naive_times = date_strs.astype("datetime64[us]").astype(datetime.datetime)
+    except ValueError:
+        CONSOLE_LOGGER.debug(
+            "Could not parse times in %s as ISO 8601; parsing individually",
+            scanlog_path,
+        )
+        naive_times = [parse_naive_utc(date_str) for date_str in date_strs]
+
+    return sorted(
+        set(time.replace(tzinfo=datetime.timezone.utc) for time in naive_times)
+    )
+
+
+class SessionIndex:
+    def __init__(self, root, path=None):
+        self.root = root
+        if path:
+            self.path = path
+        else:
+            digest = hashlib.md5(root.encode()).hexdigest()[:12]
+            self.path = os.path.join(CACHE_DIR, "sessions.{}.pickle".format(digest))
+        # Maps directory path to its mtime as of its last listing
+        self.dirs = {}
+        # Maps session name to a dict of {"path", "mtime", "scan_times"}. Note
+        # that mtime/scan_times are None until the ScanLog is first read
+        self.sessions = {}
+        self.dirty = False
+
+        cached = read_cache_file(self.path, SESSION_INDEX_FORMAT_VERSION)
+        if cached:
+            self.dirs = cached["dirs"]
+            self.sessions = cached["sessions"]
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        if write_cache_file(
+            self.path,
+            {
+                "version": SESSION_INDEX_FORMAT_VERSION,
+                "dirs": self.dirs,
+                "sessions": self.sessions,
+            },
+        ):
+            self.dirty = False
+
+    def _list_dir(self, dir_path):
+        """Add every session within the given directory to the index"""
+
+        try:
+            entries = list(os.scandir(dir_path))
+        except OSError as error:
+            CONSOLE_LOGGER.debug("Could not list %s: %s", dir_path, error)
+            return
+
+        for entry in entries:
+            scanlog_path = os.path.join(entry.path, "ScanLog.fits")
+            if entry.is_dir() and os.path.isfile(scanlog_path):
+                session = self.sessions.get(entry.name)
+                if session is None or session["path"] != scanlog_path:
+                    self.sessions[entry.name] = {
+                        "path": scanlog_path,
+                        "mtime": None,
+                        "scan_times": None,
+                    }
+
+    def update(self, full=False):
+        """Walk the archive, re-listing only new or changed directories
+
+        If full is given, all directories are re-listed"""
+
+        try:
+            entries = [entry for entry in os.scandir(self.root) if entry.is_dir()]
+        except OSError as error:
+            CONSOLE_LOGGER.debug("Could not list %s: %s", self.root, error)
+            return
+
+        for entry in entries:
+            mtime = entry.stat().st_mtime
+            if full or self.dirs.get(entry.path) != mtime:
+                CONSOLE_LOGGER.debug("Indexing sessions in %s", entry.path)
+                self._list_dir(entry.path)
+                self.dirs[entry.path] = mtime
+                self.dirty = True
+
+        # Forget about anything that has since been removed from the archive
+        removed = set(self.dirs).difference(entry.path for entry in entries)
+        for dir_path in removed:
+            del self.dirs[dir_path]
+        if removed:
+            self.sessions = {
+                name: session
+                for name, session in self.sessions.items()
+                if os.path.dirname(os.path.dirname(session["path"])) not in removed
+            }
+            self.dirty = True
+        self.save()
+
+    def get_scanlog_path(self, session_name):
+        """Return the path to the ScanLog of the given session, or None"""
+
+        if session_name not in self.sessions:
+            self.update()
+        if session_name not in self.sessions:
+            # A ScanLog may have been written to an existing session directory,
+            # which doesn't change the mtime of its parent
+            self.update(full=True)
+        session = self.sessions.get(session_name)
+        return session["path"] if session else None
+
+    def scan_times(self, session_name):
+        """Return the sorted scan start times of the given session
+
+        If the session can't be found, or its ScanLog can't be read, return None"""
+
+        scanlog_path = self.get_scanlog_path(session_name)
+        if not scanlog_path:
+            return None
+
+        session = self.sessions[session_name]
+        try:
+            mtime = os.stat(scanlog_path).st_mtime
+            if session["mtime"] != mtime:
+                CONSOLE_LOGGER.debug("Reading scan times from %s", scanlog_path)
+                session["scan_times"] = parse_scan_times(scanlog_path)
+                session["mtime"] = mtime
+                self.dirty = True
+                self.save()
+        except (OSError, ValueError, KeyError, IndexError) as error:
+            CONSOLE_LOGGER.debug("Could not read %s: %s", scanlog_path, error)
+            return None
+
+        return session["scan_times"]
+
+
+_SESSION_INDEXES = {}
+
+
+def get_session_index(root):
+    """Return the (process-wide) SessionIndex for the given archive root"""
+
+    if root not in _SESSION_INDEXES:
+        _SESSION_INDEXES[root] = SessionIndex(root)
+    return _SESSION_INDEXES[root]
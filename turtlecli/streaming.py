@@ -0,0 +1,133 @@
+"""Streaming of large History results with bounded memory
+
+By default, MySQLdb buffers the entire result set of a query in the client
+before returning a single row -- even when using QuerySet.iterator(). For
+results that include logs, that can be many GB. On MySQL, rows are instead
+streamed through an unbuffered server-side cursor (SSCursor), in chunks. An
+SSCursor ties up its connection until every row has been read, so it is
+given a connection of its own. Like any other, that connection gets the
+execute wrappers of turtlecli (see turtlecli.temptables and
+turtlecli.profiling) when it is created. On other backends, QuerySet.iterator() is used
+(which already streams on e.g. SQLite and PostgreSQL).
+"""
+
+import logging
+import sys
+import time
+
+from django.db import connections
+from django.db.utils import load_backend
+
+logger = logging.getLogger(__name__)
+
+# Number of rows fetched from the DB at a time
+STREAM_CHUNK_SIZE = 100
+# Minimum number of seconds between progress updates
+PROGRESS_INTERVAL = 0.5
+
+
+def _stream_mysql(queryset, fields, chunk_size):
+    from MySQLdb.cursors import SSCursor
+
+    settings_dict = connections[queryset.db].settings_dict
+    connection = load_backend(settings_dict["ENGINE"]).DatabaseWrapper(
+        settings_dict, queryset.db
+    )
+    try:
+        connection.ensure_connection()
+        query = queryset.values(*fields).query
+        compiler = query.get_compiler(connection=connection)
+        sql, params = compiler.as_sql()
+        # Annotations are selected after fields, regardless of the given order
+        names = (
+            list(query.extra_select)
+            + list(query.values_select)
+            + list(query.annotation_select)
+        )
+        # Wrapped like any other cursor of the connection, so that its
+        # execute wrappers (e.g. which create the temporary tables the query
+        # uses) are applied
+        raw_cursor = connection.connection.cursor(SSCursor)
+        cursor = (
+            connection.make_debug_cursor(raw_cursor)
+            if connection.queries_logged
+            else connection.make_cursor(raw_cursor)
+        )
+        try:
+            cursor.execute(sql, params)
+            chunks = iter(lambda: cursor.fetchmany(chunk_size) or None, None)
+            # This applies the same conversions (e.g. to timezone-aware
+            # datetimes) as the ORM would
+            for row in compiler.results_iter(results=chunks):
+                yield dict(zip(names, row))
+        finally:
+            cursor.close()
+    finally:
+        connection.close()
+
+
+def stream_values(queryset, fields, chunk_size=None):
+    """Generate a dict of the given fields for every result of the given QuerySet
+
+    Only chunk_size rows are held in memory at a time"""
+
+    chunk_size = chunk_size if chunk_size else STREAM_CHUNK_SIZE
+    if connections[queryset.db].vendor == "mysql":
+        logger.debug("Streaming results via a server-side cursor")
+        return _stream_mysql(queryset, fields, chunk_size)
+    return queryset.values(*fields).iterator(chunk_size=chunk_size)
+
+
+class StreamedValues:
+    """A re-iterable stream of the given fields of the given QuerySet
+
+    Unlike a QuerySet, results aren't cached: each iteration re-runs the query"""
+
+    def __init__(self, queryset, fields, chunk_size=None):
+        self.queryset = queryset
+        self.fields = fields
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        return iter(stream_values(self.queryset, self.fields, self.chunk_size))
+
+
+def format_bytes(num_bytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if num_bytes < 1024 or unit == "GB":
+            break
+        num_bytes /= 1024
+    return "{:.1f} {}".format(num_bytes, unit)
+
+
+def with_progress(rows, description="Processed", stream=None):
+    """Pass through the given (dict) rows, reporting the number of rows and bytes
+
+    Progress is written to stderr, if it is a terminal. Bytes are those of
+    the string values of each row"""
+
+    stream = stream if stream else sys.stderr
+    if not stream.isatty():
+        yield from rows
+        return
+
+    num_rows = 0
+    num_bytes = 0
+    last_update = 0
+    for row in rows:
+        num_rows += 1
+        num_bytes += sum(len(value) for value in row.values() if isinstance(value, str))
+        now = time.monotonic()
+        if now - last_update > PROGRESS_INTERVAL:
+            stream.write(
+                "\r{} {} rows ({})".format(
+                    description, num_rows, format_bytes(num_bytes)
+                )
+            )
+            stream.flush()
+            last_update = now
+        yield row
+    stream.write(
+        "\r{} {} rows ({})\n".format(description, num_rows, format_bytes(num_bytes))
+    )
+    stream.flush()
@@ -0,0 +1,147 @@
+"""Temporary tables, for sending large sets of values to the DB
+
+Long lists of values (e.g. thousands of History IDs, or time intervals) can't
+be sent inline in a query: SQLite limits the number of parameters of a
+statement, and MySQL the size of a packet. They are instead inserted into a
+temporary table, which the query joins against. Temporary tables only live as
+long as the DB connection that created them, and are only visible to it.
+
+Queries are also run on other connections, though (e.g. those of the worker
+threads of a QueryExecutor). So the definition of every temporary table is
+kept, and a TempTableCreator on every connection creates any that a statement
+uses, but that don't yet exist on that connection, before executing it.
+"""
+
+import itertools
+import logging
+import re
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.db.models.expressions import RawSQL
+
+from turtlecli.cache import get_db_alias
+
+logger = logging.getLogger(__name__)
+
+# Above this many values, an __in lookup is made via a temporary table (see
+# max_in_list_size, which may lower this)
+MAX_IN_LIST_SIZE = 10000
+
+_temp_table_counter = itertools.count()
+# Matches the names given to temporary tables by create_temp_table
+TEMP_TABLE_NAME_REGEX = re.compile(r"\bturtlecli_[a-z]+_\d+\b")
+# The temporary tables created so far, by name: (DB alias, columns, rows)
+_TEMP_TABLES = {}
+
+
+class RawSubquery(RawSQL):
+    """A raw SQL subquery, for use as the right-hand side of an __in lookup
+
+    Unlike RawSQL, this isn't wrapped in parentheses (the lookup already does
+    that); otherwise the DB treats it as a scalar subquery"""
+
+    def as_sql(self, compiler, connection):
+        return self.sql, self.params
+
+
+def max_in_list_size(using=None):
+    """Return the largest number of values that should be sent in an __in lookup"""
+
+    max_query_params = connections[get_db_alias(using)].features.max_query_params
+    if not max_query_params:
+        return MAX_IN_LIST_SIZE
+    # Leave room for the parameters of the rest of the query
+    return min(MAX_IN_LIST_SIZE, max_query_params // 2)
+
+
+class TempTableCreator:
+    """An execute wrapper that creates the temporary tables a statement uses, if
+    they don't yet exist on the connection it is executed on"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        # The names of the temporary tables that exist on the connection
+        self.created = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        for table_name in set(TEMP_TABLE_NAME_REGEX.findall(sql)) - self.created:
+            # Marked first, since creating the table executes statements, too
+            self.created.add(table_name)
+            if table_name in _TEMP_TABLES:
+                alias, columns, rows = _TEMP_TABLES[table_name]
+                if alias == self.connection.alias:
+                    logger.debug(
+                        "Re-creating temporary table %s on another connection",
+                        table_name,
+                    )
+                    _create_temp_table(self.connection, table_name, columns, rows)
+        return execute(sql, params, many, context)
+
+
+def get_temp_table_creator(connection):
+    """Return the TempTableCreator of the given connection, installing one if needed"""
+
+    for wrapper in connection.execute_wrappers:
+        if isinstance(wrapper, TempTableCreator):
+            return wrapper
+    creator = TempTableCreator(connection)
+    connection.execute_wrappers.append(creator)
+    return creator
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    # None of the temporary tables exist on a new connection (even if it
+    # replaces a closed one of the same DatabaseWrapper)
+    connection.execute_wrappers[:] = [
+        wrapper
+        for wrapper in connection.execute_wrappers
+        if not isinstance(wrapper, TempTableCreator)
+    ]
+    get_temp_table_creator(connection)
+
+
+connection_created.connect(_on_connection_created)
+
+
+def clear_temp_tables():
+    """Forget the temporary tables created so far
+
+    They are no longer re-created on other connections"""
+
+    _TEMP_TABLES.clear()
+
+
+def _create_temp_table(connection, table_name, columns, rows):
+    quoted_name = connection.ops.quote_name(table_name)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMPORARY TABLE {} ({})".format(quoted_name, ", ".join(columns))
+        )
+        cursor.executemany(
+            "INSERT INTO {} VALUES ({})".format(
+                quoted_name, ", ".join(["%s"] * len(columns))
+            ),
+            rows,
+        )
+    logger.debug("Inserted %s rows into temporary table %s", len(rows), table_name)
+
+
+def create_temp_table(prefix, columns, rows, using=None):
+    """Create a temporary table, insert the given rows into it, and return its name
+
+    columns is a list of column definitions, e.g. ["id INTEGER NOT NULL"],
+    and rows a list of tuples of values (already adapted for the DB). The table
+    is also created on any other connection to the DB whose queries use it"""
+
+    using = get_db_alias(using)
+    connection = connections[using]
+    table_name = "turtlecli_{}_{}".format(prefix, next(_temp_table_counter))
+    rows = list(rows)
+    _TEMP_TABLES[table_name] = (using, columns, rows)
+    # Connecting replaces the connection's TempTableCreator, so that must be
+    # done before the table is marked as created on it
+    connection.ensure_connection()
+    get_temp_table_creator(connection).created.add(table_name)
+    _create_temp_table(connection, table_name, columns, rows)
+    return table_name
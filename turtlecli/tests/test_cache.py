@@ -0,0 +1,37 @@
+import os
+from unittest import mock
+
+from django.test import TestCase
+
+from turtlecli.cache import get_dimension_cache
+from turtlecli.tests.utils import TortoiseTablesMixin, create_history
+
+
+class DimensionCacheTestCase(TortoiseTablesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.history = create_history()
+        self.dimensions = get_dimension_cache()
+
+    def test_misses(self):
+        procedure_id = self.history.obsprocedure_id
+        # The rows are fetched once, and saved once the run is finished
+        with mock.patch("turtlecli.cache.write_cache_file") as write_cache_file:
+            with self.assertNumQueries(1):
+                self.assertEqual(
+                    self.dimensions.procedure_name(procedure_id), "mapping"
+                )
+            # e.g. the procedures of orphaned History rows. Only the first miss
+            # refreshes the cache
+            with self.assertNumQueries(1):
+                for missing_id in range(procedure_id + 1, procedure_id + 50):
+                    self.assertIsNone(self.dimensions.procedure_name(missing_id))
+            write_cache_file.assert_not_called()
+        self.dimensions.finish()
+        self.assertTrue(os.path.exists(self.dimensions.path))
+
+        # The next run refreshes on a miss again, and so finds new rows
+        new_id = create_history(script_name="pointing").obsprocedure_id
+        with self.assertNumQueries(1):
+            self.assertEqual(self.dimensions.procedure_name(new_id), "pointing")
+            self.assertIsNone(self.dimensions.procedure_name(new_id + 1))
@@ -0,0 +1,43 @@
+from django.db import connection
+from django.test import TestCase
+
+from tortoise.models import History
+from turtlecli.dedup import ScriptContents, with_script_hash
+from turtlecli.tests.utils import (
+    MAX_VARIABLE_NUMBER,
+    TortoiseTablesMixin,
+    create_history,
+    limit_variables,
+)
+
+
+class ScriptContentsTestCase(TortoiseTablesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        history = create_history(executed_script="tint = 0")
+        # More distinct scripts than can be fetched by an inline list of IDs
+        History.objects.bulk_create(
+            [
+                History(
+                    obsprocedure_id=history.obsprocedure_id,
+                    observer_id=history.observer_id,
+                    operator_id=history.operator_id,
+                    datetime=history.datetime,
+                    version="1",
+                    executed_script="tint = {}".format(
+                        num % (MAX_VARIABLE_NUMBER + 200)
+                    ),
+                    executed_state="obs_completed",
+                )
+                for num in range(1, MAX_VARIABLE_NUMBER + 500)
+            ]
+        )
+        limit_variables(connection)
+
+    def test_for_results(self):
+        scripts = ScriptContents.for_results(History.objects.all())
+        self.assertEqual(len(scripts), MAX_VARIABLE_NUMBER + 200)
+        for row in with_script_hash(History.objects.all()).values(
+            "id", "executed_script", "script_hash"
+        ):
+            self.assertEqual(scripts.get(row["script_hash"]), row["executed_script"])
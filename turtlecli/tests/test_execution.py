@@ -0,0 +1,106 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from tortoise.models import History
+from turtlecli import execution
+from turtlecli.cli import parse_args
+from turtlecli.execution import ExecutedQuery, QueryExecutor
+from turtlecli.intervals import MAX_OR_RANGES
+from turtlecli.query import compile_query
+from turtlecli.tests.utils import (
+    MAX_VARIABLE_NUMBER,
+    TortoiseTablesMixin,
+    create_history,
+    limit_variables,
+)
+from turtlecli.utils import HISTORY_TABLE_ID_FIELDNAMES
+
+NUM_TIMES = MAX_OR_RANGES + 50
+
+
+class ExecutedQueryTestCase(TortoiseTablesMixin, TransactionTestCase):
+    # The worker threads' connections must see the rows, so these can't be
+    # created inside a (TestCase) transaction
+
+    def setUp(self):
+        super().setUp()
+        start = timezone.now().replace(microsecond=0) - timedelta(days=30)
+        self.times = [start + timedelta(hours=hours) for hours in range(NUM_TIMES)]
+        for time in self.times:
+            create_history(datetime=time)
+            # Outside of every window
+            create_history(datetime=time + timedelta(minutes=30))
+        self.addCleanup(History.objects.all().delete)
+
+        self.executor = QueryExecutor(jobs=4)
+        self.addCleanup(self.executor.shutdown)
+
+    def execute(self, limit):
+        # More windows than are ORed together, so they are sent via a
+        # temporary table (on the main thread's connection)
+        args = parse_args(
+            ["--times", *[time.isoformat() for time in self.times]]
+            + ["-B", "1", "-u", "minutes", "-L", str(limit)]
+        )
+        query, __ = compile_query(args)
+        return ExecutedQuery(
+            History.objects.filter(query).order_by("datetime", "id"),
+            args.limit,
+            HISTORY_TABLE_ID_FIELDNAMES,
+            executor=self.executor,
+        )
+
+    def test_count_on_worker(self):
+        executed = self.execute(limit=3)
+        self.assertTrue(executed.truncated)
+        self.assertEqual(len(executed), 3)
+        self.assertEqual(executed.count, NUM_TIMES)
+
+    def test_no_count_unless_truncated(self):
+        executed = self.execute(limit=NUM_TIMES)
+        self.assertFalse(executed.truncated)
+        self.assertIsNone(executed.count_future)
+        self.assertEqual(executed.count, NUM_TIMES)
+
+    def test_results_rerun_on_worker(self):
+        executed = self.execute(limit=0)
+        with mock.patch.object(execution, "MAX_ID_LIST_SIZE", 10):
+            results = executed.results
+        self.assertEqual(
+            self.executor.submit(
+                lambda: [history.datetime for history in results]
+            ).result(),
+            self.times,
+        )
+
+
+class ExecutedQueryResultsTestCase(TortoiseTablesMixin, TestCase):
+    def test_results_by_ids(self):
+        history = create_history()
+        # More results than can be selected by an inline list of IDs
+        History.objects.bulk_create(
+            [
+                History(
+                    obsprocedure_id=history.obsprocedure_id,
+                    observer_id=history.observer_id,
+                    operator_id=history.operator_id,
+                    datetime=history.datetime,
+                    version="1",
+                    executed_state="obs_completed",
+                )
+                for __ in range(MAX_VARIABLE_NUMBER + 200)
+            ]
+        )
+        limit_variables(connection)
+
+        executed = ExecutedQuery(
+            History.objects.order_by("-id"), 0, HISTORY_TABLE_ID_FIELDNAMES
+        )
+        self.assertEqual(
+            [history.id for history in executed.results],
+            list(History.objects.order_by("-id").values_list("id", flat=True)),
+        )
@@ -0,0 +1,44 @@
+from django.test import TestCase
+
+from tortoise.models import History
+from turtlecli.filters import filterByIds
+from turtlecli.temptables import max_in_list_size
+from turtlecli.tests.utils import TortoiseTablesMixin, create_history
+
+
+class FilterByIdsTestCase(TortoiseTablesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        history = create_history()
+        rows = [
+            History(
+                obsprocedure_id=history.obsprocedure_id,
+                observer_id=history.observer_id,
+                operator_id=history.operator_id,
+                datetime=history.datetime,
+                version=history.version,
+            )
+            for __ in range(max_in_list_size() * 2)
+        ]
+        History.objects.bulk_create(rows)
+        self.ids = sorted(History.objects.values_list("id", flat=True))
+
+    def test_few_ids(self):
+        ids = self.ids[:10]
+        self.assertEqual(
+            sorted(
+                History.objects.filter(filterByIds(ids)).values_list("id", flat=True)
+            ),
+            ids,
+        )
+
+    def test_many_ids(self):
+        # More than can be sent inline (as parameters), plus some that don't exist
+        ids = self.ids[1:] + [self.ids[-1] + 1, self.ids[-1] + 2]
+        self.assertGreater(len(ids), max_in_list_size())
+        query = filterByIds(set(ids))
+        self.assertIn("turtlecli_ids", str(query))
+        self.assertEqual(
+            sorted(History.objects.filter(query).values_list("id", flat=True)),
+            self.ids[1:],
+        )
@@ -0,0 +1,258 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from tortoise.models import History
+from turtlecli.archive import Archive
+from turtlecli.gitify import (
+    UNKNOWN_PROJECT_NAME,
+    UNKNOWN_SCRIPT_NAME,
+    GitifyError,
+    MANIFEST_FILE_NAME,
+    get_log_file_name,
+    get_script_file_name,
+    gitify,
+    gitify_by_project,
+    group_procedure_ids_by_project,
+)
+from turtlecli.intervals import MAX_OR_RANGES, filterByIntervals
+from turtlecli.tests.utils import TortoiseTablesMixin, create_history
+
+GIT_ENVIRON = {
+    "GIT_AUTHOR_NAME": "Test",
+    "GIT_AUTHOR_EMAIL": "test@example.com",
+    "GIT_COMMITTER_NAME": "Test",
+    "GIT_COMMITTER_EMAIL": "test@example.com",
+    # Quiets git init's hint about the name of the initial branch
+    "GIT_CONFIG_COUNT": "1",
+    "GIT_CONFIG_KEY_0": "init.defaultBranch",
+    "GIT_CONFIG_VALUE_0": "master",
+}
+
+
+class GitifyTestCase(TortoiseTablesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(os.environ, GIT_ENVIRON)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output)
+
+        self.start = timezone.now() - timedelta(days=1)
+        create_history(datetime=self.start, executed_script="tint = 1")
+        create_history(
+            script_name="pointing",
+            datetime=self.start + timedelta(hours=1),
+            executed_script="Peak()",
+        )
+        self.mapping_path = os.path.join(
+            self.output, get_script_file_name("AGBT19A_453", "mapping")
+        )
+        self.pointing_path = os.path.join(
+            self.output, get_script_file_name("AGBT19A_453", "pointing")
+        )
+
+    def git(self, *args):
+        return subprocess.check_output(["git", *args], cwd=self.output).decode()
+
+    def read(self, path):
+        with open(path) as file:
+            return file.read()
+
+    def write(self, path, text):
+        with open(path, "w") as file:
+            file.write(text)
+
+    def test_gitify(self):
+        summary = gitify(History.objects.all(), self.output, progress=False)
+        self.assertEqual(summary["num_commits"], 2)
+        self.assertEqual(self.read(self.mapping_path), "tint = 1")
+        self.assertEqual(self.read(self.pointing_path), "Peak()")
+        self.assertEqual(self.git("status", "--porcelain"), "")
+
+        # Only new executions are exported, and only the files they change
+        # are updated (untracked files are left alone)
+        self.write(os.path.join(self.output, "notes.txt"), "notes")
+        create_history(
+            datetime=self.start + timedelta(hours=2), executed_script="tint = 2"
+        )
+        summary = gitify(History.objects.all(), self.output, progress=False)
+        self.assertEqual(summary["num_commits"], 1)
+        self.assertEqual(self.read(self.mapping_path), "tint = 2")
+        self.assertEqual(self.git("status", "--porcelain"), "?? notes.txt\n")
+
+    def test_gitify_uncommitted_changes(self):
+        gitify(History.objects.all(), self.output, progress=False)
+        create_history(
+            datetime=self.start + timedelta(hours=2), executed_script="tint = 2"
+        )
+        head = self.git("rev-parse", "HEAD")
+
+        # Neither unstaged nor staged changes are overwritten
+        self.write(self.pointing_path, "Peak(); Focus()")
+        with self.assertRaises(GitifyError):
+            gitify(History.objects.all(), self.output, progress=False)
+        self.git("add", self.pointing_path)
+        with self.assertRaises(GitifyError):
+            gitify(History.objects.all(), self.output, progress=False)
+
+        self.assertEqual(self.read(self.pointing_path), "Peak(); Focus()")
+        self.assertEqual(self.read(self.mapping_path), "tint = 1")
+        self.assertEqual(self.git("rev-parse", "HEAD"), head)
+
+    def test_gitify_archive(self):
+        History.objects.update(log="Slew")
+        archive_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_path)
+        archive = Archive(path=archive_path)
+        archive.update()
+        self.addCleanup(archive.close)
+        # So that logs read from the archive can be told apart
+        History.objects.update(log="Slew (from the DB)")
+        create_history(
+            datetime=self.start + timedelta(hours=2),
+            executed_script="tint = 2",
+            log="Track",
+        )
+
+        gitify(
+            History.objects.all(),
+            self.output,
+            include_log=True,
+            archive=archive,
+            progress=False,
+        )
+        self.assertEqual(
+            self.read(
+                os.path.join(self.output, get_log_file_name("AGBT19A_453", "pointing"))
+            ),
+            "Slew",
+        )
+        # Not in the archive
+        self.assertEqual(
+            self.read(
+                os.path.join(self.output, get_log_file_name("AGBT19A_453", "mapping"))
+            ),
+            "Track",
+        )
+
+    def test_gitify_orphan(self):
+        # e.g. the procedure was deleted (the DB doesn't enforce foreign keys)
+        orphan = create_history(
+            script_name="gone",
+            datetime=self.start + timedelta(hours=2),
+            executed_script="Track()",
+        )
+        procedure_id = orphan.obsprocedure_id + 1000
+        History.objects.filter(id=orphan.id).update(obsprocedure_id=procedure_id)
+        # Before the test's constraints are checked
+        self.addCleanup(History.objects.filter(id=orphan.id).delete)
+
+        summary = gitify(History.objects.all(), self.output, progress=False)
+        self.assertEqual(summary["num_commits"], 3)
+        orphan_path = os.path.join(
+            self.output,
+            get_script_file_name(
+                UNKNOWN_PROJECT_NAME, UNKNOWN_SCRIPT_NAME.format(procedure_id)
+            ),
+        )
+        self.assertEqual(self.read(orphan_path), "Track()")
+
+
+class GroupProcedureIdsByProjectTestCase(TortoiseTablesMixin, TestCase):
+    def test_group_procedure_ids_by_project(self):
+        mapping = create_history()
+        pointing = create_history(script_name="pointing")
+        other = create_history(project_name="AGBT18B_001")
+        # e.g. the procedure was deleted (the DB doesn't enforce foreign keys)
+        orphan = History.objects.filter(id=create_history(script_name="gone").id)
+        orphan.update(obsprocedure_id=other.obsprocedure_id + 1000)
+        # Before the test's constraints are checked
+        self.addCleanup(orphan.delete)
+
+        procedure_ids_by_project = group_procedure_ids_by_project(History.objects.all())
+        self.assertCountEqual(
+            procedure_ids_by_project.pop("AGBT19A_453"),
+            [mapping.obsprocedure_id, pointing.obsprocedure_id],
+        )
+        self.assertEqual(
+            procedure_ids_by_project,
+            {
+                "AGBT18B_001": [other.obsprocedure_id],
+                UNKNOWN_PROJECT_NAME: [other.obsprocedure_id + 1000],
+            },
+        )
+
+
+class GitifyByProjectTestCase(TortoiseTablesMixin, TransactionTestCase):
+    # The workers' connections must see the rows, so these can't be created
+    # inside a (TestCase) transaction
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(os.environ, GIT_ENVIRON)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output)
+        self.addCleanup(History.objects.all().delete)
+
+        start = timezone.now().replace(microsecond=0) - timedelta(days=1)
+        self.times = [
+            start + timedelta(minutes=minutes) for minutes in range(0, 1500, 5)
+        ]
+        for num, time in enumerate(self.times):
+            create_history(
+                project_name="AGBT19A_453" if num // 2 % 2 else "AGBT18B_001",
+                datetime=time,
+                executed_script="tint = {}".format(num),
+            )
+
+    def test_gitify_by_project(self):
+        # More intervals than are ORed together, so the results are selected
+        # via a temporary table (which the workers must re-create)
+        times = self.times[::2]
+        self.assertGreater(len(times), MAX_OR_RANGES)
+        orphan = create_history(datetime=times[0], executed_script="Track()")
+        # Not in a transaction, so the constraint would be checked immediately
+        with connection.constraint_checks_disabled():
+            History.objects.filter(id=orphan.id).update(
+                obsprocedure_id=orphan.obsprocedure_id + 1000
+            )
+        results = History.objects.filter(
+            filterByIntervals([(time, time) for time in times])
+        )
+        # Only the Query is sent to the workers; pickling the QuerySet would
+        # fetch all of the results
+        with mock.patch.object(QuerySet, "__getstate__", side_effect=AssertionError):
+            gitify_by_project(results, self.output, jobs=2)
+
+        with open(os.path.join(self.output, MANIFEST_FILE_NAME)) as file:
+            manifest = json.load(file)
+        num_commits = {
+            project_name: int(
+                subprocess.check_output(
+                    ["git", "rev-list", "--count", "HEAD"],
+                    cwd=os.path.join(self.output, project_name),
+                )
+            )
+            for project_name in manifest["projects"]
+        }
+        self.assertEqual(
+            num_commits,
+            {
+                "AGBT18B_001": len(times) / 2,
+                "AGBT19A_453": len(times) / 2,
+                UNKNOWN_PROJECT_NAME: 1,
+            },
+        )
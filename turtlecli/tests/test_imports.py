@@ -0,0 +1,72 @@
+import os
+import subprocess
+import sys
+import unittest
+
+from django.test import SimpleTestCase
+
+# Modules that are slow to import, and only needed by some options, so must not
+# be imported at startup
+DEFERRED_MODULES = ("IPython", "astropy", "pygments", "sqlparse", "zstandard")
+# The most (cumulative) time that importing turtlecli.cli may take, after
+# django.setup(), in seconds
+IMPORT_TIME_BUDGET = 0.3
+
+# Imports turtlecli as bin/turtlecli does, with turtle_orm.cli_settings. The
+# turtle_orm.settings that those extend is deployment-specific, so the test
+# settings stand in for it
+STARTUP_SCRIPT = """
+import importlib
+import sys
+
+sys.modules["turtle_orm.settings"] = importlib.import_module("turtle_orm.test_settings")
+
+import django
+
+django.setup()
+
+import turtlecli.cli
+
+print(" ".join(name for name in {deferred_modules!r} if name in sys.modules))
+"""
+
+
+@unittest.skipUnless(sys.version_info >= (3, 7), "-X importtime requires Python 3.7")
+class ImportTestCase(SimpleTestCase):
+    def import_cli(self):
+        """Import turtlecli.cli in a new interpreter
+
+        Return the deferred modules that were imported, and a dict mapping the
+        name of each imported module to its cumulative import time (in seconds)"""
+
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE="turtle_orm.cli_settings")
+        process = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                STARTUP_SCRIPT.format(deferred_modules=DEFERRED_MODULES),
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            env=env,
+            check=True,
+        )
+        import_times = {}
+        for line in process.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if line.startswith("import time:") and "|" in line:
+                __, cumulative, name = line.split("|")
+                if cumulative.strip().isdigit():
+                    import_times[name.strip()] = int(cumulative) / 1e6
+        return process.stdout.split(), import_times
+
+    def test_startup_imports(self):
+        # Once to compile the bytecode of any changed modules, which would
+        # otherwise count towards the budget
+        self.import_cli()
+        imported, import_times = self.import_cli()
+        self.assertEqual(imported, [])
+        self.assertLess(import_times["turtlecli.cli"], IMPORT_TIME_BUDGET)
@@ -0,0 +1,30 @@
+from django.test import SimpleTestCase
+
+from turtlecli.projects import ProjectIndex, build_project_keys
+
+PROJECT_NAMES = {
+    1: "AGBT19A_453",
+    2: "AGBT19A_001",
+    3: "AGBT18B_453",
+    4: "TGBT19A_453",
+    5: "TINT",
+}
+
+
+class ProjectIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        self.index = ProjectIndex(PROJECT_NAMES, build_project_keys(PROJECT_NAMES))
+
+    def test_exact_key(self):
+        self.assertCountEqual(self.index.lookup("GBT19A453"), [1, 4])
+        self.assertCountEqual(self.index.lookup("agbt2019a-0453"), [1])
+        self.assertCountEqual(self.index.lookup("TGBT19A_453"), [4])
+
+    def test_partial_name(self):
+        self.assertCountEqual(self.index.lookup("AGBT19A"), [1, 2])
+        self.assertCountEqual(self.index.lookup("19A453"), [1, 4])
+        self.assertCountEqual(self.index.lookup("GBT18B"), [3])
+
+    def test_no_match(self):
+        self.assertCountEqual(self.index.lookup("AGBT20A_999"), [])
+        self.assertCountEqual(self.index.lookup("TINT"), [])
@@ -0,0 +1,137 @@
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.db import connections, router
+from django.db.backends.signals import connection_created
+from django.test import TestCase
+
+from tortoise.models import History
+from turtlecli.cli import parse_args
+from turtlecli.query import compile_query
+from turtlecli.replica import (
+    REPLICA_ALIAS,
+    ReplicaRouter,
+    field_names,
+    get_replica_path,
+    register_replica,
+    sync,
+)
+from turtlecli.tests.utils import (
+    MAX_VARIABLE_NUMBER,
+    TortoiseTablesMixin,
+    create_history,
+    limit_variables,
+)
+
+
+class ReplicaTestCase(TortoiseTablesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.path = os.path.join(temp_dir, "replica.sqlite3")
+        register_replica(self.path)
+        self.addCleanup(self.unregister_replica)
+        connection_created.connect(self.limit_variables)
+        self.addCleanup(connection_created.disconnect, self.limit_variables)
+
+        create_history(log="the scan was aborted")
+        create_history(project_name="AGBT18B_001", log="Begin Scheduling Block")
+        self.in_progress = create_history(
+            project_name="AGBT18B_001", executed_state="obs_in_progess", log="Slew"
+        )
+        # More rows than can be deleted in a single statement (see limit_variables)
+        History.objects.bulk_create(
+            [
+                History(
+                    obsprocedure_id=self.in_progress.obsprocedure_id,
+                    observer_id=self.in_progress.observer_id,
+                    operator_id=self.in_progress.operator_id,
+                    datetime=self.in_progress.datetime,
+                    version="1",
+                    executed_state="obs_completed",
+                )
+                for __ in range(MAX_VARIABLE_NUMBER)
+            ]
+        )
+
+    @staticmethod
+    def limit_variables(sender, connection, **kwargs):
+        if connection.alias == REPLICA_ALIAS:
+            limit_variables(connection)
+
+    @staticmethod
+    def stop_using_replica():
+        router.routers[:] = [
+            router_
+            for router_ in router.routers
+            if not isinstance(router_, ReplicaRouter)
+        ]
+
+    def unregister_replica(self):
+        self.stop_using_replica()
+        connections[REPLICA_ALIAS].close()
+        del connections[REPLICA_ALIAS]
+        del connections.databases[REPLICA_ALIAS]
+
+    def assertSameRows(self, argv):
+        """Assert that the given turtlecli query returns the same rows with --local"""
+
+        def query_rows(argv):
+            query, __ = compile_query(parse_args(argv))
+            return list(
+                History.objects.filter(query)
+                .order_by("id")
+                .values_list(*field_names(History))
+            )
+
+        rows = query_rows(argv)
+        try:
+            self.assertEqual(
+                query_rows(argv + ["--local", "--replica-path", self.path]), rows
+            )
+        finally:
+            self.stop_using_replica()
+        return rows
+
+    def test_sync(self):
+        sync(path=self.path)
+        self.assertEqual(
+            len(self.assertSameRows(["--last", "1"])), History.objects.count()
+        )
+
+        # In-progress rows are re-synced, along with new ones
+        History.objects.filter(id=self.in_progress.id).update(
+            executed_state="obs_completed", log="Slew\nthe scan was aborted"
+        )
+        create_history(log="the scan was aborted again")
+        sync(path=self.path)
+        self.assertEqual(
+            len(self.assertSameRows(["--log-contains", "aborted", "--last", "1"])), 3
+        )
+
+    def test_sync_full(self):
+        sync(path=self.path)
+        History.objects.filter(id=self.in_progress.id).delete()
+        sync(full=True, path=self.path)
+        self.assertSameRows(["-p", "AGBT18B_001", "--last", "1"])
+
+    def test_replica_path(self):
+        sync(path=self.path)
+        self.assertSameRows(["--last", "1"])
+
+        # The default replica was never synced
+        with mock.patch("sys.stderr", io.StringIO()) as stderr:
+            with self.assertRaises(SystemExit):
+                parse_args(["--last", "1", "--local"])
+        self.assertIn(get_replica_path(), stderr.getvalue())
+        self.assertEqual(
+            connections.databases[REPLICA_ALIAS]["NAME"], get_replica_path()
+        )
+
+        with mock.patch("sys.stderr", io.StringIO()):
+            with self.assertRaises(SystemExit):
+                parse_args(["--last", "1", "--replica-path", self.path])
@@ -0,0 +1,99 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+
+from tortoise.models import History, ObsProcedure
+from turtlecli.reports import MIN_POOL_DIFFS, DiffReport
+from turtlecli.tests.utils import (
+    MAX_VARIABLE_NUMBER,
+    TortoiseTablesMixin,
+    create_history,
+    limit_variables,
+)
+from turtlecli.utils import diff_scripts
+
+
+class DiffReportTestCase(TortoiseTablesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        start = timezone.now() - timedelta(days=1)
+        for num in range(MIN_POOL_DIFFS):
+            script_name = "script{}".format(num)
+            for version in range(3):
+                create_history(
+                    script_name=script_name,
+                    datetime=start + timedelta(minutes=version),
+                    executed_script="tint = {}\nscans = {}".format(version, num),
+                )
+
+    def test_diffs(self):
+        report = DiffReport(History.objects.all())
+        pairs = report.result_generator
+        self.assertEqual(len(pairs), MIN_POOL_DIFFS * 3)
+        # The first execution of each script has nothing to diff against
+        self.assertEqual(
+            sum(1 for previous, __ in pairs if previous is None), MIN_POOL_DIFFS
+        )
+        self.assertEqual(len(report.diffs), MIN_POOL_DIFFS * 2)
+        for (hash_a, hash_b), diff in report.diffs.items():
+            self.assertEqual(
+                diff,
+                diff_scripts(report.scripts.get(hash_a), report.scripts.get(hash_b)),
+            )
+
+    def test_diffs_in_pool_from_thread(self):
+        # As when the report is prefetched alongside the rendering of the table
+        report = DiffReport(History.objects.all())
+        report.jobs = 2
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            diffs = executor.submit(report.diff_pairs, report.diffs.keys()).result()
+        self.assertEqual(diffs, report.diffs)
+
+
+class DiffReportPreviousTestCase(TortoiseTablesMixin, TestCase):
+    def test_previous_not_in_results(self):
+        history = create_history(executed_script="tint = 0")
+        template = {
+            field.attname: getattr(history.obsprocedure, field.attname)
+            for field in ObsProcedure._meta.concrete_fields
+            if not field.primary_key
+        }
+        # More procedures (and so previous executions that aren't among the
+        # results) than can be fetched by an inline list of IDs
+        ObsProcedure.objects.bulk_create(
+            [
+                ObsProcedure(**dict(template, name="script{}".format(num)))
+                for num in range(MAX_VARIABLE_NUMBER + 200)
+            ]
+        )
+        procedure_ids = ObsProcedure.objects.exclude(
+            id=history.obsprocedure_id
+        ).values_list("id", flat=True)
+        later = history.datetime + timedelta(minutes=1)
+        History.objects.bulk_create(
+            [
+                History(
+                    obsprocedure_id=procedure_id,
+                    observer_id=history.observer_id,
+                    operator_id=history.operator_id,
+                    datetime=datetime,
+                    version="1",
+                    executed_script="tint = {}".format(version),
+                    executed_state="obs_completed",
+                )
+                for procedure_id in procedure_ids
+                for version, datetime in enumerate([history.datetime, later])
+            ]
+        )
+        limit_variables(connection)
+
+        report = DiffReport(History.objects.filter(datetime=later))
+        pairs = report.result_generator
+        self.assertEqual(len(pairs), MAX_VARIABLE_NUMBER + 200)
+        for previous, result in pairs:
+            self.assertEqual(previous["obsprocedure_id"], result["obsprocedure_id"])
+            self.assertEqual(previous["datetime"], history.datetime)
+        self.assertEqual(len(report.diffs), 1)
@@ -0,0 +1,78 @@
+import ast
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from turtlecli import scriptkwargs
+from turtlecli.scriptkwargs import extract_kwargs
+
+SCRIPT = """
+tint = 40.96e-6
+offset = -2
+Track(src, beamName="1", flag=True)
+params = {"Receiver": "Rcvr1_2", "scans": 3}
+Configure('''
+receiver = 'Rcvr2_3'
+swper = 0.04 # seconds
+''')
+"""
+
+EXPECTED_KWARGS = {
+    ("tint", "4.096e-05"),
+    ("offset", "-2"),
+    ("beamname", "1"),
+    ("flag", "true"),
+    ("receiver", "rcvr1_2"),
+    ("scans", "3"),
+    ("receiver", "rcvr2_3"),
+    ("swper", "0.04"),
+}
+
+
+class LegacyStr(ast.expr):
+    _fields = ("s",)
+
+
+class LegacyNum(ast.expr):
+    _fields = ("n",)
+
+
+class LegacyNameConstant(ast.expr):
+    _fields = ("value",)
+
+
+def to_legacy(tree):
+    """Replace the ast.Constant nodes in tree by the node types of Python < 3.8"""
+
+    class Transformer(ast.NodeTransformer):
+        def visit_Constant(self, node):
+            if isinstance(node.value, str):
+                return LegacyStr(s=node.value)
+            if isinstance(node.value, (bool, type(None))):
+                return LegacyNameConstant(value=node.value)
+            return LegacyNum(n=node.value)
+
+    return Transformer().visit(tree)
+
+
+class ExtractKwargsTestCase(SimpleTestCase):
+    def test_extract_kwargs(self):
+        self.assertEqual(extract_kwargs(SCRIPT), EXPECTED_KWARGS)
+
+    def test_extract_kwargs_unparseable(self):
+        self.assertEqual(
+            extract_kwargs("receiver = 'Rcvr1_2'\nif x\ntint=1 # s"),
+            {("receiver", "rcvr1_2"), ("tint", "1")},
+        )
+
+    def test_extract_kwargs_legacy_nodes(self):
+        legacy_nodes = (
+            (LegacyStr, "s"),
+            (LegacyNum, "n"),
+            (LegacyNameConstant, "value"),
+        )
+        tree = to_legacy(ast.parse(SCRIPT))
+        with mock.patch.object(
+            scriptkwargs, "LEGACY_CONSTANT_NODES", legacy_nodes
+        ), mock.patch.object(scriptkwargs.ast, "parse", return_value=tree):
+            self.assertEqual(extract_kwargs(SCRIPT), EXPECTED_KWARGS)
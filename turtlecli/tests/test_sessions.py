@@ -0,0 +1,100 @@
+import datetime
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from turtlecli.sessions import SessionIndex, parse_scan_times
+
+# {root}/{directory}/{session}/ScanLog.fits, as in the real archive
+FIXTURE_ROOT = os.path.join(os.path.dirname(__file__), "fixtures", "science-data")
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc)
+
+
+class ParseScanTimesTestCase(SimpleTestCase):
+    def test_parse_scan_times(self):
+        # DATE-OBS is repeated for every row of a scan, and isn't in order
+        self.assertEqual(
+            parse_scan_times(
+                os.path.join(
+                    FIXTURE_ROOT, "AGBT19A_453", "AGBT19A_453_01", "ScanLog.fits"
+                )
+            ),
+            [
+                utc(2019, 3, 1, 0, 55),
+                utc(2019, 3, 1, 1, 0),
+                utc(2019, 3, 1, 1, 10, 30, 500000),
+            ],
+        )
+
+
+class SessionIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.root = os.path.join(temp_dir, "science-data")
+        shutil.copytree(FIXTURE_ROOT, self.root)
+        self.index_path = os.path.join(temp_dir, "sessions.pickle")
+
+    def get_index(self):
+        return SessionIndex(self.root, path=self.index_path)
+
+    def test_build(self):
+        index = self.get_index()
+        index.update()
+        self.assertEqual(
+            set(index.sessions), {"AGBT19A_453_01", "AGBT19A_453_02", "AGBT18B_001_01"}
+        )
+        self.assertEqual(
+            index.get_scanlog_path("AGBT18B_001_01"),
+            os.path.join(self.root, "AGBT18B_001", "AGBT18B_001_01", "ScanLog.fits"),
+        )
+        self.assertIsNone(index.get_scanlog_path("AGBT20A_999_01"))
+        self.assertIsNone(index.scan_times("AGBT20A_999_01"))
+
+    def test_scan_times(self):
+        self.assertEqual(
+            self.get_index().scan_times("AGBT19A_453_02"), [utc(2019, 3, 8, 4, 0)]
+        )
+
+        # The times are cached, so the ScanLog isn't read again
+        with mock.patch("turtlecli.sessions.parse_scan_times") as parse:
+            self.assertEqual(
+                self.get_index().scan_times("AGBT19A_453_02"), [utc(2019, 3, 8, 4, 0)]
+            )
+        parse.assert_not_called()
+
+    def test_incremental_update(self):
+        self.get_index().update()
+
+        project_dir = os.path.join(self.root, "AGBT19A_453")
+        os.mkdir(os.path.join(project_dir, "AGBT19A_453_03"))
+        shutil.copy(
+            os.path.join(project_dir, "AGBT19A_453_02", "ScanLog.fits"),
+            os.path.join(project_dir, "AGBT19A_453_03", "ScanLog.fits"),
+        )
+        # In case the filesystem's mtime resolution is too coarse to notice
+        mtime = os.stat(project_dir).st_mtime + 10
+        os.utime(project_dir, (mtime, mtime))
+
+        index = self.get_index()
+        with mock.patch.object(index, "_list_dir", wraps=index._list_dir) as list_dir:
+            self.assertEqual(
+                index.scan_times("AGBT19A_453_03"), [utc(2019, 3, 8, 4, 0)]
+            )
+        # Only the directory that changed was re-listed
+        list_dir.assert_called_once_with(project_dir)
+        self.assertIn("AGBT18B_001_01", index.sessions)
+
+    def test_removed_directory(self):
+        self.get_index().update()
+        shutil.rmtree(os.path.join(self.root, "AGBT18B_001"))
+
+        index = self.get_index()
+        index.update()
+        self.assertEqual(set(index.sessions), {"AGBT19A_453_01", "AGBT19A_453_02"})
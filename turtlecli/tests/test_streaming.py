@@ -0,0 +1,73 @@
+import sys
+import types
+from datetime import timedelta
+from unittest import mock
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.db.backends.sqlite3.base import SQLiteCursorWrapper
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+from tortoise.models import History
+from turtlecli.intervals import MAX_OR_RANGES, filterByIntervals
+from turtlecli.profiling import Profiler
+from turtlecli.streaming import _stream_mysql
+from turtlecli.tests.utils import TortoiseTablesMixin, create_history
+
+FIELDS = ["id", "datetime", "obsprocedure__name"]
+
+
+def fake_mysqldb():
+    """Return the modules of a MySQLdb whose SSCursor is a (buffered) SQLite cursor"""
+
+    cursors = types.ModuleType("MySQLdb.cursors")
+    cursors.SSCursor = SQLiteCursorWrapper
+    mysqldb = types.ModuleType("MySQLdb")
+    mysqldb.cursors = cursors
+    return {"MySQLdb": mysqldb, "MySQLdb.cursors": cursors}
+
+
+class StreamMySQLTestCase(TortoiseTablesMixin, TransactionTestCase):
+    # The stream's own connection must see the rows, so these can't be created
+    # inside a (TestCase) transaction
+
+    def setUp(self):
+        super().setUp()
+        start = timezone.now().replace(microsecond=0) - timedelta(days=1)
+        times = [start + timedelta(minutes=minutes) for minutes in range(0, 1500, 5)]
+        for time in times:
+            create_history(datetime=time)
+        self.addCleanup(History.objects.all().delete)
+        # More intervals than are ORed together, so they are sent via a
+        # temporary table (on this thread's connection)
+        self.queryset = History.objects.filter(
+            filterByIntervals([(time, time) for time in times[::2]])
+        ).order_by("datetime")
+        self.assertGreater(len(times[::2]), MAX_OR_RANGES)
+
+    def test_stream(self):
+        profiler = Profiler()
+        profiler.install()
+        self.addCleanup(self.uninstall, profiler)
+
+        with mock.patch.dict(sys.modules, fake_mysqldb()):
+            rows = list(_stream_mysql(self.queryset, FIELDS, chunk_size=7))
+
+        # The query was made through the execute wrappers of its connection
+        # (including the one that re-creates the temporary table on it)
+        selects = [
+            statement
+            for statement in profiler.statements
+            if statement["sql"].startswith("SELECT")
+        ]
+        self.assertEqual(len(selects), 1)
+        self.assertEqual(selects[0]["rows"], len(rows))
+        self.assertEqual(rows, list(self.queryset.values(*FIELDS)))
+
+    @staticmethod
+    def uninstall(profiler):
+        connection_created.disconnect(profiler._on_connection_created)
+        for connection in connections.all():
+            if profiler in connection.execute_wrappers:
+                connection.execute_wrappers.remove(profiler)
@@ -0,0 +1,154 @@
+import os
+import re
+import shutil
+import tempfile
+
+from django.test import TestCase, SimpleTestCase
+
+from turtlecli.tests.utils import TortoiseTablesMixin, create_history
+from turtlecli.textindex import (
+    TextIndex,
+    clear_text_indexes,
+    get_text_index,
+    required_literals,
+)
+
+LOGS = [
+    "receiver = 'Rcvr1_2'\ntint = 81.92e-6",
+    "RECEIVER = 'Rcvr2_3'\ntint = 40.96e-6",
+    "Configure(config)\nTrack(src, None, 60)",
+    "Slew('3C286')\nBalance()",
+    "abcdef",
+    "def only",
+    "ghi jkl",
+    "[12:00:00] ******** Begin Scheduling Block",
+    "Error: the scan was aborted",
+    "error: SCAN ABORTED",
+    "mapping the source",
+    "Stra\u00dfe \u00c4rger",
+    "\u0130stanbul",
+    "\u017fcan aborted",
+    "",
+]
+
+# (pattern, literals that every match must contain)
+REQUIRED_LITERALS = [
+    ("receiver", ["rece", "ver"]),
+    # The common prefix of the alternatives is required
+    ("rcvr1_2|rcvr2_3", ["rcvr"]),
+    # Literals that are too short for the trigram index are dropped
+    ("receiver = 'rcvr(1_2|2_3)'", ["rece", "ver = 'rcvr"]),
+    ("(abc)?def", ["def"]),
+    ("(abc)+def", ["abc", "def"]),
+    ("x*abc", ["abc"]),
+    ("abc?def", ["def"]),
+    ("[a-z]+ong", ["ong"]),
+    ("[Tt]ransmit", ["ransm"]),
+    ("track\\s*\\(\\s*src", ["track", "src"]),
+    ("^Slew\\('", ["Slew('"]),
+    ("(?i)begin scheduling", ["beg", "n schedul"]),
+    ("a.*b", []),
+    ("(?!foo)bar", ["bar"]),
+    # Characters which the index doesn't fold like re.IGNORECASE (such as i,
+    # which also matches \u0130) are skipped
+    ("istanbul", ["stanbul"]),
+    ("stra\u00dfe", ["stra"]),
+    ("[", []),
+]
+
+# Every regex is searched for (case-insensitively) both via the index and
+# by scanning every row; the results must be the same
+PATTERNS = [pattern for pattern, __ in REQUIRED_LITERALS if pattern != "["] + [
+    "RCVR",
+    "receiver|slew",
+    "(receiver|track).*(81|60)",
+    "scan (was )?aborted",
+    "sc[a-z]n",
+    "^def",
+    "^abc",
+    "e-6$",
+    "\\d\\d:\\d\\d:\\d\\d",
+    "\\*{8}",
+    "stra\u00dfe",
+    "\u00e4rger",
+    "",
+    "(?s)tint.*",
+    "tint\\s*=\\s*81",
+    "[Tt]int",
+    "[a-z]+ing",
+    "(abc|ghi)\\s*(def|jkl)",
+    "(?:map)+ping",
+    "a{0}def",
+    "sc(an)?",
+    "istanbul",
+    "\u0131stanbul",
+    "kelvin",
+]
+
+
+class RequiredLiteralsTestCase(SimpleTestCase):
+    def test_required_literals(self):
+        for pattern, literals in REQUIRED_LITERALS:
+            with self.subTest(pattern=pattern):
+                self.assertEqual(required_literals(pattern), literals)
+
+
+class SearchRegexTestCase(TortoiseTablesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.logs = {create_history(log=log).id: log for log in LOGS}
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.index = TextIndex(path=os.path.join(temp_dir, "textindex.sqlite3"))
+        self.index.update()
+
+    def test_search_regex(self):
+        for pattern in PATTERNS:
+            with self.subTest(pattern=pattern):
+                self.assertEqual(
+                    self.index.search_regex("log", [pattern]),
+                    {
+                        id_
+                        for id_, log in self.logs.items()
+                        if log and re.search(pattern, log, re.IGNORECASE)
+                    },
+                )
+
+    def test_search_regexes(self):
+        # Any of the given regexes may match
+        self.assertEqual(
+            self.index.search_regex("log", ["rcvr1", "slew"]),
+            {
+                id_
+                for id_, log in self.logs.items()
+                if re.search("rcvr1|slew", log, re.IGNORECASE)
+            },
+        )
+
+    def test_invalid_regex(self):
+        with self.assertRaises(ValueError):
+            self.index.search_regex("log", ["["])
+
+
+class GetTextIndexTestCase(TortoiseTablesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(clear_text_indexes)
+
+    def test_clear_text_indexes(self):
+        first = create_history(log="the scan was aborted")
+        self.assertEqual(
+            get_text_index().search_contains("log", ["aborted"]), {first.id}
+        )
+
+        # Retrieving the index again doesn't update it...
+        second = create_history(log="the scan was aborted again")
+        self.assertEqual(
+            get_text_index().search_contains("log", ["aborted"]), {first.id}
+        )
+        # ...but it is once it has been cleared (as the daemon does after
+        # every request)
+        clear_text_indexes()
+        self.assertEqual(
+            get_text_index().search_contains("log", ["aborted"]), {first.id, second.id}
+        )
@@ -0,0 +1,95 @@
+"""Helpers shared by the turtlecli tests"""
+
+import os
+import shutil
+import sqlite3
+
+from django.db import connections
+from django.utils import timezone
+
+from tortoise.models import History, ObsProcedure, ObsProjectRef, Observer, Operator
+from turtlecli import cache
+from turtlecli.replica import create_tables
+
+# The default SQLITE_MAX_VARIABLE_NUMBER before SQLite 3.32
+MAX_VARIABLE_NUMBER = 999
+
+
+def reset_caches():
+    """Forget all of the (process-wide and on-disk) caches of the DB"""
+
+    cache._DIMENSION_CACHES.clear()
+    shutil.rmtree(cache.CACHE_DIR, ignore_errors=True)
+    os.makedirs(cache.CACHE_DIR)
+
+
+def limit_variables(connection):
+    """Restore the historical limit on the variables of the given SQLite connection
+
+    Recent SQLite builds allow far more parameters than Django assumes
+    (max_query_params), which would hide statements that have too many"""
+
+    if hasattr(connection.connection, "setlimit"):
+        connection.connection.setlimit(
+            sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, MAX_VARIABLE_NUMBER
+        )
+
+
+def create_history(
+    project_name="AGBT19A_453",
+    script_name="mapping",
+    datetime=None,
+    executed_script="",
+    log="",
+    observer_name="Thomas Chamberlin",
+    operator_name="Greg Monk",
+    executed_state="obs_completed",
+    using="default",
+):
+    """Create a History row (and any dimension rows it needs), and return it"""
+
+    observer, __ = Observer.objects.using(using).get_or_create(name=observer_name)
+    operator, __ = Operator.objects.using(using).get_or_create(name=operator_name)
+    project, __ = ObsProjectRef.objects.using(using).get_or_create(
+        name=project_name, defaults={"primary_observer": observer, "session": ""}
+    )
+    procedure, __ = ObsProcedure.objects.using(using).get_or_create(
+        name=script_name,
+        obsprojectref=project,
+        defaults={
+            "session": "",
+            "script": executed_script,
+            "operator": operator,
+            "observer": observer,
+            "state": "saved",
+            "status": "valid",
+            "last_modified": timezone.now(),
+        },
+    )
+    return History.objects.using(using).create(
+        obsprocedure=procedure,
+        observer=observer,
+        operator=operator,
+        datetime=datetime if datetime else timezone.now(),
+        version="1",
+        executed_script=executed_script,
+        executed_state=executed_state,
+        log=log,
+    )
+
+
+class TortoiseTablesMixin:
+    """Creates the tortoise tables, which (being unmanaged) the test runner doesn't
+
+    Must come before the TestCase class in the bases"""
+
+    @classmethod
+    def setUpClass(cls):
+        # Before TestCase starts its transaction; SQLite can't alter the
+        # schema inside one
+        create_tables(using="default")
+        super().setUpClass()
+
+    def setUp(self):
+        super().setUp()
+        reset_caches()
@@ -0,0 +1,380 @@
+"""Local full-text index of History scripts and logs
+
+Searching within History.executed_script and History.log on the server means
+a LIKE '%...%' over every one of these (multi-kilobyte) fields. Instead, they
+can be indexed locally in a SQLite FTS5 table, using the trigram tokenizer
+(which supports case-insensitive substring matching). Searches then return
+the matching History IDs, which are used to fetch the results from the server
+by primary key.
+
+Regular expression searches are accelerated in the same way: the literal
+strings that any match of a regex must contain are extracted from it, and
+used to narrow the search to a set of candidate rows via the trigram index.
+Only those candidates are then checked against the actual regex. If a regex
+has no usable literals, every row in the index is checked.
+
+The keyword=value statements in each script (see turtlecli.scriptkwargs) are
+extracted into a separate table of (history_id, keyword, value, num) as
+scripts are indexed, so that --kwargs searches are simple indexed lookups
+(where num is the value as a number, if it is one).
+
+The index is built incrementally by History ID: every update fetches only
+the rows above the highest indexed ID, plus any rows that were still in
+progress as of the last update (since their logs may have grown).
+"""
+
+import logging
+import os
+import re
+import sqlite3
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+from tortoise.models import History
+from turtlecli.cache import get_cache_path, get_db_alias
+from turtlecli.scriptkwargs import (
+    extract_kwargs,
+    normalize_keyword,
+    normalize_value,
+    to_number,
+)
+
+logger = logging.getLogger(__name__)
+
+# Note that this is the (misspelled) value actually stored in the DB
+IN_PROGRESS_STATE = "obs_in_progess"
+# Number of History rows fetched from the DB at a time when updating the index
+UPDATE_CHUNK_SIZE = 500
+# The fields of History that are indexed
+TEXT_FIELDS = ("executed_script", "log")
+# The trigram tokenizer can only use its index for strings of at least this length
+MIN_INDEXED_LENGTH = 3
+# Stored as the user_version of the index DB. Bump this whenever the way in
+# which kwargs are extracted changes, so that they are re-extracted
+KWARGS_VERSION = 1
+
+
+class TextIndexError(Exception):
+    pass
+
+
+def quote_fts_string(string):
+    """Quote the given string as an FTS5 phrase"""
+
+    return '"{}"'.format(string.replace('"', '""'))
+
+
+def escape_like(string):
+    r"""Escape the LIKE wildcards in the given string (using \ as the escape character)"""
+
+    return string.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+# Repetition opcodes of the regex parser (POSSESSIVE_REPEAT is new in Python 3.11)
+REPEAT_OPS = tuple(
+    getattr(sre_constants, name)
+    for name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+    if hasattr(sre_constants, name)
+)
+
+
+def is_safely_foldable(char):
+    """Return True if the trigram index folds the case of the given character
+    exactly as re.IGNORECASE does
+
+    That isn't so for i, which re.IGNORECASE also matches to the Turkish dotted
+    and dotless I (which SQLite doesn't fold to i), nor for much outside ASCII"""
+
+    return ord(char) < 128 and char not in "iI"
+
+
+def required_literals(pattern):
+    """Return a list of literal strings that every match of `pattern` must contain
+
+    This is conservative: it only considers literals that are not within an
+    alternation or optional repetition. An empty list means that nothing is
+    known about the pattern's matches"""
+
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (re.error, sre_constants.error):
+        return []
+
+    literals = []
+
+    def flush(run):
+        if run:
+            literals.append("".join(run))
+            run.clear()
+
+    def walk(items):
+        run = []
+        for op, av in items:
+            if op is sre_constants.LITERAL and is_safely_foldable(chr(av)):
+                run.append(chr(av))
+                continue
+
+            flush(run)
+            if op is sre_constants.SUBPATTERN:
+                # av is (group, add_flags, del_flags, pattern)
+                walk(av[-1])
+            elif op in REPEAT_OPS:
+                # av is (min, max, pattern); if min is 0 it is optional
+                min_repeat, __, repeated = av
+                if min_repeat >= 1:
+                    walk(repeated)
+            # Everything else (alternations, character classes, etc.) tells
+            # us nothing about which literals are required
+        flush(run)
+
+    walk(parsed)
+    return [literal for literal in literals if len(literal) >= MIN_INDEXED_LENGTH]
+
+
+class TextIndex:
+    def __init__(self, path=None, using=None):
+        self.using = get_db_alias(using)
+        self.path = path if path else get_cache_path("textindex", self.using, "sqlite3")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        try:
+            self.db.executescript(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS history_text "
+                "USING fts5(executed_script, log, tokenize='trigram');"
+                "CREATE TABLE IF NOT EXISTS in_progress (id INTEGER PRIMARY KEY);"
+                "CREATE TABLE IF NOT EXISTS kwargs "
+                "(history_id INTEGER NOT NULL, keyword TEXT NOT NULL, "
+                "value TEXT NOT NULL, num REAL);"
+                "CREATE INDEX IF NOT EXISTS kwargs_value ON kwargs (keyword, value);"
+                "CREATE INDEX IF NOT EXISTS kwargs_num ON kwargs (keyword, num);"
+                "CREATE INDEX IF NOT EXISTS kwargs_history_id ON kwargs (history_id);"
+            )
+        except sqlite3.OperationalError as error:
+            raise TextIndexError(
+                "Could not create text index {} (note that SQLite >= 3.34 is "
+                "required): {}".format(self.path, error)
+            )
+
+        (kwargs_version,) = self.db.execute("PRAGMA user_version").fetchone()
+        if kwargs_version != KWARGS_VERSION:
+            self._reindex_kwargs()
+
+    def close(self):
+        self.db.close()
+
+    def watermark(self):
+        """Return the highest History ID in the index"""
+
+        (watermark,) = self.db.execute("SELECT max(rowid) FROM history_text").fetchone()
+        return watermark or 0
+
+    def _index_kwargs(self, id_, executed_script):
+        self.db.execute("DELETE FROM kwargs WHERE history_id = ?", (id_,))
+        self.db.executemany(
+            "INSERT INTO kwargs (history_id, keyword, value, num) VALUES (?, ?, ?, ?)",
+            [
+                (id_, keyword, value, to_number(value))
+                for keyword, value in extract_kwargs(executed_script)
+            ],
+        )
+
+    def _reindex_kwargs(self):
+        """Re-extract the kwargs of every script that is already in the index
+
+        This is done locally, from the indexed scripts"""
+
+        logger.debug("Extracting kwargs from all indexed scripts")
+        with self.db:
+            self.db.execute("DELETE FROM kwargs")
+            for id_, executed_script in self.db.execute(
+                "SELECT rowid, executed_script FROM history_text"
+            ).fetchall():
+                self._index_kwargs(id_, executed_script)
+            self.db.execute("PRAGMA user_version = {:d}".format(KWARGS_VERSION))
+
+    def _index_rows(self, rows):
+        with self.db:
+            for id_, executed_script, log, executed_state in rows:
+                self.db.execute("DELETE FROM history_text WHERE rowid = ?", (id_,))
+                self.db.execute(
+                    "INSERT INTO history_text (rowid, executed_script, log) "
+                    "VALUES (?, ?, ?)",
+                    (id_, executed_script, log),
+                )
+                self._index_kwargs(id_, executed_script)
+                if executed_state == IN_PROGRESS_STATE:
+                    self.db.execute(
+                        "INSERT OR IGNORE INTO in_progress (id) VALUES (?)", (id_,)
+                    )
+                else:
+                    self.db.execute("DELETE FROM in_progress WHERE id = ?", (id_,))
+
+    def update(self):
+        """Index all History rows that are new (or were in progress) since the last update"""
+
+        queryset = History.objects.using(self.using).values_list(
+            "id", *TEXT_FIELDS, "executed_state"
+        )
+        in_progress = [id_ for (id_,) in self.db.execute("SELECT id FROM in_progress")]
+        if in_progress:
+            logger.debug("Re-indexing %s in-progress History rows", len(in_progress))
+            self._index_rows(queryset.filter(id__in=in_progress))
+
+        watermark = self.watermark()
+        while True:
+            rows = list(
+                queryset.filter(id__gt=watermark).order_by("id")[:UPDATE_CHUNK_SIZE]
+            )
+            if not rows:
+                break
+            self._index_rows(rows)
+            watermark = rows[-1][0]
+            logger.debug("Indexed History rows up to ID %s", watermark)
+
+    def search_contains(self, field, strings):
+        """Return the set of History IDs whose `field` contains any of the given strings
+
+        Matching is case-insensitive"""
+
+        if field not in TEXT_FIELDS:
+            raise ValueError(
+                "Field must be one of {}; got {}".format(TEXT_FIELDS, field)
+            )
+
+        ids = set()
+        for string in strings:
+            if len(string) >= MIN_INDEXED_LENGTH:
+                cursor = self.db.execute(
+                    "SELECT rowid FROM history_text WHERE history_text MATCH ?",
+                    ("{} : {}".format(field, quote_fts_string(string)),),
+                )
+            else:
+                # Too short to use the index; fall back to a scan (which is
+                # at least local)
+                cursor = self.db.execute(
+                    "SELECT rowid FROM history_text WHERE {} LIKE ? ESCAPE '\\'".format(
+                        field
+                    ),
+                    ("%{}%".format(escape_like(string)),),
+                )
+            ids.update(id_ for (id_,) in cursor)
+        logger.debug(
+            "Found %s History IDs with %s containing %s", len(ids), field, strings
+        )
+        return ids
+
+    def search_regex(self, field, patterns):
+        """Return the set of History IDs whose `field` matches any of the given regexes
+
+        Matching is case-insensitive, and uses Python-style regular expressions"""
+
+        if field not in TEXT_FIELDS:
+            raise ValueError(
+                "Field must be one of {}; got {}".format(TEXT_FIELDS, field)
+            )
+
+        ids = set()
+        for pattern in patterns:
+            try:
+                regex = re.compile(pattern, re.IGNORECASE)
+            except re.error as error:
+                raise ValueError(
+                    "Invalid regular expression {!r}: {}".format(pattern, error)
+                )
+
+            literals = required_literals(pattern)
+            if literals:
+                logger.debug(
+                    "Narrowing search for %r to rows containing %s", pattern, literals
+                )
+                cursor = self.db.execute(
+                    "SELECT rowid, {} FROM history_text WHERE history_text MATCH ?".format(
+                        field
+                    ),
+                    (
+                        "{} : ({})".format(
+                            field,
+                            " AND ".join(
+                                quote_fts_string(literal) for literal in literals
+                            ),
+                        ),
+                    ),
+                )
+            else:
+                logger.debug(
+                    "No usable literals in %r; checking every indexed row", pattern
+                )
+                cursor = self.db.execute(
+                    "SELECT rowid, {} FROM history_text".format(field)
+                )
+
+            ids.update(id_ for id_, text in cursor if text and regex.search(text))
+        logger.debug(
+            "Found %s History IDs with %s matching %s", len(ids), field, patterns
+        )
+        return ids
+
+    def search_kwargs(self, kwargs, match_all=False):
+        """Return the set of History IDs whose scripts contain the given kwargs
+
+        kwargs is a dict of {keyword: value}. Matching is case-insensitive,
+        and numeric values are compared as numbers (so e.g. 1e-3 matches
+        0.001). If match_all is given, scripts must contain every one of the
+        kwargs; otherwise, any of them"""
+
+        ids = None
+        for keyword, value in kwargs.items():
+            value = normalize_value(value)
+            matching_ids = {
+                id_
+                for (id_,) in self.db.execute(
+                    "SELECT history_id FROM kwargs WHERE keyword = ? "
+                    "AND (value = ? OR num = ?)",
+                    (normalize_keyword(keyword), value, to_number(value)),
+                )
+            }
+            if ids is None:
+                ids = matching_ids
+            elif match_all:
+                ids &= matching_ids
+            else:
+                ids |= matching_ids
+        ids = ids or set()
+        logger.debug(
+            "Found %s History IDs with %s of kwargs %s",
+            len(ids),
+            "all" if match_all else "any",
+            kwargs,
+        )
+        return ids
+
+
+_TEXT_INDEXES = {}
+
+
+def get_text_index(using=None):
+    """Return the (process-wide) TextIndex for the given DB alias
+
+    The index is brought up to date the first time it is retrieved"""
+
+    using = get_db_alias(using)
+    if using not in _TEXT_INDEXES:
+        text_index = TextIndex(using=using)
+        text_index.update()
+        _TEXT_INDEXES[using] = text_index
+    return _TEXT_INDEXES[using]
+
+
+def clear_text_indexes():
+    """Close and forget the process-wide TextIndexes
+
+    They are re-opened (and brought up to date) when next retrieved"""
+
+    for text_index in _TEXT_INDEXES.values():
+        text_index.close()
+    _TEXT_INDEXES.clear()
@@ -1,17 +1,13 @@
 """Misc. utilities"""
 
+import difflib
 import logging
-import subprocess
+import shutil
 
 from django.db import connection
 
 from colorama import Fore
-from pygments import highlight
-from pygments.formatters import TerminalFormatter
-from pygments.lexers import MySqlLexer
 from tabulate import tabulate
-import sqlparse
-
 
 CONSOLE_LOGGER = logging.getLogger(__name__)
 
@@ -34,6 +30,16 @@ DEFAULT_HISTORY_TABLE_FIELDNAMES = (
     "executed_state",
 )
 
+# The same fields as above, but with IDs in place of names. These are
+# resolved into names via the dimension cache
+HISTORY_TABLE_ID_FIELDNAMES = (
+    "datetime",
+    "obsprocedure",
+    "observer",
+    "operator",
+    "executed_state",
+)
+
 
 def formatTable(table, headers):
     return tabulate(table, headers=headers)
@@ -76,6 +82,25 @@ def in_ipython():
         return True
 
 
+def diff_lines(text_a, text_b, compact=True):
+    """Generate the lines of the unified (if compact) or full diff of the given texts"""
+
+    lines_a = text_a.split("\n")
+    lines_b = text_b.split("\n")
+    if compact:
+        return difflib.unified_diff(lines_a, lines_b)
+    return difflib.ndiff(lines_a, lines_b)
+
+
+def diff_scripts(script_a, script_b, compact=True):
+    """Return the (uncolored) diff of the given scripts, as a single string
+
+    This is run in worker processes which (being started by a forkserver, rather
+    than forked from turtlecli itself) needn't have set up Django"""
+
+    return "\n".join(diff_lines(script_a or "", script_b or "", compact))
+
+
 # From: https://chezsoi.org/lucas/blog/colored-diff-output-with-python.html
 def color_diff(diff):
     for line in diff:
@@ -105,6 +130,12 @@ def formatSql(sql, indent=False):
 
     Optionally indent every line of the SQL before returning it."""
 
+    # These are slow to import, and only needed when displaying SQL
+    from pygments import highlight
+    from pygments.formatters import TerminalFormatter
+    from pygments.lexers import MySqlLexer
+    import sqlparse
+
     formatted = sqlparse.format(sql, reindent=True, keyword_case="upper")
     if indent:
         lines = []
@@ -127,8 +158,9 @@ class DjangoSqlFormatter(logging.Formatter):
 
 
 def get_console_width():
-    _, console_width_str = subprocess.check_output(["stty", "size"]).decode().split()
-    return int(console_width_str)
+    # This honors $COLUMNS (e.g. set by the daemon to the width of the client's
+    # terminal), and falls back to 80 if there is no terminal
+    return shutil.get_terminal_size().columns
 
 
 def format_date_time(dt):